@@ -5,101 +5,110 @@ import { elemGenerator } from "https://javajawa.github.io/elems.js/elems.js";
 const upload = document.getElementById("upload");
 const list = document.getElementById("list");
 const submit = document.getElementById("submit");
-const reader = new FileReader();
+const form = upload.form;
 
 const input = elemGenerator("input");
 const label = elemGenerator("label");
 const li = elemGenerator("li");
 
-upload.addEventListener("change", () => reader.readAsText(upload.files[0]));
+// The upload session for the current file, once the server has read it.
+let session = null;
+
+upload.addEventListener("change", sendFile);
 list.addEventListener("change", () => {
 	submit.setAttribute("disabled", "");
 	list.querySelectorAll("input").forEach(i => {
 		i.checked && submit.removeAttribute("disabled");
 	});
 });
-reader.addEventListener("load", processEmpires);
+form.addEventListener("submit", sendSelection);
 
-function processEmpires() {
+function clearList() {
 	while (list.lastChild) {
 		list.removeChild(list.lastChild);
 	}
+}
+
+function showMessage(message) {
+	clearList();
+	message.split("\n").forEach(line => list.appendChild(li(line)));
+}
+
+function sendFile() {
+	session = null;
 	submit.setAttribute("disabled", "");
 
-	const data = reader.result;
-
-	// Offset where the current empire starts.
-	let start = 0;
-	// Offset we have read up to.
-	let offset = data.indexOf("{");
-	// The nesting level of `{}` we're at.
-	let depth = 1;
-	// Where the next `{` and `}` are.
-	let nextOpen, nextClose;
-
-	while (true) {
-		// Find the next braces.
-		nextOpen = data.indexOf("{", offset + 1);
-		nextClose = data.indexOf("}", offset + 1);
-
-		// If no more braces, we're done
-		if (nextOpen === -1 && nextClose === -1) {
-			return;
-		}
-
-		if (nextOpen !== -1 && nextOpen < nextClose) {
-			++depth;
-			offset = nextOpen;
-			continue;
-		}
-
-		// We're up one level of nested
-		--depth;
-
-		// If depth > 0, we're still in an empire definitions.
-		if (depth) {
-			offset = nextClose;
-			continue;
-		}
-
-		// If depth == 0, everything between `start`
-		processEmpire(data.substring(start, nextClose));
-
-		// If there are no { after this empire, then no more empires.
-		if (nextOpen === -1) {
-			return;
-		}
-
-		start = nextClose + 1;
-		offset = nextOpen;
-		depth = 1;
+	if (!upload.files.length) {
+		return;
 	}
-}
 
-function processEmpire(text) {
-	const lines = text.trim().split("\n");
+	showMessage("Reading " + upload.files[0].name + "...");
 
-	let name = lines[0].trim();
+	const data = new FormData();
 
-	while (name.endsWith("{") || name.endsWith("=")) {
-		name = name.substring(0, name.length - 1).trim();
+	data.append("file", upload.files[0]);
+
+	fetch("/upload-session", { method: "POST", body: data })
+		.then(response => checkResponse(response).json())
+		.then(showEmpires)
+		.catch(error => showMessage(error.message));
+}
+
+function checkResponse(response) {
+	if (!response.ok) {
+		throw new Error(
+			"Upload failed: " + response.status + " " + response.statusText
+		);
 	}
 
-	let ethics = [];
+	return response;
+}
 
-	lines
-		.map(line => line.trim())
-		.filter(line => line.startsWith("ethic"))
-		.map(line => line.replace(/^ethic="/, ""))
-		.map(line => line.replace(/^ethic_/, ""))
-		.map(line => line.replace("_", " "))
-		.map(line => line.replace(/"$/, ""))
-		.forEach(line => ethics.push(line));
+function showEmpires(data) {
+	clearList();
+	session = data.session;
+	data.empires.forEach(processEmpire);
+}
+
+function processEmpire(empire) {
+	const attributes = {
+		id: empire.name,
+		type: "checkbox",
+		name: "select",
+		value: empire.name
+	};
+	let description = empire.name + " [" + empire.ethics.join(", ") + "]";
+
+	if (!empire.valid) {
+		attributes.disabled = "";
+		description += " (does not appear to be a valid empire)";
+	}
 
 	list.appendChild(
-		li(
-			input({ id: name, type: "checkbox", name: "select", value: name }),
-			label({ for: name }, name + " [" + ethics.join(", ") + "]")
-		)
+		li(input(attributes), label({ for: empire.name }, description))
 	);
 }
+
+function sendSelection(event) {
+	event.preventDefault();
+
+	if (!session) {
+		return;
+	}
+
+	const data = new URLSearchParams();
+
+	for (const box of list.querySelectorAll("input:checked")) {
+		data.append("select", box.value);
+	}
+
+	submit.setAttribute("disabled", "");
+
+	fetch("/upload-session/" + session, { method: "POST", body: data })
+		.then(response => checkResponse(response).text())
+		.then(report => {
+			showMessage(report);
+			setTimeout(() => location.reload(), 5000);
+		})
+		.catch(error => showMessage(error.message));
+}
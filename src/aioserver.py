@@ -0,0 +1,295 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: nospell ts=4 expandtab
+
+"""
+asyncio front end for BaseHTTPRequestHandler based servers.
+
+Connections are owned by an event loop, so an idle keep-alive connection
+costs a coroutine rather than a thread. Once a request's head has been
+read, it is handed to an instance of the normal request handler class,
+either directly on the loop, or, if the handler class says the request may
+block, in a bounded pool of worker threads. Requests with a body always go
+to the pool, and the body is streamed to the handler as it arrives, rather
+than being held in memory.
+"""
+
+from __future__ import annotations
+
+from typing import Any, Optional, Tuple, Type
+
+import asyncio
+import concurrent.futures
+import email.message
+import http.client
+import http.server
+import io
+import ssl
+import traceback
+
+# How long, in seconds, an idle keep-alive connection is kept open.
+KEEP_ALIVE_TIMEOUT = 120.0
+
+# The largest request head (request line and headers) that will be read.
+MAX_HEAD_SIZE = 64 * 1024
+
+# Size of the buffer for responses written from worker threads.
+WRITE_BUFFER_SIZE = 64 * 1024
+
+
+class AsyncioRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Handler mixin that serves a single request which has already been read.
+
+    Unlike a socketserver handler, there is no socket or server; the
+    request is read from `rfile`, and the response written to `wfile`.
+    """
+
+    def __init__(
+        self: AsyncioRequestHandler,
+        rfile: io.BufferedIOBase,
+        wfile: io.BufferedIOBase,
+        client_address: Tuple[str, int],
+    ) -> None:
+        self.rfile = rfile
+        self.wfile = wfile
+        self.client_address = client_address
+
+        try:
+            self.handle_one_request()
+        finally:
+            self.wfile.flush()
+
+    @staticmethod
+    def is_blocking(command: str, path: str, headers: email.message.Message) -> bool:
+        """Whether a request may block, and so has to be run off the event loop"""
+
+        return True
+
+
+class LoopWriter(io.RawIOBase):
+    """
+    Writable stream, for use from a worker thread, which writes to a
+    connection owned by the event loop, waiting for each write to drain.
+    """
+
+    loop: asyncio.AbstractEventLoop
+    writer: asyncio.StreamWriter
+
+    def __init__(
+        self: LoopWriter, loop: asyncio.AbstractEventLoop, writer: asyncio.StreamWriter
+    ) -> None:
+        super().__init__()
+        self.loop = loop
+        self.writer = writer
+
+    def writable(self: LoopWriter) -> bool:
+        return True
+
+    def write(self: LoopWriter, data: Any) -> int:
+        data = bytes(data)
+        asyncio.run_coroutine_threadsafe(self.send(data), self.loop).result()
+
+        return len(data)
+
+    async def send(self: LoopWriter, data: bytes) -> None:
+        self.writer.write(data)
+        await self.writer.drain()
+
+
+class LoopReader(io.RawIOBase):
+    """
+    Readable stream, for use from a worker thread, of a request which is
+    being received by the event loop: the head, which has already been
+    read, followed by up to `remaining` bytes of the body.
+    """
+
+    loop: asyncio.AbstractEventLoop
+    reader: asyncio.StreamReader
+    head: bytes
+
+    # The bytes of the body not yet read from the connection.
+    remaining: int
+
+    def __init__(
+        self: LoopReader,
+        loop: asyncio.AbstractEventLoop,
+        reader: asyncio.StreamReader,
+        head: bytes,
+        length: int,
+    ) -> None:
+        super().__init__()
+        self.loop = loop
+        self.reader = reader
+        self.head = head
+        self.remaining = length
+
+    def readable(self: LoopReader) -> bool:
+        return True
+
+    def readinto(self: LoopReader, buffer: Any) -> int:
+        if self.head:
+            data = self.head[: len(buffer)]
+            count = len(data)
+            self.head = self.head[count:]
+        elif self.remaining > 0:
+            read = self.reader.read(min(len(buffer), self.remaining))
+            future = asyncio.run_coroutine_threadsafe(read, self.loop)
+            data = future.result(KEEP_ALIVE_TIMEOUT)
+            self.remaining -= len(data)
+        else:
+            return 0
+
+        buffer[: len(data)] = data
+
+        return len(data)
+
+
+class AsyncioHTTPServer:
+    """Serves HTTP/1.1 connections from an event loop"""
+
+    # The handler class, combined with AsyncioRequestHandler.
+    handler_class: Type[AsyncioRequestHandler]
+
+    # Pool for the requests which may block.
+    executor: concurrent.futures.ThreadPoolExecutor
+
+    # Bounds the number of requests queued for, or running in, the pool.
+    slots: Optional[asyncio.Semaphore]
+
+    workers: int
+
+    def __init__(
+        self: AsyncioHTTPServer,
+        handler_class: Type[http.server.BaseHTTPRequestHandler],
+        workers: int,
+    ) -> None:
+        self.handler_class = type(
+            "Asyncio" + handler_class.__name__,
+            (handler_class, AsyncioRequestHandler),
+            {},
+        )
+        self.workers = workers
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.slots = None
+
+    async def serve_forever(
+        self: AsyncioHTTPServer,
+        address: Tuple[str, int],
+        context: Optional[ssl.SSLContext] = None,
+    ) -> None:
+        self.slots = asyncio.Semaphore(self.workers)
+
+        server = await asyncio.start_server(
+            self.serve_connection,
+            address[0] or None,
+            address[1],
+            ssl=context,
+            limit=MAX_HEAD_SIZE,
+        )
+
+        for sock in server.sockets or []:
+            print(f"Serving HTTP (asyncio) on {sock.getsockname()}…")
+
+        async with server:
+            await server.serve_forever()
+
+    async def serve_connection(
+        self: AsyncioHTTPServer,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        address = writer.get_extra_info("peername")
+
+        try:
+            while await self.serve_request(reader, writer, address):
+                pass
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        except asyncio.LimitOverrunError:
+            writer.write(b"HTTP/1.1 431 Request Header Fields Too Large\r\n\r\n")
+        except Exception:
+            traceback.print_exc()
+        finally:
+            writer.close()
+
+    async def serve_request(
+        self: AsyncioHTTPServer,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        address: Tuple[str, int],
+    ) -> bool:
+        """
+        Reads and handles one request.
+
+        :return: Whether the connection should be kept open for another request.
+        """
+
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), KEEP_ALIVE_TIMEOUT)
+
+        request_line, _, header_data = head.partition(b"\r\n")
+        headers = http.client.parse_headers(io.BytesIO(header_data))
+
+        try:
+            length = max(0, int(headers.get("Content-Length") or 0))
+        except ValueError:
+            length = 0
+
+        words = request_line.decode("iso-8859-1").split()
+
+        # Whether the whole request has been read.
+        complete = True
+
+        # Malformed requests are left to the handler to reject.
+        if length or (
+            len(words) == 3
+            and self.handler_class.is_blocking(words[0], words[1], headers)
+        ):
+            loop = asyncio.get_event_loop()
+            body = LoopReader(loop, reader, head, length)
+            handler = await self.run_in_pool(io.BufferedReader(body), writer, address)
+            complete = not body.remaining
+        else:
+            wfile = io.BytesIO()
+            handler = self.handler_class(io.BytesIO(head), wfile, address)
+            writer.write(wfile.getvalue())
+
+        await writer.drain()
+
+        # The connection can not be reused if some of the body is unread.
+        return complete and not handler.close_connection
+
+    async def run_in_pool(
+        self: AsyncioHTTPServer,
+        rfile: io.BufferedIOBase,
+        writer: asyncio.StreamWriter,
+        address: Tuple[str, int],
+    ) -> AsyncioRequestHandler:
+        """Handles a request in the worker pool, streaming the response back"""
+
+        loop = asyncio.get_event_loop()
+        wfile = io.BufferedWriter(LoopWriter(loop, writer), WRITE_BUFFER_SIZE)
+
+        def run() -> AsyncioRequestHandler:
+            return self.handler_class(rfile, wfile, address)
+
+        assert self.slots is not None
+
+        async with self.slots:
+            return await loop.run_in_executor(self.executor, run)
+
+
+def serve(
+    handler_class: Type[http.server.BaseHTTPRequestHandler],
+    address: Tuple[str, int],
+    workers: int,
+    context: Optional[ssl.SSLContext] = None,
+) -> None:
+    """Runs an asyncio HTTP server until interrupted"""
+
+    server = AsyncioHTTPServer(handler_class, workers)
+
+    try:
+        asyncio.run(server.serve_forever(address, context))
+    finally:
+        server.executor.shutdown(wait=False)
@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: nospell ts=4 expandtab
+
+"""
+In-memory cache of the static files (pages, scripts, styles and images).
+
+Each file is read once, has its `<!--include file-->` lines expanded (for
+HTML), and is compressed into a CachedBody. The files, and any files they
+include, are stat(2)ed at most once every STAT_INTERVAL seconds to check
+for changes, in which case the asset is rebuilt.
+"""
+
+from __future__ import annotations
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import io
+import os
+import re
+import threading
+import time
+
+from compression import CachedBody
+
+INCLUDE_SNIPPET = re.compile("\\s*<!--include (?P<file>.*)-->\\s*")
+
+# How often, in seconds, an asset's files are checked for changes.
+STAT_INTERVAL = 1.0
+
+# (filename, mime type)
+AssetKey = Tuple[str, str]
+
+
+class Asset:
+    """A static file, ready to send"""
+
+    body: CachedBody
+
+    # The modification time of the newest file used to build the asset.
+    mtime: int
+
+    # The modification time of each file used to build the asset.
+    sources: Dict[str, float]
+
+    # When the files were last checked for changes (monotonic clock).
+    checked: float
+
+    def __init__(self: Asset, body: CachedBody, sources: Dict[str, float]) -> None:
+        self.body = body
+        self.sources = sources
+        self.mtime = int(max(sources.values()))
+        self.checked = time.monotonic()
+
+    def is_stale(self: Asset) -> bool:
+        """Checks if any of the asset's files have changed (rate limited)"""
+
+        now = time.monotonic()
+
+        if now - self.checked < STAT_INTERVAL:
+            return False
+
+        self.checked = now
+
+        for filename, mtime in self.sources.items():
+            try:
+                if os.stat(filename).st_mtime != mtime:
+                    return True
+            except OSError:
+                return True
+
+        return False
+
+
+def expand_includes(data: bytes, sources: Dict[str, float]) -> bytes:
+    """
+    Replaces `<!--include file-->` lines with the contents of the file.
+
+    :param sources: Updated with the modification time of each included file.
+    """
+
+    output: List[bytes] = []
+
+    for line in io.TextIOWrapper(io.BytesIO(data), encoding="utf-8"):
+        match = INCLUDE_SNIPPET.search(line)
+
+        if not match:
+            output.append(line.encode("utf-8"))
+            continue
+
+        filename = match.group("file")
+        start, end = match.span()
+
+        output.append(line[:start].encode("utf-8"))
+
+        with open(filename, "rb") as include:
+            sources[filename] = os.fstat(include.fileno()).st_mtime
+            output.append(include.read())
+
+        output.append(line[end:].encode("utf-8"))
+
+    return b"".join(output)
+
+
+def load_asset(filename: str, mime: str) -> Optional[Asset]:
+    """Reads (and, for HTML, expands) a file, or None if it does not exist"""
+
+    if not os.path.isfile(filename):
+        return None
+
+    with open(filename, "rb") as handle:
+        sources = {filename: os.fstat(handle.fileno()).st_mtime}
+        data = handle.read()
+
+    if mime == "text/html":
+        data = expand_includes(data, sources)
+
+    return Asset(CachedBody(data, mime), sources)
+
+
+class AssetCache:
+    """All the static assets which have been requested or preloaded"""
+
+    assets: Dict[AssetKey, Asset]
+    lock: threading.Lock
+
+    def __init__(self: AssetCache) -> None:
+        self.assets = {}
+        self.lock = threading.Lock()
+
+    def get(self: AssetCache, filename: str, mime: str) -> Optional[Asset]:
+        """Gets an asset, loading or reloading it if needed"""
+
+        key = (filename, mime)
+
+        with self.lock:
+            asset = self.assets.get(key)
+
+            if asset and not asset.is_stale():
+                return asset
+
+        asset = load_asset(filename, mime)
+
+        with self.lock:
+            if asset:
+                self.assets[key] = asset
+            else:
+                self.assets.pop(key, None)
+
+        return asset
+
+    def preload(self: AssetCache, files: Iterable[AssetKey]) -> None:
+        """Loads a set of assets ahead of them being requested"""
+
+        for filename, mime in files:
+            self.get(filename, mime)
+
+
+ASSETS = AssetCache()
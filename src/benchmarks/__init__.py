@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: nospell ts=4 expandtab
+
+"""
+Benchmarks for the upload and download hot paths.
+
+Run from the src folder with `python3 -m benchmarks`; see `--help` for the
+corpus sizes, repeat counts and baseline options.
+"""
+
+from __future__ import annotations
+
+from typing import Callable, Dict, Tuple
+from typing_extensions import TypedDict
+
+import gc
+import time
+import tracemalloc
+
+from .corpus import Corpus
+
+# A prepared benchmark run, which returns the number of items it processed.
+Runner = Callable[[], int]
+
+# Prepares a benchmark run for a corpus (untimed).
+Setup = Callable[[Corpus], Runner]
+
+BenchmarkResult = TypedDict(
+    "BenchmarkResult",
+    {
+        "name": str,
+        "size": int,
+        "seconds": float,
+        "items": int,
+        "throughput": float,
+        "peak_memory": int,
+    },
+)
+
+# All the registered benchmarks { name => setup }
+BENCHMARKS: Dict[str, Setup] = {}
+
+
+def benchmark(name: str) -> Callable[[Setup], Setup]:
+    """Registers a benchmark setup function under a name"""
+
+    def register(setup: Setup) -> Setup:
+        BENCHMARKS[name] = setup
+        return setup
+
+    return register
+
+
+def measure(run: Runner, repeat: int) -> Tuple[float, int, int]:
+    """
+    Times a benchmark run.
+
+    :return: The best time of `repeat` runs, the number of items processed,
+             and the peak traced memory of one further run.
+    """
+
+    best = float("inf")
+    items = 0
+
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        items = run()
+        best = min(best, time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return best, items, peak
+
+
+def run_benchmark(name: str, corpus: Corpus, repeat: int) -> BenchmarkResult:
+    """Sets up, and then measures, a registered benchmark"""
+
+    run = BENCHMARKS[name](corpus)
+    seconds, items, peak = measure(run, repeat)
+
+    return BenchmarkResult(
+        name=name,
+        size=len(corpus.empires),
+        seconds=seconds,
+        items=items,
+        throughput=items / seconds if seconds else 0.0,
+        peak_memory=peak,
+    )
+
+
+__all__ = ["BENCHMARKS", "BenchmarkResult", "Corpus", "benchmark", "run_benchmark"]
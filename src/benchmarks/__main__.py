@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: nospell ts=4 expandtab
+
+"""
+Runs the benchmarks against generated corpora.
+
+    python3 -m benchmarks --sizes 100,10000 --baseline bench-baseline.json
+
+Results are compared against the baseline file, if it exists, and any
+benchmark slower than the baseline by more than the threshold is reported
+as a regression (and the exit code is non-zero). Use --save to write the
+results as the new baseline.
+"""
+
+from __future__ import annotations
+
+from typing import Dict, List
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from . import BENCHMARKS, BenchmarkResult, Corpus, run_benchmark
+from . import accounts, hot_paths  # noqa: F401  (registers the benchmarks)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="benchmarks", description=__doc__)
+    parser.add_argument(
+        "--sizes",
+        default="100,10000",
+        help="comma separated corpus sizes, in empires (default: 100,10000)",
+    )
+    parser.add_argument(
+        "--only", action="append", default=[], help="run only the named benchmark(s)"
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark")
+    parser.add_argument(
+        "--baseline",
+        default="bench-baseline.json",
+        help="the stored baseline to compare against",
+    )
+    parser.add_argument(
+        "--save", action="store_true", help="store the results as the new baseline"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="fractional slow-down counted as a regression (default: 0.2)",
+    )
+    parser.add_argument("--list", action="store_true", help="list the benchmarks")
+
+    return parser.parse_args()
+
+
+def load_baseline(filename: str) -> Dict[str, BenchmarkResult]:
+    if not os.path.exists(filename):
+        return {}
+
+    with open(filename, "r", encoding="utf-8") as handle:
+        data: Dict[str, BenchmarkResult] = json.load(handle)
+
+    return data
+
+
+def result_key(result: BenchmarkResult) -> str:
+    return f"{result['name']}@{result['size']}"
+
+
+def report(result: BenchmarkResult, baseline: Dict[str, BenchmarkResult]) -> None:
+    """Prints a result line, with the change from the baseline"""
+
+    previous = baseline.get(result_key(result))
+    note = ""
+
+    if previous and previous["seconds"]:
+        note = f"{result['seconds'] / previous['seconds'] - 1:+7.1%}"
+
+    print(
+        f"{result['name']:32} {result['size']:>7} "
+        f"{result['seconds'] * 1000:10.2f} ms "
+        f"{result['throughput']:12.0f} /s "
+        f"{result['peak_memory'] / 1024 / 1024:9.2f} MiB  {note}"
+    )
+
+
+def run_size(
+    size: int, names: List[str], repeat: int, baseline: Dict[str, BenchmarkResult]
+) -> List[BenchmarkResult]:
+    """Generates a corpus of the given size, and runs the benchmarks on it"""
+
+    cwd = os.getcwd()
+    results: List[BenchmarkResult] = []
+
+    with tempfile.TemporaryDirectory(prefix="empire-bench-") as root:
+        os.chdir(root)
+
+        try:
+            start = time.perf_counter()
+            corpus = Corpus(root, size)
+            print(f"# {size} empires generated in {time.perf_counter() - start:.1f}s")
+
+            for name in names:
+                result = run_benchmark(name, corpus, repeat)
+                report(result, baseline)
+                results.append(result)
+        finally:
+            os.chdir(cwd)
+
+    return results
+
+
+def main() -> int:
+    args = parse_args()
+
+    if args.list:
+        print("\n".join(sorted(BENCHMARKS)))
+        return 0
+
+    names = args.only or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+
+    if unknown:
+        print(f"Unknown benchmark(s): {', '.join(unknown)}", file=sys.stderr)
+        return 2
+
+    baseline = load_baseline(args.baseline)
+    results: List[BenchmarkResult] = []
+
+    for size in [int(size) for size in args.sizes.split(",")]:
+        results.extend(run_size(size, names, args.repeat, baseline))
+
+    regressions = [
+        result_key(result)
+        for result in results
+        if result_key(result) in baseline
+        and result["seconds"]
+        > baseline[result_key(result)]["seconds"] * (1 + args.threshold)
+    ]
+
+    if args.save:
+        baseline.update({result_key(result): result for result in results})
+
+        with open(args.baseline, "w", encoding="utf-8") as handle:
+            json.dump(baseline, handle, indent=2, sort_keys=True)
+
+    if regressions:
+        print(f"Regressions: {', '.join(regressions)}")
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: nospell ts=4 expandtab
+
+"""
+Stress benchmark for concurrent registrations in the user store.
+"""
+
+from __future__ import annotations
+
+from typing import List
+
+import os
+import threading
+
+from users import UserStore
+
+from . import Corpus, Runner, benchmark
+
+# Number of threads registering users at once.
+THREADS = 16
+
+
+@benchmark("UserStore.register")
+def register_users(corpus: Corpus) -> Runner:
+    """
+    Has THREADS threads register every author in the corpus at once, with
+    different hashes, then checks that each author was written exactly once
+    and that every thread saw the same stored hash.
+    """
+
+    names = sorted({filename.split("/")[1] for filename in corpus.files})
+    filename = os.path.join(corpus.root, "users.txt")
+
+    def run() -> int:
+        if os.path.exists(filename):
+            os.unlink(filename)
+
+        store = UserStore(filename)
+        store.load()
+
+        barrier = threading.Barrier(THREADS)
+        seen: List[List[bytes]] = [[] for _ in range(THREADS)]
+
+        def register(index: int) -> None:
+            barrier.wait()
+
+            for name in names:
+                hashed = f"hash-{name}-{index}".encode("ascii")
+                seen[index].append(store.register(name.encode("ascii"), hashed))
+
+        threads = [threading.Thread(target=register, args=(i,)) for i in range(THREADS)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        check_registrations(filename, names, seen)
+
+        return len(names) * THREADS
+
+    return run
+
+
+def check_registrations(
+    filename: str, names: List[str], seen: List[List[bytes]]
+) -> None:
+    with open(filename, "rb") as handle:
+        lines = handle.read().splitlines()
+
+    stored = dict(line.split(b":", 1) for line in lines)
+
+    if len(lines) != len(names) or sorted(stored) != [n.encode() for n in names]:
+        raise RuntimeError(f"{len(lines)} users written for {len(names)} names")
+
+    if any(hashes != seen[0] for hashes in seen):
+        raise RuntimeError("Threads disagree on the stored hash for a user")
+
+    if [stored[name.encode()] for name in names] != seen[0]:
+        raise RuntimeError("Stored hashes do not match the registered ones")
@@ -0,0 +1,172 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: nospell ts=4 expandtab
+
+"""
+Generates synthetic empire corpora for the benchmarks.
+
+Corpora are generated from a fixed seed, so the same size always gives
+the same empires, files and authors.
+"""
+
+from __future__ import annotations
+
+from typing import List
+
+import io
+import os
+import random
+
+from clauswitz import ClausObject, write_claus_object
+
+import importer
+
+ETHICS = [
+    "ethic_authoritarian",
+    "ethic_egalitarian",
+    "ethic_materialist",
+    "ethic_militarist",
+    "ethic_pacifist",
+    "ethic_spiritualist",
+    "ethic_xenophile",
+    "ethic_xenophobe",
+]
+
+CIVICS = [
+    "civic_beacon_of_liberty",
+    "civic_idealistic_foundation",
+    "civic_meritocracy",
+    "civic_technocracy",
+    "civic_parliamentary_system",
+    "civic_police_state",
+    "civic_mining_guilds",
+    "civic_agrarian_idyll",
+]
+
+WORDS = (
+    "the a of and stars ancient empire people world drifting old sun trade "
+    "fleet peace war hive machine sea sky stone forest ice fire great small"
+).split()
+
+
+def words(rng: random.Random, count: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(count))
+
+
+def make_empire(rng: random.Random, index: int, author: str) -> ClausObject:
+    """Creates a valid, randomised, empire design"""
+
+    name = f"{words(rng, 2).title()} {index}"
+    ethics = rng.sample(ETHICS, 3)
+
+    return [
+        ("key", name),
+        ("name", name),
+        ("adjective", words(rng, 1).title()),
+        ("authority", "auth_democratic"),
+        ("civics", rng.sample(CIVICS, 2)),
+        ("ethic", ethics[0]),
+        ("ethic", ethics[1]),
+        ("ethic", ethics[2]),
+        ("origin", "origin_default"),
+        ("initializer", f"custom_starting_init_{index % 7}"),
+        ("spawn_enabled", True),
+        ("spawn_as_fallen", False),
+        ("ignore_portrait_duplication", False),
+        ("author", author),
+        ("room", "personality_default"),
+        ("planet_name", words(rng, 1).title()),
+        ("planet_class", "pc_continental"),
+        ("system_name", words(rng, 1).title()),
+        (
+            "species",
+            [
+                ("class", "MAM"),
+                ("portrait", f"mam{index % 9 + 1}"),
+                ("name", words(rng, 1).title()),
+                ("plural", words(rng, 1).title()),
+                ("adjective", words(rng, 1).title()),
+                ("name_list", "MAM1"),
+                ("trait", "trait_intelligent"),
+                ("trait", "trait_communal"),
+                ("species_bio", words(rng, rng.randint(10, 80))),
+            ],
+        ),
+        (
+            "ruler",
+            [
+                ("gender", rng.choice(["male", "female"])),
+                ("name", words(rng, 2).title()),
+                ("portrait", f"mam{index % 9 + 1}"),
+                ("texture", "0"),
+                ("hair", str(index % 12)),
+                ("clothes", str(index % 5)),
+                ("ruler_title", "title_president"),
+            ],
+        ),
+        (
+            "empire_flag",
+            [
+                ("icon", [("category", "ornate"), ("file", "flag_ornate_1.dds")]),
+                ("background", [("category", "backgrounds"), ("file", "00.dds")]),
+                ("colors", ["dark_blue", "black", "null", "null"]),
+            ],
+        ),
+    ]
+
+
+def make_designs(empires: List[ClausObject]) -> str:
+    """Writes empires as the game would in user_empire_designs.txt"""
+
+    output = io.StringIO()
+
+    for empire in empires:
+        output.write(f'"{importer.get_value(empire, "key")}"={{\n')
+        write_claus_object(empire, output, 1)
+        output.write("}\n")
+
+    return output.getvalue()
+
+
+class Corpus:
+    """A set of generated empires, as both a design file and source folders"""
+
+    # The folder the corpus was written to.
+    root: str
+
+    # The generated empires.
+    empires: List[ClausObject]
+
+    # The empires as the contents of a user_empire_designs.txt.
+    designs: str
+
+    # The paths of the stored empire files, relative to the root.
+    files: List[str]
+
+    # The source folders that were written.
+    sources: List[str]
+
+    def __init__(self: Corpus, root: str, size: int, seed: int = 7) -> None:
+        rng = random.Random(seed + size)
+        authors = [f"author{i:04d}" for i in range(max(5, size // 25))]
+
+        self.root = root
+        self.empires = []
+        self.files = []
+        self.sources = ["approved", "historical"]
+
+        for index in range(size):
+            author = rng.choice(authors)
+            self.empires.append(make_empire(rng, index, author))
+
+        self.designs = make_designs(self.empires)
+
+        for index, empire in enumerate(self.empires):
+            # Put roughly a fifth of the empires in the second source.
+            source = self.sources[1] if index % 5 == 4 else self.sources[0]
+            folder = f"{source}/{importer.get_value(empire, 'author')}"
+
+            os.makedirs(os.path.join(root, folder), exist_ok=True)
+            importer.store(empire, os.path.join(root, folder))
+
+            self.files.append(f"{folder}/{importer.get_value(empire, 'key')}.txt")
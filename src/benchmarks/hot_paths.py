@@ -0,0 +1,233 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: nospell ts=4 expandtab
+
+"""
+Benchmarks of the upload (parse, validate, store) and download (select,
+build mod pack) paths.
+"""
+
+from __future__ import annotations
+
+from typing import List
+
+import io
+import random
+
+import catalogue
+import clauswitz
+import importer
+
+from catalogue import CATALOGUE
+from clauswitz.parser import write_bytes
+from handlers.download_modpack import (
+    add_empire_to_modpack,
+    author_balanced_empires,
+    select_empires,
+)
+
+from . import Corpus, Runner, benchmark
+
+# Number of empires selected for the download benchmarks (the page's maximum).
+SELECT_COUNT = 80
+
+# Number of files, independent of the corpus size, for the large selection
+# benchmark, and the fraction of them that are selected.
+LARGE_SELECTION = 100_000
+LARGE_SELECTION_FRACTION = 0.95
+
+# Keys looked up for each empire, as in is_valid_empire and the listings.
+LOOKUP_KEYS = [
+    "key",
+    "origin",
+    "empire_flag",
+    "ruler",
+    "civics",
+    "spawn_enabled",
+    "spawn_as_fallen",
+    "ethic",
+    "author",
+    "species",
+]
+
+
+def warm_catalogue(corpus: Corpus) -> None:
+    """Indexes the corpus, and stops the catalogue re-scanning mid-benchmark"""
+
+    catalogue.REFRESH_INTERVAL = float("inf")
+    CATALOGUE.clear()
+    CATALOGUE.get(corpus.sources)
+
+
+@benchmark("importer.parse_user_empires")
+def parse_user_empires(corpus: Corpus) -> Runner:
+    def run() -> int:
+        return len(importer.parse_user_empires(corpus.designs))
+
+    return run
+
+
+def read_files(corpus: Corpus) -> List[bytes]:
+    contents: List[bytes] = []
+
+    for filename in corpus.files:
+        with open(filename, "rb") as handle:
+            contents.append(handle.read())
+
+    return contents
+
+
+@benchmark("parser.parse")
+def parse_files(corpus: Corpus) -> Runner:
+    contents = read_files(corpus)
+
+    def run() -> int:
+        for data in contents:
+            clauswitz.parse_data(io.BytesIO(data))
+
+        return len(contents)
+
+    return run
+
+
+@benchmark("parser.extract")
+def extract_files(corpus: Corpus) -> Runner:
+    """As parser.parse, but reading only what the catalogue needs"""
+
+    contents = read_files(corpus)
+
+    def run() -> int:
+        for data in contents:
+            clauswitz.extract(io.BytesIO(data), catalogue.EMPIRE_PATHS)
+
+        return len(contents)
+
+    return run
+
+
+@benchmark("parser.write")
+def write_empires(corpus: Corpus) -> Runner:
+    def run() -> int:
+        output = io.StringIO()
+
+        for empire in corpus.empires:
+            clauswitz.write_claus_object(empire, output, 1)
+
+        return len(corpus.empires)
+
+    return run
+
+
+@benchmark("parser.write_bytes")
+def write_empires_bytes(corpus: Corpus) -> Runner:
+    """As parser.write, but UTF-8 encoded, as importer.store writes files"""
+
+    def run() -> int:
+        output = io.BytesIO()
+
+        for empire in corpus.empires:
+            write_bytes(empire, output, 1)
+
+        return len(corpus.empires)
+
+    return run
+
+
+@benchmark("importer.get_values")
+def get_values(corpus: Corpus) -> Runner:
+    def run() -> int:
+        for empire in corpus.empires:
+            for key in LOOKUP_KEYS:
+                importer.get_values(empire, key)
+
+        return len(corpus.empires) * len(LOOKUP_KEYS)
+
+    return run
+
+
+@benchmark("importer.is_valid_empire")
+def validate_parsed(corpus: Corpus) -> Runner:
+    """Validates and reads the listing fields of parsed (not generated) empires"""
+
+    empires = [
+        item[1]
+        for item in importer.parse_user_empires(corpus.designs)
+        if isinstance(item, tuple) and isinstance(item[1], list)
+    ]
+
+    def run() -> int:
+        for empire in empires:
+            importer.is_valid_empire(empire)
+
+            for key in LOOKUP_KEYS:
+                importer.get_values(empire, key)
+
+        return len(empires)
+
+    return run
+
+
+@benchmark("select_empires.random")
+def select_random(corpus: Corpus) -> Runner:
+    warm_catalogue(corpus)
+
+    def run() -> int:
+        return len(select_empires(SELECT_COUNT, corpus.sources, False))
+
+    return run
+
+
+@benchmark("select_empires.balanced")
+def select_balanced(corpus: Corpus) -> Runner:
+    warm_catalogue(corpus)
+
+    def run() -> int:
+        return len(select_empires(SELECT_COUNT, corpus.sources, True))
+
+    return run
+
+
+@benchmark("author_balanced_empires.100k")
+def select_balanced_large(corpus: Corpus) -> Runner:
+    """
+    Selects nearly all of a large, synthetic, list of files, where some
+    authors have far more empires than others and some names are shared.
+    """
+
+    rng = random.Random(LARGE_SELECTION)
+    sources = ["approved", "historical"]
+    files = [
+        f"{rng.choice(sources)}/author{int(rng.paretovariate(1.2)) % 5000:04d}"
+        f"/empire{rng.randrange(LARGE_SELECTION * 2)}.txt"
+        for _ in range(LARGE_SELECTION)
+    ]
+    count = int(len(files) * LARGE_SELECTION_FRACTION)
+
+    def run() -> int:
+        selected = author_balanced_empires(count, files, sources)
+        names = {filename.rsplit("/", 1)[1] for filename in selected}
+
+        if len(names) != len(selected):
+            raise AssertionError("Selected two empires with the same name")
+
+        return len(selected)
+
+    return run
+
+
+@benchmark("ModPack.write_to_zip")
+def build_modpack(corpus: Corpus) -> Runner:
+    warm_catalogue(corpus)
+    entries = CATALOGUE.get(corpus.sources)[:SELECT_COUNT]
+
+    def run() -> int:
+        mod = clauswitz.ModPack("Random Empires Modpack", "random-empires", "1.0")
+
+        for entry in entries:
+            add_empire_to_modpack(mod, entry)
+
+        mod.write_to_zip(io.BytesIO())
+
+        return len(entries)
+
+    return run
@@ -0,0 +1,496 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: nospell ts=4 expandtab
+
+"""
+In-memory index of the empires available in each source folder.
+
+Empire files live at `<source>/<author>/<key>.txt`. Rather than globbing
+and parsing every one of them on each request, the catalogue keeps the
+metadata the site needs for each file, along with the size and mtime it
+was read at, so that only new or changed files need to be parsed again.
+
+Each entry also records whether the empire is valid, and the SHA-256 of
+the file, which are worked out when it is indexed (normally when it is
+uploaded or moved between sources by moderation.py).
+
+Once attached to a Watcher, the sources are not re-scanned at all: the
+watcher reports which files were added, modified or deleted, and only those
+entries are updated.
+"""
+
+from __future__ import annotations
+
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from typing_extensions import TypedDict
+
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+
+import clauswitz
+import importer
+from metrics import METRICS
+from watcher import DELETED, EntryKey, Watcher, WatchEvent, scan_source
+
+EmpireData = TypedDict(
+    "EmpireData", {"author": str, "name": str, "ethics": List[str], "bio": str}
+)
+
+CatalogueEntry = TypedDict(
+    "CatalogueEntry",
+    {
+        "source": str,
+        "author": str,
+        "key": str,
+        "path": str,
+        "mtime": float,
+        "size": int,
+        "sha256": str,
+        "valid": bool,
+        "empire": EmpireData,
+    },
+)
+
+# The folders empires are kept in, by moderation state.
+SOURCES = ("approved", "pending", "historical")
+
+# The parts of an empire file needed to list it, and to check it is valid.
+# Validity only needs the objects to be there, not their contents.
+EMPIRE_PATHS = [
+    "*/key",
+    "*/author",
+    "*/ethic",
+    "*/species/species_bio",
+    "*/origin",
+    "*/spawn_enabled",
+    "*/spawn_as_fallen",
+    "*/empire_flag/",
+    "*/ruler/",
+    "*/civics/",
+]
+
+# The minimum time, in seconds, between two scans of the same source.
+REFRESH_INTERVAL = 5.0
+
+
+def read_empire(filename: str) -> Tuple[EmpireData, bool, str]:
+    """
+    Reads an on-disk empire file.
+
+    :return: The listing metadata, whether the empire is valid, and the
+             SHA-256 of the file.
+    """
+
+    with open(filename, "rb") as handle:
+        data = handle.read()
+
+    obj = clauswitz.extract(io.BytesIO(data), EMPIRE_PATHS)
+
+    # Extract the empire data out of the wrapper object.
+    if isinstance(obj, list) and len(obj) == 1:
+        if isinstance(obj[0], tuple):
+            obj = obj[0][1]
+
+    # Get the fields we want in the fragment.
+    name = str(importer.get_value(obj, "key"))
+    author = str(importer.get_value(obj, "author"))
+    ethics = importer.get_values(obj, "ethic")
+
+    bio = ""
+    species = importer.get_value(obj, "species")
+    if isinstance(species, list):
+        bio = str(importer.get_value(species, "species_bio") or "")
+
+    # Make the ethics presentable.
+    ethics_out = [
+        str(ethic).replace("ethic_", "").replace("_", " ") for ethic in ethics
+    ]
+
+    empire = EmpireData(author=author, name=name, ethics=ethics_out, bio=bio)
+    valid = isinstance(obj, list) and importer.is_valid_empire(obj)
+
+    return empire, valid, hashlib.sha256(data).hexdigest()
+
+
+def index_empire(key: EntryKey, stat: os.stat_result) -> Optional[CatalogueEntry]:
+    """
+    Parses an empire file into a catalogue entry.
+
+    :return: The entry, or None if the file could not be parsed.
+    """
+
+    source, author, name = key
+    path = f"{source}/{author}/{name}.txt"
+
+    try:
+        with METRICS.timer("parse_catalogue"):
+            empire, valid, digest = read_empire(path)
+    except Exception as ex:
+        print(f"Unable to index {path}: {ex}")
+        return None
+
+    return CatalogueEntry(
+        source=source,
+        author=author,
+        key=name,
+        path=path,
+        mtime=stat.st_mtime,
+        size=stat.st_size,
+        sha256=digest,
+        valid=valid,
+        empire=empire,
+    )
+
+
+def is_valid_source(source: str) -> bool:
+    """Checks a source is one of the empire folders"""
+
+    return source in SOURCES
+
+
+class Catalogue:
+    """
+    Index of empire metadata, keyed by (source, author, key).
+
+    Each source is re-scanned (with stat calls only) when it is read, at
+    most once every REFRESH_INTERVAL seconds, unless a watcher is attached.
+    Only files whose size or mtime have changed are parsed again.
+    """
+
+    # Where the catalogue is persisted between runs.
+    filename: Optional[str]
+
+    # The indexed empires.
+    entries: Dict[EntryKey, CatalogueEntry]
+
+    # When each source was last scanned (monotonic clock).
+    scanned: Dict[str, float]
+
+    # Counter per source, incremented whenever its content changes.
+    generations: Dict[str, int]
+
+    # Files which could not be parsed { path => (mtime, size) }
+    failed: Dict[str, Tuple[float, int]]
+
+    # Reports changes to the sources, instead of them being re-scanned.
+    watcher: Optional[Watcher]
+
+    # Guards the catalogue's state. It is not held while files are scanned,
+    # parsed or saved, so that readers are never kept waiting for the disk.
+    lock: threading.RLock
+
+    # Serialises saving, so that the newest snapshot is written last.
+    save_lock: threading.Lock
+
+    def __init__(self: Catalogue) -> None:
+        self.filename = None
+        self.watcher = None
+        self.entries = {}
+        self.scanned = {}
+        self.generations = {}
+        self.failed = {}
+        self.lock = threading.RLock()
+        self.save_lock = threading.Lock()
+
+    def clear(self: Catalogue) -> None:
+        """Forgets everything in the catalogue"""
+
+        with self.lock:
+            self.entries.clear()
+            self.scanned.clear()
+            self.generations.clear()
+            self.failed.clear()
+
+    def attach(self: Catalogue, watcher: Watcher) -> None:
+        """
+        Keeps the catalogue up to date from a watcher's events.
+
+        Each source is scanned once, when first used, and from then on only
+        the files the watcher reports as changed are looked at again.
+        """
+
+        with self.lock:
+            self.watcher = watcher
+            self.scanned.clear()
+
+        watcher.listeners.append(self.apply)
+
+    def load(self: Catalogue, filename: str) -> None:
+        """
+        Loads a previously saved catalogue, and sets the file to save to.
+
+        The loaded entries are still checked against the disk on first use,
+        so a stale or missing file only costs a re-parse.
+        """
+
+        self.filename = filename
+
+        if not os.path.exists(filename):
+            return
+
+        try:
+            with open(filename, "r", encoding="utf-8") as handle:
+                data: List[CatalogueEntry] = json.load(handle)
+        except (OSError, ValueError) as ex:
+            print(f"Unable to load catalogue {filename}: {ex}")
+            return
+
+        with self.lock:
+            for entry in data:
+                # Entries from before hashes were recorded are re-indexed.
+                if "sha256" not in entry or not is_valid_source(entry["source"]):
+                    continue
+
+                key = (entry["source"], entry["author"], entry["key"])
+                self.entries[key] = entry
+
+    def save(self: Catalogue) -> None:
+        """Writes the catalogue to disk, if it has a file set"""
+
+        if not self.filename:
+            return
+
+        with self.save_lock:
+            # Entries are replaced rather than modified, so a copy of the
+            # list can be written out without holding the lock.
+            with self.lock:
+                data = list(self.entries.values())
+
+            data.sort(key=lambda entry: entry["path"])
+
+            # The moderation tool and the server may save at the same time,
+            # so each process writes its own temporary file (saves within a
+            # process are serialised by the save lock).
+            temp = f"{self.filename}.{os.getpid()}.tmp"
+
+            try:
+                with open(temp, "w", encoding="utf-8") as handle:
+                    json.dump(data, handle)
+            except BaseException:
+                if os.path.exists(temp):
+                    os.unlink(temp)
+                raise
+
+            os.replace(temp, self.filename)
+
+    def get(self: Catalogue, sources: Iterable[str]) -> List[CatalogueEntry]:
+        """Gets all the empires in the given sources, sorted by path"""
+
+        valid = [source for source in sources if self.refresh(source)]
+
+        with self.lock:
+            output = [
+                entry for entry in self.entries.values() if entry["source"] in valid
+            ]
+
+        return sorted(output, key=lambda entry: entry["path"])
+
+    def generation(self: Catalogue, source: str) -> int:
+        """Gets a counter which changes whenever a source's contents change"""
+
+        self.refresh(source)
+
+        with self.lock:
+            return self.generations.get(source, 0)
+
+    def refresh(self: Catalogue, source: str, force: bool = False) -> bool:
+        """
+        Brings the catalogue for a source up to date with the disk.
+
+        :return: Whether the source is valid.
+        """
+
+        if not is_valid_source(source):
+            return False
+
+        with self.lock:
+            now = time.monotonic()
+            last = self.scanned.get(source)
+
+            if not force and last is not None:
+                if self.watcher or now - last < REFRESH_INTERVAL:
+                    return True
+
+            # Marked first, so that other requests use the current entries
+            # rather than scanning the source again at the same time.
+            self.scanned[source] = now
+            watcher = self.watcher
+
+        if watcher and last is None:
+            found = watcher.watch(source)
+        else:
+            found = scan_source(source)
+
+        if self.update(source, found):
+            self.save()
+
+        return True
+
+    def update(
+        self: Catalogue, source: str, found: Dict[EntryKey, os.stat_result]
+    ) -> bool:
+        """
+        Updates the catalogue from a scan of a source folder.
+
+        :return: Whether anything changed.
+        """
+
+        # Remove anything that has been deleted.
+        with self.lock:
+            changes: Dict[EntryKey, Optional[os.stat_result]] = {
+                key: None
+                for key in self.entries
+                if key[0] == source and key not in found
+            }
+
+        # Add or update everything that is new or modified.
+        changes.update(found)
+
+        return bool(self.apply_changes(changes))
+
+    def apply(self: Catalogue, events: List[WatchEvent]) -> None:
+        """Updates the catalogue from a batch of the watcher's events"""
+
+        # The last event for each file decides what happens to it.
+        changes: Dict[EntryKey, Optional[os.stat_result]] = {}
+
+        with self.lock:
+            for kind, key, stat in events:
+                # Sources are only indexed once they have been used.
+                if key[0] in self.scanned:
+                    changes[key] = None if kind == DELETED else stat
+
+        if self.apply_changes(changes):
+            self.save()
+
+    def apply_changes(
+        self: Catalogue, changes: Dict[EntryKey, Optional[os.stat_result]]
+    ) -> Set[str]:
+        """
+        Removes (for None) or re-indexes empires, parsing any new or modified
+        files without holding the lock.
+
+        :return: The sources which changed.
+        """
+
+        with self.lock:
+            removed = {
+                key: self.entries[key]
+                for key, stat in changes.items()
+                if stat is None and key in self.entries
+            }
+            stale = [
+                (key, stat)
+                for key, stat in changes.items()
+                if stat is not None and self.is_stale(key, stat)
+            ]
+
+        indexed = [(key, stat, index_empire(key, stat)) for key, stat in stale]
+        changed: Set[str] = set()
+
+        with self.lock:
+            for key, entry in removed.items():
+                # Unless it was re-added while the lock was released.
+                if self.entries.get(key) is entry:
+                    del self.entries[key]
+                    changed.add(key[0])
+
+            for key, stat, new_entry in indexed:
+                if self.store(key, stat, new_entry):
+                    changed.add(key[0])
+
+            for source in changed:
+                self.generations[source] = self.generations.get(source, 0) + 1
+
+        return changed
+
+    def is_stale(self: Catalogue, key: EntryKey, stat: os.stat_result) -> bool:
+        """
+        Checks if an empire file needs to be parsed: it has not been indexed
+        (or failed to parse) since it was modified. The lock must be held.
+        """
+
+        entry = self.entries.get(key)
+
+        if entry and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+            return False
+
+        source, author, name = key
+        path = f"{source}/{author}/{name}.txt"
+
+        return self.failed.get(path) != (stat.st_mtime, stat.st_size)
+
+    def store(
+        self: Catalogue,
+        key: EntryKey,
+        stat: os.stat_result,
+        entry: Optional[CatalogueEntry],
+    ) -> bool:
+        """
+        Stores a parsed empire (from index_empire), or records that it could
+        not be parsed. The lock must be held.
+
+        :return: Whether the catalogue changed.
+        """
+
+        existing = self.entries.get(key)
+
+        # A newer version was indexed while this one was being parsed.
+        if existing and existing["mtime"] > stat.st_mtime:
+            return False
+
+        source, author, name = key
+        path = f"{source}/{author}/{name}.txt"
+
+        if entry is None:
+            self.failed[path] = (stat.st_mtime, stat.st_size)
+            self.entries.pop(key, None)
+        else:
+            self.failed.pop(path, None)
+            self.entries[key] = entry
+
+        return True
+
+    def move(self: Catalogue, key: EntryKey, destination: str) -> CatalogueEntry:
+        """
+        Moves an empire file to another source, keeping its catalogue entry.
+
+        The file is linked into place and then unlinked from the old source,
+        so it is never missing, and an existing file is never overwritten.
+
+        :raises FileExistsError: If the destination already has the file.
+        :raises KeyError: If the empire is not in the catalogue.
+        """
+
+        source, author, name = key
+
+        self.refresh(source, force=True)
+
+        with self.lock:
+            entry = self.entries[key]
+            path = f"{destination}/{author}/{name}.txt"
+
+            os.makedirs(f"{destination}/{author}", exist_ok=True)
+            os.link(entry["path"], path)
+            os.unlink(entry["path"])
+
+            del self.entries[key]
+
+            moved = entry.copy()
+            moved["source"] = destination
+            moved["path"] = path
+            self.entries[(destination, author, name)] = moved
+
+            for changed in [source, destination]:
+                self.generations[changed] = self.generations.get(changed, 0) + 1
+
+        self.save()
+
+        return moved
+
+
+CATALOGUE = Catalogue()
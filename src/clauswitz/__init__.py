@@ -8,10 +8,19 @@ Tools for dealing with the Clauswitz engine.
 
 from __future__ import annotations
 
-from .parser import ClausDatum, ClausObject
+from .parser import ClausDatum, ClausNode, ClausObject
 from .parser import write as write_claus_object
 from .parser import parse as parse_data
+from .extract import extract
 
 from .mod import ModPack
 
-__all__ = ["ClausDatum", "ClausObject", "write_claus_object", "parse_data", "ModPack"]
+__all__ = [
+    "ClausDatum",
+    "ClausNode",
+    "ClausObject",
+    "write_claus_object",
+    "parse_data",
+    "extract",
+    "ModPack",
+]
@@ -0,0 +1,345 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: nospell ts=4 expandtab
+
+"""
+Selective parsing of Clauswitz files, for when only a few keys are needed.
+
+extract() reads the same token stream as parse(), but only builds the
+objects on the way to the requested keys, and the requested items
+themselves. Every other block is skipped by counting braces, without
+allocating anything for it.
+"""
+
+from __future__ import annotations
+
+from typing import IO, Any, Dict, List, Optional, Tuple, Union
+
+import functools
+import sys
+
+from .parser import ClausNode, ClausObject, Token, build, convert, read_tokens, unquote
+
+# A tree of the requested paths { key => Trie }, where the key "*" matches
+# any key, END holds the path that ends at that point (if any), and EMPTY
+# is set if the path asks for the object there without its contents.
+Trie = Dict[str, Any]
+
+END = "\0"
+EMPTY = "\1"
+
+OPERATORS = ("{", "}", "=")
+
+
+class State:
+    """
+    Where a path of keys has got to in the trie of requested paths.
+
+    States are built once for a set of paths, with the state reached by
+    each possible key worked out in advance, so matching a key is a single
+    dict lookup.
+    """
+
+    __slots__ = ("ends", "empty", "descends", "transitions", "other")
+
+    # The requested paths that end at this point.
+    ends: List[str]
+
+    # Whether an object here is wanted without its contents.
+    empty: bool
+
+    # Whether any requested paths continue past this point.
+    descends: bool
+
+    # The state reached by each key named in a path { key => state }
+    transitions: Dict[str, Optional[State]]
+
+    # The state reached by any other key (through "*").
+    other: Optional[State]
+
+    def __init__(self: State, nodes: List[Trie]) -> None:
+        keys = {key for node in nodes for key in node if key not in (END, EMPTY, "*")}
+
+        self.ends = [node[END] for node in nodes if END in node]
+        self.empty = any(EMPTY in node for node in nodes)
+        self.transitions = {key: next_state(nodes, key) for key in keys}
+        self.other = next_state(nodes, "*")
+        self.descends = bool(keys) or self.other is not None
+
+    def step(self: State, key: str) -> Optional[State]:
+        return self.transitions.get(key, self.other)
+
+
+def next_state(nodes: List[Trie], key: str) -> Optional[State]:
+    """The state reached from a set of trie nodes by a key"""
+
+    children = [node[name] for node in nodes for name in {key, "*"} if name in node]
+
+    return State(children) if children else None
+
+
+@functools.lru_cache(maxsize=32)
+def compile_paths(paths: Tuple[str, ...]) -> State:
+    """Builds the states for a set of paths"""
+
+    root: Trie = {}
+
+    for path in paths:
+        node = root
+
+        keys = path.split("/")
+
+        for key in keys[:-1] if keys[-1] == "" else keys:
+            node = node.setdefault(key, {})
+
+        node[END] = path
+
+        if keys[-1] == "":
+            node[EMPTY] = True
+
+    return State([root])
+
+
+def extract(handle: Union[IO[bytes], IO[str]], paths: List[str]) -> ClausObject:
+    """
+    Parses only the requested keys from a Clauswitz file.
+
+    Each path is a "/"-separated list of keys, where "*" matches any key,
+    such as "*/species/species_bio". The output has the same shape as
+    parse() would give, but only holds the items at those paths (in full,
+    if they are objects), and the objects that contain them. A path ending
+    in "/" gets the object at that path, but none of its contents; which is
+    enough to check it is there.
+
+    Reading stops once every path has been found, and the objects they
+    were found in have been closed; so a wildcard only finds the items in
+    the first object it matches that has them.
+    """
+
+    extractor = Extractor(compile_paths(tuple(paths)), len(paths))
+
+    for tokens in read_tokens(handle):
+        if extractor.read(tokens):
+            return extractor.output
+
+    extractor.flush()
+
+    return extractor.output
+
+
+class Extractor:
+    """The state of an extract(): the open objects, and where they are"""
+
+    output: ClausObject
+
+    # The open objects, with the state their items are matched from.
+    stack: List[Tuple[ClausObject, State]]
+
+    # The depth of braces in the block being skipped (if any).
+    skip: int
+
+    # The key and tokens of a skipped block that is being kept in full.
+    capture: Optional[List[Token]]
+    capture_key: str
+
+    # The previous token, if it is a value that may turn out to be a key.
+    pending: Optional[Token]
+
+    # Whether the pending token has been followed by an equals sign.
+    assign: bool
+
+    # The number of paths requested.
+    wanted: int
+
+    # The depth of the object each path was first found in.
+    found: Dict[str, int]
+
+    def __init__(self: Extractor, state: State, wanted: int) -> None:
+        self.output = ClausNode()
+        self.stack = [(self.output, state)]
+        self.skip = 0
+        self.capture = None
+        self.capture_key = ""
+        self.pending = None
+        self.assign = False
+        self.wanted = wanted
+        self.found = {}
+
+    def read(self: Extractor, tokens: List[Token]) -> bool:
+        """Handles a list of tokens, returning whether extraction is done"""
+
+        index = 0
+        count = len(tokens)
+
+        while index < count:
+            if self.skip:
+                index = self.skip_block(tokens, index)
+                continue
+
+            # Whole `key=value` items are matched in one step.
+            if (
+                not self.assign
+                and index + 2 < count
+                and tokens[index + 1] == "="
+                and tokens[index] not in OPERATORS
+                and tokens[index + 2] not in OPERATORS
+            ):
+                # A bare token before the key can only be a value, which
+                # is not kept in a partial object.
+                self.pending = None
+                key = tokens[index]
+                state = self.stack[-1][1]
+
+                if state.other or key in state.transitions or key[0] == '"':
+                    self.add(key, tokens[index + 2])
+
+                index += 3
+                continue
+
+            if self.feed(tokens[index]):
+                return True
+
+            index += 1
+
+        return False
+
+    def skip_block(self: Extractor, tokens: List[Token], index: int) -> int:
+        """
+        Skips (or captures) the tokens of the current block.
+
+        :return: The index after the end of the block, or of the tokens.
+        """
+
+        count = len(tokens)
+
+        while index < count:
+            try:
+                end = tokens.index("}", index)
+            except ValueError:
+                end = count
+
+            segment = tokens[index:end]
+            self.skip += segment.count("{")
+
+            if self.capture is not None:
+                self.capture.extend(segment)
+
+            if end == count:
+                return count
+
+            self.skip -= 1
+
+            if not self.skip:
+                self.end_skip()
+                return end + 1
+
+            if self.capture is not None:
+                self.capture.append("}")
+
+            index = end + 1
+
+        return count
+
+    def feed(self: Extractor, token: Token) -> bool:
+        """Handles a token outside a skipped block"""
+
+        if token == "{":
+            self.open()
+        elif token == "}":
+            return self.close()
+        elif token == "=":
+            self.assign = self.pending is not None
+        elif self.assign and self.pending:
+            self.add(self.pending, token)
+            self.pending = None
+            self.assign = False
+        else:
+            self.flush()
+            self.pending = token
+
+        return False
+
+    def match(self: Extractor, key: str) -> Optional[State]:
+        """
+        Matches the key of an item in the current object against the paths.
+
+        :return: The state reached by the key, if any paths reach it.
+        """
+
+        state = self.stack[-1][1].step(key)
+
+        if state and state.ends:
+            for path in state.ends:
+                self.found.setdefault(path, len(self.stack))
+
+        return state
+
+    def add(self: Extractor, key: Token, value: Optional[Token]) -> None:
+        """Adds a `key=value` item, if a path ends at it"""
+
+        name = unquote(key)
+        state = self.match(name)
+
+        if state and state.ends:
+            converted = convert(value) if value else ""
+            self.stack[-1][0].append((sys.intern(name), converted))
+
+    def flush(self: Extractor) -> None:
+        """Adds the pending key, if it was followed by an equals but no value"""
+
+        if self.assign and self.pending:
+            self.add(self.pending, None)
+
+        self.pending = None
+        self.assign = False
+
+    def open(self: Extractor) -> None:
+        """Opens a block, keeping it in full or in part, or skipping it"""
+
+        pending = self.pending
+        self.pending = None
+        self.assign = False
+
+        # Anonymous blocks are never part of the output.
+        if not pending:
+            self.skip = 1
+            return
+
+        name = sys.intern(unquote(pending))
+        state = self.match(name)
+
+        if not state:
+            self.skip = 1
+        elif state.ends and not state.empty:
+            self.skip = 1
+            self.capture = []
+            self.capture_key = name
+        elif state.descends:
+            child: ClausObject = ClausNode()
+            self.stack[-1][0].append((name, child))
+            self.stack.append((child, state))
+        else:
+            self.skip = 1
+            self.stack[-1][0].append((name, ClausNode()))
+
+    def end_skip(self: Extractor) -> None:
+        """Adds the block that was just skipped, if it is being kept"""
+
+        if self.capture is not None:
+            child = build([self.capture])
+            self.stack[-1][0].append((self.capture_key, child))
+            self.capture = None
+
+    def close(self: Extractor) -> bool:
+        """Closes the current object, returning whether extraction is done"""
+
+        self.flush()
+        self.stack.pop()
+
+        if not self.stack:
+            return True
+
+        if len(self.found) < self.wanted:
+            return False
+
+        return all(depth > len(self.stack) for depth in self.found.values())
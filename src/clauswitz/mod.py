@@ -8,15 +8,26 @@ Selection of functions to generate a mod from a user_empire_designs.txt file
 
 from __future__ import annotations
 
-from typing import Dict, Set, Union
-from io import BytesIO, StringIO
+from typing import IO, Dict, List, Set, Union
+from io import BytesIO, RawIOBase
 
+import codecs
+import hashlib
 import os
 import shutil
 import zipfile
 
 from clauswitz import parser
 
+# Size of the chunks that on-disk files are copied in.
+COPY_CHUNK_SIZE = 64 * 1024
+
+# The modification time given to every file in a mod zip.
+ZIP_TIMESTAMP = (1980, 1, 1, 0, 0, 0)
+
+# How files are compressed in mod zips.
+ZIP_COMPRESSION = zipfile.ZIP_DEFLATED
+
 
 def normalise_path(file_name: str) -> str:
     """
@@ -41,6 +52,38 @@ def normalise_path(file_name: str) -> str:
     return file_path
 
 
+def zip_entry(path: str) -> zipfile.ZipInfo:
+    """
+    Creates the header for a file in a mod zip.
+
+    All entries get the same timestamp and permissions, so that building the
+    same mod pack twice gives byte-identical zips.
+
+    :param path: The path of the file in the zip.
+    """
+
+    info = zipfile.ZipInfo(path, date_time=ZIP_TIMESTAMP)
+    info.external_attr = 0o644 << 16
+    info.compress_type = ZIP_COMPRESSION
+
+    return info
+
+
+def copy_segments(sources: List[str], destination: IO[bytes]) -> None:
+    """
+    Copies a list of on-disk files, in order, into a destination stream.
+
+    Each file is streamed in chunks, so only one chunk is in memory at once.
+
+    :param sources:     The files to copy.
+    :param destination: The stream to copy them to.
+    """
+
+    for source in sources:
+        with open(source, "rb") as segment:
+            shutil.copyfileobj(segment, destination, COPY_CHUNK_SIZE)
+
+
 class ModPack:
     """
     Describes and builds a ModPack.
@@ -68,6 +111,10 @@ class ModPack:
     # { dest_filename => buffer }
     files_to_write: Dict[str, BytesIO]
 
+    # List of files to build by concatenating existing files
+    # { dest_filename => [source filenames] }
+    files_to_concat: Dict[str, List[str]]
+
     def __init__(self: ModPack, name: str, short_name: str, version: str):
         self.name = name
         self.short_name = short_name
@@ -78,6 +125,7 @@ class ModPack:
 
         self.files_to_add = dict()
         self.files_to_write = dict()
+        self.files_to_concat = dict()
 
     def add_dependency(self: ModPack, dependency: str) -> None:
         """
@@ -131,7 +179,11 @@ class ModPack:
 
         path = normalise_path(file_name)
 
-        return path in self.files_to_add or path in self.files_to_write
+        return (
+            path in self.files_to_add
+            or path in self.files_to_write
+            or path in self.files_to_concat
+        )
 
     def add_file(self: ModPack, destination_file: str, source_file: str) -> bool:
         """
@@ -169,6 +221,31 @@ class ModPack:
 
         return True
 
+    def add_file_segment(
+        self: ModPack, destination_file: str, source_file: str
+    ) -> None:
+        """
+        Appends a file, which currently exists on disk, to a file in the mod.
+
+        The destination file is built when the mod is, by concatenating each
+        of its segments in the order they were added. As with add_file, the
+        source file is not read until then.
+
+        This function will raise a FileExistsError if the destination has
+        already been added as a whole file or an in-memory file, and a
+        ValueError if the destination path is not a valid relative path.
+
+        :param destination_file: The location of the file in the mod pack.
+        :param source_file:      The location of the segment currently on disk.
+        """
+
+        path = normalise_path(destination_file)
+
+        if path in self.files_to_add or path in self.files_to_write:
+            raise FileExistsError(f"Can not append to {path}, as it has been added")
+
+        self.files_to_concat.setdefault(path, []).append(source_file)
+
     def get_file_writer(self: ModPack, destination_file: str) -> BytesIO:
         """
         Creates a in-memory File writer for a destination_file in the mod pack.
@@ -192,7 +269,7 @@ class ModPack:
 
         # If this file has already been added as a copy of and external file,
         # we can't also have it as an in-memory stream.
-        if path in self.files_to_add:
+        if path in self.files_to_add or path in self.files_to_concat:
             raise FileExistsError(f"Can not create file {path}, as it has been added")
 
         # If we don't already have a in-memory file with this name, create it.
@@ -202,27 +279,23 @@ class ModPack:
         # Return the stream
         return self.files_to_write[path]
 
-    def get_metadata(self: ModPack) -> StringIO:
+    def get_metadata(self: ModPack) -> bytes:
         """
         Gets the mod metadata, for writing to the .mod files.
 
-        :return: The mod's metadata.
+        :return: The mod's metadata, UTF-8 encoded.
         """
 
-        output = StringIO()
-        parser.write(
+        return parser.serialize(
             [
                 ("name", self.name),
                 ("version", self.version),
                 ("path", f"mod/{self.short_name}"),
                 ("supported_version", self.stellaris_versions),
-                ("dependencies", list(self.dependencies)),
-                ("tags", list(self.tags)),
-            ],
-            output,
-        )
-
-        return output
+                ("dependencies", sorted(self.dependencies)),
+                ("tags", sorted(self.tags)),
+            ]
+        ).encode("utf-8")
 
     def write_to_folder(self: ModPack, dest_folder: str) -> None:
         """
@@ -235,15 +308,10 @@ class ModPack:
         os.makedirs(mod_folder, exist_ok=True)
         metadata = self.get_metadata()
 
-        with open(mod_file, "w", encoding="utf-8") as mod_handle:
-            mod_handle.write("\ufeff")
-            shutil.copyfileobj(metadata, mod_handle)
-
-        with open(
-            os.path.join(mod_folder, "descriptor.mod"), "w", encoding="utf-8"
-        ) as mod_handle:
-            mod_handle.write("\ufeff")
-            shutil.copyfileobj(metadata, mod_handle)
+        # The metadata files start with a UTF-8 byte order mark.
+        for path in [mod_file, os.path.join(mod_folder, "descriptor.mod")]:
+            with open(path, "wb") as mod_handle:
+                mod_handle.write(codecs.BOM_UTF8 + metadata)
 
         for (file_name, source) in self.files_to_add.items():
             dest = os.path.join(mod_folder, file_name)
@@ -261,25 +329,93 @@ class ModPack:
             if not os.path.exists(dest_dir):
                 os.makedirs(dest_dir, exist_ok=True)
 
-            with open(dest, "wb", encoding="utf-8") as dest_handle:
+            with open(dest, "wb") as dest_handle:
                 dest_handle.write(content.getvalue())
 
-    def write_to_zip(self: ModPack, destination: Union[BytesIO, str]) -> None:
+        for (file_name, sources) in self.files_to_concat.items():
+            dest = os.path.join(mod_folder, file_name)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+
+            with open(dest, "wb") as dest_handle:
+                copy_segments(sources, dest_handle)
+
+    def write_to_zip(
+        self: ModPack, destination: Union[IO[bytes], RawIOBase, str]
+    ) -> None:
         """
         Writes the mod folder and description file to a zip file in destination.
+
+        The destination can be a non-seekable stream (e.g. a socket), in which
+        case each entry is sent as soon as it has been written, and on-disk
+        files are read in chunks rather than being loaded into memory.
+
+        Entries are written in sorted order with fixed timestamps, so the same
+        mod pack always gives the same zip.
         """
 
         with zipfile.ZipFile(destination, "w") as zip_file:
             zip_file.comment = f"{self.name} v{self.version}".encode("utf-8")
 
-            metadata = self.get_metadata().getvalue()
-            zip_file.writestr(f"{self.short_name}.mod", metadata)
-            zip_file.writestr(os.path.join(self.short_name, "descriptor.mod"), metadata)
+            metadata = self.get_metadata()
 
-            for (file_name, source) in self.files_to_add.items():
-                path = os.path.join(self.short_name, file_name)
-                zip_file.write(source, path)
+            with zip_file.open(zip_entry(f"{self.short_name}.mod"), "w") as entry:
+                entry.write(metadata)
 
-            for (file_name, contents) in self.files_to_write.items():
+            path = os.path.join(self.short_name, "descriptor.mod")
+            with zip_file.open(zip_entry(path), "w") as entry:
+                entry.write(metadata)
+
+            for file_name in sorted(self.file_list()):
                 path = os.path.join(self.short_name, file_name)
-                zip_file.writestr(path, contents.getvalue())
+
+                with zip_file.open(zip_entry(path), "w") as entry:
+                    self.write_file(file_name, entry)
+
+    def file_list(self: ModPack) -> List[str]:
+        """Lists the files in the mod pack (excluding the metadata)"""
+
+        return [*self.files_to_add, *self.files_to_write, *self.files_to_concat]
+
+    def write_file(self: ModPack, file_name: str, destination: IO[bytes]) -> None:
+        """Writes the contents of one of the mod's files to a stream"""
+
+        if file_name in self.files_to_add:
+            copy_segments([self.files_to_add[file_name]], destination)
+        elif file_name in self.files_to_write:
+            destination.write(self.files_to_write[file_name].getbuffer())
+        else:
+            copy_segments(self.files_to_concat[file_name], destination)
+
+    def fingerprint(self: ModPack) -> str:
+        """
+        Gets a hash identifying the zip this mod pack would build.
+
+        The hash covers the zip compression, the metadata, each file's name,
+        and its content: the bytes of in-memory files, and the path, size
+        and mtime of files on disk. As zips are written deterministically,
+        two mod packs with the same fingerprint produce byte-identical zips.
+
+        :return: The hex digest.
+        """
+
+        digest = hashlib.sha256(f"{ZIP_COMPRESSION}\0".encode("utf-8"))
+        digest.update(self.get_metadata())
+
+        for file_name in sorted(self.file_list()):
+            digest.update(b"\0" + file_name.encode("utf-8") + b"\0")
+
+            if file_name in self.files_to_write:
+                digest.update(self.files_to_write[file_name].getbuffer())
+                continue
+
+            sources = self.files_to_concat.get(file_name) or [
+                self.files_to_add[file_name]
+            ]
+
+            for source in sources:
+                stat = os.stat(source)
+                digest.update(
+                    f"{source}\0{stat.st_size}\0{stat.st_mtime_ns}\0".encode("utf-8")
+                )
+
+        return digest.hexdigest()
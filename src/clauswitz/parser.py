@@ -4,84 +4,392 @@
 
 from __future__ import annotations
 
-from typing import Any, IO, List, Tuple, Union
+from typing import Any, Dict, IO, Iterable, Iterator, List, Optional, Tuple, Union
+from typing_extensions import SupportsIndex
+
+import codecs
+import re
+import sys
 
 ClausDatum = Union[str, bool, Tuple[str, Any]]
 ClausObject = List[ClausDatum]
 
+Token = str
+
+# Amount of data read from the handle at a time.
+CHUNK_SIZE = 64 * 1024
+
+# A single token: a bare word, an operator, a quoted string (which may be
+# unterminated at the end of the input), or a comment.
+TOKEN = re.compile(r'[^\s{}="#]+|[{}=]|"[^"\\]*(?:\\.?[^"\\]*)*"?|#[^\n]*')
+
+ESCAPED = re.compile(r"\\(.)")
+
+# Values which are written without quotes.
+BARE_VALUES = frozenset(["male", "female", "always"])
+
+# The indentation for each depth of object.
+INDENTS = ["\t" * depth for depth in range(32)]
+
+
+class ClausNode(List[ClausDatum]):
+    """
+    A parsed object: a list of values and (key, value) tuples, which also
+    indexes its keys so that they can be looked up in constant time.
+
+    The index is built on the first lookup. Items appended later are added
+    to it on the next lookup; any other change drops it, so a node can be
+    used and modified as a plain list.
+    """
+
+    __slots__ = ("by_key", "indexed")
+
+    # The values for each key, in order { key => [value, ...] }
+    by_key: Dict[str, List[Any]]
+
+    # The number of items (from the start of the list) in the index.
+    indexed: int
+
+    def __init__(self: ClausNode, items: Iterable[ClausDatum] = ()) -> None:
+        super().__init__(items)
+        self.by_key = {}
+        self.indexed = 0
+
+    def __reduce__(self: ClausNode) -> Tuple[Any, ...]:
+        return ClausNode, (list(self),)
+
+    def get_values(self: ClausNode, key: str) -> List[Any]:
+        """Gets the values of all the items with the given key"""
+
+        if self.indexed < len(self):
+            self.update_index()
+
+        return list(self.by_key.get(key, ()))
+
+    def update_index(self: ClausNode) -> None:
+        index = self.by_key
+        start = self.indexed
+
+        for item in self[start:]:
+            if isinstance(item, tuple):
+                if item[0] in index:
+                    index[item[0]].append(item[1])
+                else:
+                    index[item[0]] = [item[1]]
+
+        self.indexed = len(self)
+
+    def reset_index(self: ClausNode) -> None:
+        if self.indexed:
+            self.by_key = {}
+            self.indexed = 0
+
+    # Anything other than appending may change or reorder existing items.
+
+    def __setitem__(self: ClausNode, *args: Any) -> None:
+        self.reset_index()
+        super().__setitem__(*args)
+
+    def __delitem__(self: ClausNode, *args: Any) -> None:
+        self.reset_index()
+        super().__delitem__(*args)
+
+    def __imul__(self: ClausNode, count: SupportsIndex) -> ClausNode:
+        self.reset_index()
+        return super().__imul__(count)
+
+    def insert(self: ClausNode, *args: Any) -> None:
+        self.reset_index()
+        super().insert(*args)
+
+    def pop(self: ClausNode, *args: Any) -> ClausDatum:
+        self.reset_index()
+        return super().pop(*args)
+
+    def remove(self: ClausNode, *args: Any) -> None:
+        self.reset_index()
+        super().remove(*args)
+
+    def clear(self: ClausNode) -> None:
+        self.reset_index()
+        super().clear()
+
+    def sort(self: ClausNode, *args: Any, **kwargs: Any) -> None:
+        self.reset_index()
+        super().sort(*args, **kwargs)
+
+    def reverse(self: ClausNode) -> None:
+        self.reset_index()
+        super().reverse()
+
+
+def tokenize(handle: Union[IO[bytes], IO[str]]) -> Iterator[Token]:
+    """
+    Splits a Clauswitz file into tokens, in a single pass over the handle.
+
+    Quoted strings are returned with their quotes.
+    """
+
+    for tokens in read_tokens(handle):
+        yield from tokens
+
+
+def read_tokens(handle: Union[IO[bytes], IO[str]]) -> Iterator[List[Token]]:
+    """
+    Reads a handle in chunks, and gets the list of tokens in each one.
+
+    Each chunk is tokenized up to its last newline, and the remainder is
+    carried over to the next chunk. A quoted string that is still open at
+    that point is carried over as well. Comments are discarded.
+    """
+
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    eof = False
+
+    while not eof:
+        chunk = handle.read(CHUNK_SIZE)
+        eof = not chunk
+
+        if isinstance(chunk, bytes):
+            chunk = decoder.decode(chunk, eof)
+
+        buffer += chunk
+        cut = len(buffer) if eof else buffer.rfind("\n") + 1
+
+        tokens = TOKEN.findall(buffer, 0, cut)
+
+        # A quoted string that is not closed runs to the end of the segment.
+        if tokens and not eof and tokens[-1][0] == '"' and not is_closed(tokens[-1]):
+            cut -= len(tokens.pop())
+
+        if buffer.find("#", 0, cut) >= 0:
+            tokens = [token for token in tokens if token[0] != "#"]
+
+        buffer = buffer[cut:]
+
+        yield tokens
+
+
+def is_closed(token: Token) -> bool:
+    """Checks whether a quoted string token has its closing quote"""
+
+    if len(token) < 2 or token[-1] != '"':
+        return False
+
+    # The final quote is escaped if it follows an odd number of backslashes.
+    body = token[1:-1]
+
+    return (len(body) - len(body.rstrip("\\"))) % 2 == 0
+
+
+def unquote(token: Token) -> str:
+    """Removes the quotes and escape characters from a token, if quoted"""
+
+    if token[0] != '"':
+        return token
+
+    if "\\" in token:
+        token = token[1:-1] if is_closed(token) else token[1:]
+
+        return ESCAPED.sub(r"\1", token)
+
+    return token[1:-1] if len(token) > 1 and token[-1] == '"' else token[1:]
+
 
 def parse(handle: Union[IO[bytes], IO[str]]) -> ClausObject:
-    output: ClausObject = []
+    """
+    Parses a Clauswitz file into a list of values and (key, value) tuples.
 
-    while True:
-        line = handle.readline()
+    Handles `key=value`, `key={ ... }` and `key{ ... }` (with any spacing),
+    bare values in lists, quoted strings, and comments. Nested objects are
+    tracked with an explicit stack, so depth is not limited by recursion.
+    An unmatched `}` ends the parse, as does the end of the file.
+    """
 
-        if isinstance(line, bytes):
-            line = line.decode("utf-8")
+    return build(read_tokens(handle))
 
-        if line == "":
-            break
 
-        line = line.strip()
+def build(chunks: Iterable[List[Token]]) -> ClausObject:
+    """Builds the objects for a stream of tokens, as described in parse()"""
 
-        if line == "}":
-            break
+    output: ClausObject = ClausNode()
+    stack: List[ClausObject] = [output]
+    current = output
 
-        if "=" not in line:
-            output.append(line.strip('"'))
+    # The previous token, if it is a value that may turn out to be a key.
+    pending: Optional[Token] = None
+    # Whether the pending token has been followed by an equals sign.
+    assign = False
 
-            continue
+    for tokens in chunks:
+        for token in tokens:
+            if token == "{":
+                current = open_object(current, pending)
+                stack.append(current)
+                pending = None
+                assign = False
 
-        key, value = line.split("=", 1)
-        n_value: Union[ClausDatum, ClausObject]
+            elif token == "}":
+                flush(current, pending, assign)
+                pending = None
+                assign = False
 
-        if value == "{":
-            n_value = parse(handle)
-        elif value in ["yes", "no"]:
-            n_value = value == "yes"
-        else:
-            n_value = value.strip('"')
+                stack.pop()
+
+                if not stack:
+                    return output
+
+                current = stack[-1]
+
+            elif token == "=":
+                assign = pending is not None
+
+            elif assign and pending:
+                current.append((sys.intern(unquote(pending)), convert(token)))
+                pending = None
+                assign = False
+
+            else:
+                flush(current, pending, False)
+                pending = token
 
-        key = key.strip('"')
-        output.append((key, n_value,))
+    flush(current, pending, assign)
 
     return output
 
 
+def open_object(current: ClausObject, pending: Optional[Token]) -> ClausObject:
+    """
+    Creates a new object for a `{`, attached to the pending key.
+
+    Anonymous blocks (with no key) are parsed, but not added to the output.
+    """
+
+    child: ClausObject = ClausNode()
+
+    if pending:
+        current.append((sys.intern(unquote(pending)), child))
+
+    return child
+
+
+def convert(token: Token) -> Union[str, bool]:
+    """Converts the token on the right of an equals sign to a value"""
+
+    if token == "yes" or token == "no":
+        return token == "yes"
+
+    # Bare words are mostly identifiers (ethics, civics, traits...) which
+    # are repeated across empires, so only one copy of each is kept.
+    if token[0] != '"':
+        return sys.intern(token)
+
+    return unquote(token)
+
+
+def flush(current: ClausObject, pending: Optional[Token], assign: bool) -> None:
+    """Adds a token that was not followed by a value to the current object"""
+
+    if not pending:
+        return
+
+    if assign:
+        current.append((sys.intern(unquote(pending)), ""))
+    else:
+        current.append(unquote(pending))
+
+
 def write(data: ClausObject, handle: IO[str], depth: int = 0) -> None:
-    for item in data:
-        handle.write("\t" * depth)
+    """Writes objects to a text stream, as serialize() formats them"""
 
-        if not isinstance(item, tuple):
-            write_literal(item, handle)
-            handle.write("\n")
-            continue
+    handle.write(serialize(data, depth))
 
-        key, value = item
 
-        handle.write(f'"{key}"' if " " in key else key)
-        handle.write("=")
+def write_bytes(data: ClausObject, handle: IO[bytes], depth: int = 0) -> None:
+    """Writes objects, UTF-8 encoded, to a binary stream (e.g. a zip entry)"""
 
-        if isinstance(value, list):
-            if value:
-                handle.write("{\n")
-                write(value, handle, depth + 1)
-                handle.write("\t" * depth)
-                handle.write("}\n")
-            else:
-                handle.write("{}\n")
+    handle.write(serialize(data, depth).encode("utf-8"))
+
+
+def serialize(data: ClausObject, depth: int = 0) -> str:
+    """
+    Formats objects in Clauswitz syntax, with each item on its own line,
+    indented by `depth` tabs.
 
+    The pieces of the output are collected in a list and joined once, so
+    the output is built in a single allocation. Nested objects are tracked
+    with an explicit stack, as in parse().
+    """
+
+    parts: List[str] = []
+    stack = [iter(data)]
+    indent = get_indent(depth)
+
+    while stack:
+        for item in stack[-1]:
+            if not isinstance(item, tuple):
+                parts += (indent, write_value(item), "\n")
+                continue
+
+            key, value = item
+            key = quote(key) if " " in key else key
+
+            # Most values are strings which need quotes, but no escaping.
+            if (
+                isinstance(value, str)
+                and value not in BARE_VALUES
+                and '"' not in value
+                and "\\" not in value
+            ):
+                parts += (indent, key, '="', value, '"\n')
+            elif not isinstance(value, list):
+                parts += (indent, key, "=", write_value(value), "\n")
+            elif not value:
+                parts += (indent, key, "={}\n")
+            else:
+                parts += (indent, key, "={\n")
+                stack.append(iter(value))
+                depth += 1
+                indent = get_indent(depth)
+                break
         else:
-            write_literal(value, handle)
-            handle.write("\n")
+            stack.pop()
 
+            if stack:
+                depth -= 1
+                indent = get_indent(depth)
+                parts += (indent, "}\n")
 
-def write_literal(value: Union[bool, str, float, int], handle: IO[str]) -> None:
-    if isinstance(value, bool):
-        handle.write("yes" if value else "no")
-    elif isinstance(value, (int, float)):
-        handle.write(str(value))
-    elif value in ["male", "female", "always"]:
-        handle.write(value)
-    else:
-        handle.write(f'"{value}"')
+    return "".join(parts)
+
+
+def get_indent(depth: int) -> str:
+    return INDENTS[depth] if depth < len(INDENTS) else "\t" * depth
+
+
+def write_value(value: Union[bool, str, float, int]) -> str:
+    """Formats a value for the right of an equals sign, or a list"""
+
+    if value is True:
+        return "yes"
+
+    if value is False:
+        return "no"
+
+    if isinstance(value, (int, float)):
+        return str(value)
+
+    if value in BARE_VALUES:
+        return value
+
+    return quote(value)
+
+
+def quote(value: str) -> str:
+    """Quotes a string, escaping any quotes and backslashes in it"""
+
+    if '"' in value or "\\" in value:
+        value = value.replace("\\", "\\\\").replace('"', '\\"')
+
+    return f'"{value}"'
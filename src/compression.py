@@ -0,0 +1,302 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: nospell ts=4 expandtab
+
+"""
+Pre-compressed response bodies, with content-coding negotiation.
+
+gzip is always available. brotli is used when the `brotli` package is
+installed, and silently skipped otherwise.
+"""
+
+from __future__ import annotations
+
+from typing import Dict, List, Optional, Tuple
+
+import email.utils
+import gzip
+import hashlib
+import http.server
+import time
+
+from ranges import requested_ranges, send_ranges
+
+try:
+    import brotli  # type: ignore
+except ImportError:
+    brotli = None
+
+# Supported content-codings, in order of server preference.
+ENCODINGS: List[str] = ["br", "gzip"] if brotli else ["gzip"]
+
+# Bodies smaller than this are not worth compressing on the fly.
+COMPRESS_THRESHOLD = 1024
+
+# MIME types which are worth compressing (as well as all text/ types).
+COMPRESSIBLE_TYPES = ["application/javascript", "application/json", "image/svg+xml"]
+
+
+def compress(data: bytes, encoding: str, fast: bool = False) -> bytes:
+    """
+    Compresses data with the given content-coding.
+
+    :param fast: Trade compression ratio for speed, for bodies which are only
+                 sent once, rather than cached.
+    """
+
+    if encoding == "gzip":
+        return gzip.compress(data, 6 if fast else 9, mtime=0)
+
+    if encoding == "br" and brotli:
+        return bytes(brotli.compress(data, quality=5 if fast else 11))
+
+    raise ValueError(f"Unsupported encoding {encoding}")
+
+
+def parse_accept_encoding(header: Optional[str]) -> Dict[str, float]:
+    """Gets the q-value for each coding listed in an Accept-Encoding header"""
+
+    output: Dict[str, float] = {}
+
+    for item in (header or "").split(","):
+        [coding, *params] = [part.strip() for part in item.split(";")]
+
+        if not coding:
+            continue
+
+        quality = 1.0
+
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+
+        output[coding.lower()] = quality
+
+    return output
+
+
+def negotiate(header: Optional[str], available: List[str]) -> str:
+    """
+    Picks the content-coding to send, given an Accept-Encoding header.
+
+    :param header:    The Accept-Encoding header, if any.
+    :param available: The codings that can be sent, in order of preference.
+
+    :return: The selected coding, or "identity".
+    """
+
+    accepted = parse_accept_encoding(header)
+    default = accepted.get("*", 0.0)
+
+    for encoding in available:
+        if accepted.get(encoding, default) > 0:
+            return encoding
+
+    return "identity"
+
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    """Checks an If-None-Match header against an ETag (weak comparison)"""
+
+    if not header:
+        return False
+
+    if header.strip() == "*":
+        return True
+
+    tags = [tag.strip() for tag in header.split(",")]
+
+    return etag in [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+
+
+class CachedBody:
+    """
+    A response body along with each of its compressed variants.
+
+    Each variant has its own strong ETag, derived from the hash of the
+    uncompressed data.
+    """
+
+    # The MIME type of the body.
+    mime: str
+
+    # The hash of the uncompressed content.
+    digest: str
+
+    # The body, keyed by content-coding ("identity" is always present).
+    variants: Dict[str, bytes]
+
+    def __init__(self: CachedBody, data: bytes, mime: str):
+        self.mime = mime
+        self.digest = hashlib.sha1(data).hexdigest()
+        self.variants = {"identity": data}
+
+        # Images and the like are already compressed, and small bodies
+        # gain nothing, so they are not worth the (slow) best compression.
+        if not is_compressible(mime) or len(data) < COMPRESS_THRESHOLD:
+            return
+
+        for encoding in ENCODINGS:
+            compressed = compress(data, encoding)
+
+            # Only keep the variants which are actually worth sending.
+            if len(compressed) < len(data):
+                self.variants[encoding] = compressed
+
+    def etag(self: CachedBody, encoding: str) -> str:
+        """Gets the ETag for one of the variants"""
+
+        if encoding == "identity":
+            return f'"{self.digest}"'
+
+        return f'"{self.digest}-{encoding}"'
+
+    def select(self: CachedBody, accept: Optional[str]) -> Tuple[str, bytes]:
+        """Selects the variant to send for an Accept-Encoding header"""
+
+        available = [e for e in ENCODINGS if e in self.variants]
+        encoding = negotiate(accept, available)
+
+        return encoding, self.variants[encoding]
+
+
+def is_compressible(mime: str) -> bool:
+    """Checks if a MIME type is worth compressing"""
+
+    mime = mime.split(";")[0].strip().lower()
+
+    return mime.startswith("text/") or mime in COMPRESSIBLE_TYPES
+
+
+def modified_since(header: Optional[str], mtime: int) -> bool:
+    """Checks an If-Modified-Since header against a modification time"""
+
+    if not header:
+        return True
+
+    try:
+        since = email.utils.parsedate_to_datetime(header).timestamp()
+    except (TypeError, ValueError):
+        return True
+
+    return mtime > since
+
+
+def is_unchanged(
+    self: http.server.BaseHTTPRequestHandler, etag: str, last_modified: Optional[int]
+) -> bool:
+    """Checks the request's conditional headers, to see if a 304 can be sent"""
+
+    if self.headers["If-None-Match"]:
+        return etag_matches(self.headers["If-None-Match"], etag)
+
+    if last_modified is not None:
+        return not modified_since(self.headers["If-Modified-Since"], last_modified)
+
+    return False
+
+
+def send_cached(
+    self: http.server.BaseHTTPRequestHandler,
+    body: CachedBody,
+    cache_control: str = "no-cache",
+    last_modified: Optional[int] = None,
+    max_age: Optional[int] = None,
+) -> None:
+    """
+    Sends a cached body, or a 304 if the client already has it.
+
+    Range requests are answered from the uncompressed body.
+
+    :param last_modified: The modification time of the body, if known,
+                          which is checked against If-Modified-Since.
+    :param max_age:       If set, an Expires header this many seconds ahead.
+    """
+
+    encoding, data = body.select(self.headers["Accept-Encoding"])
+    identity = body.variants["identity"]
+
+    headers = {
+        "Cache-Control": cache_control,
+        "Vary": "Accept-Encoding",
+        "Accept-Ranges": "bytes",
+    }
+
+    if last_modified is not None:
+        headers["Last-Modified"] = self.date_time_string(last_modified)
+
+    if max_age is not None:
+        headers["Expires"] = self.date_time_string(int(time.time()) + max_age)
+
+    if is_unchanged(self, body.etag(encoding), last_modified):
+        headers["ETag"] = body.etag(encoding)
+        send_headers(self, 304, headers)
+        return
+
+    ranges = requested_ranges(self, len(identity), body.etag("identity"), last_modified)
+
+    if ranges is not None:
+        headers["ETag"] = body.etag("identity")
+        send_ranges(self, identity, len(identity), body.mime, ranges, headers)
+        return
+
+    headers["ETag"] = body.etag(encoding)
+    headers["Content-Type"] = body.mime
+    headers["Content-Length"] = str(len(data))
+
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+
+    send_headers(self, 200, headers)
+
+    self.wfile.write(data)
+
+
+def send_headers(
+    self: http.server.BaseHTTPRequestHandler, status: int, headers: Dict[str, str]
+) -> None:
+    self.send_response(status)
+
+    for name, value in headers.items():
+        self.send_header(name, value)
+
+    self.end_headers()
+
+
+def send_body(
+    self: http.server.BaseHTTPRequestHandler,
+    data: bytes,
+    mime: str,
+    status: int = 200,
+    headers: Optional[Dict[str, str]] = None,
+) -> None:
+    """
+    Sends a dynamic (uncached) response body, compressing it on the fly if it
+    is large enough and of a compressible type.
+    """
+
+    encoding = "identity"
+
+    if is_compressible(mime) and len(data) >= COMPRESS_THRESHOLD:
+        encoding = negotiate(self.headers["Accept-Encoding"], ENCODINGS)
+
+    if encoding != "identity":
+        data = compress(data, encoding, fast=True)
+
+    headers = dict(headers or {})
+    headers["Content-Type"] = mime
+    headers["Content-Length"] = str(len(data))
+
+    # Whether or not this response was compressed depended on the header.
+    if is_compressible(mime):
+        headers["Vary"] = "Accept-Encoding"
+
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+
+    send_headers(self, status, headers)
+
+    self.wfile.write(data)
@@ -6,14 +6,24 @@ from __future__ import annotations
 
 from .ajax_empire_list import page_ajax_list
 from .download_modpack import download_user_empires
+from .moderate import do_moderate, page_pending
 from .page_file import page_file
 from .process_upload import process_upload
 from .send_username import send_username
+from .server_metrics import page_metrics
+from .upload_session import create_upload_session, import_upload_session
+from .worker_stats import page_worker_stats
 
 __all__ = [
+    "create_upload_session",
+    "do_moderate",
     "download_user_empires",
+    "import_upload_session",
     "page_ajax_list",
     "page_file",
+    "page_metrics",
+    "page_pending",
+    "page_worker_stats",
     "process_upload",
     "send_username",
 ]
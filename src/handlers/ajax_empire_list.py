@@ -4,64 +4,56 @@
 
 from __future__ import annotations
 
-from typing import List
-from typing_extensions import TypedDict
+from typing import Dict, List, Tuple
 
-import glob
 import json
 import http.server
+import threading
 
-import clauswitz
-import importer
+from catalogue import CATALOGUE, EmpireData, is_valid_source
+from compression import CachedBody, send_cached
 
+# The serialised listing for each folder, with the catalogue
+# generation it was built from { folder => (generation, body) }
+LISTINGS: Dict[str, Tuple[int, CachedBody]] = {}
+LISTINGS_LOCK = threading.Lock()
 
-EmpireData = TypedDict(
-    "EmpireData", {"author": str, "name": str, "ethics": List[str], "bio": str}
-)
+# The listing sent for folders which are not sources.
+EMPTY_LISTING = CachedBody(b"[]", "text/json")
 
 
 def page_ajax_list(self: http.server.BaseHTTPRequestHandler, folder: str) -> None:
     """Sends an AJAX fragment listing available files in a folder"""
 
-    # Get the list of files that are in the file.
-    files = glob.glob(f"{folder}/**/*.txt")
-    output: List[EmpireData] = []
+    send_cached(self, get_listing(folder))
 
-    for filename in files:
-        # Parse the Empire in the file.
-        with open(filename, "r") as handle:
-            obj = clauswitz.parse_data(handle)
 
-        # Extract the empire data out of the wrapper object.
-        if isinstance(obj, list) and len(obj) == 1:
-            if isinstance(obj[0], tuple):
-                obj = obj[0][1]
+def get_listing(folder: str) -> CachedBody:
+    """Gets the JSON listing for a folder, rebuilding it if it has changed"""
 
-        # Get the fields we want in the fragment.
-        name = str(importer.get_value(obj, "key"))
-        author = str(importer.get_value(obj, "author"))
-        ethics = importer.get_values(obj, "ethic")
+    if not is_valid_source(folder):
+        return EMPTY_LISTING
 
-        bio = ""
-        species = importer.get_value(obj, "species")
-        if isinstance(species, list):
-            bio = str(importer.get_value(species, "species_bio"))
+    generation = CATALOGUE.generation(folder)
 
-        # Make the ethics presentable.
-        ethics_out = [
-            str(ethic).replace("ethic_", "").replace("_", " ") for ethic in ethics
-        ]
+    with LISTINGS_LOCK:
+        cached = LISTINGS.get(folder)
 
-        # Add to the output list
-        output.append(EmpireData(author=author, name=name, ethics=ethics_out, bio=bio))
+    if cached and cached[0] == generation:
+        return cached[1]
+
+    # The listing is built (and compressed) without holding the lock, so
+    # other folders' listings are not held up. If two requests build the
+    # same listing at once, the one for the newest generation is kept.
+    output: List[EmpireData] = [entry["empire"] for entry in CATALOGUE.get([folder])]
 
     # Convert the list to JSON for JS client.
-    json_data = json.dumps(output).encode("utf-8")
+    body = CachedBody(json.dumps(output).encode("utf-8"), "text/json")
+
+    with LISTINGS_LOCK:
+        cached = LISTINGS.get(folder)
 
-    # Send the response
-    self.send_response(200)
-    self.send_header("Content-Type", "text/json")
-    self.send_header("Content-Length", str(len(json_data)))
-    self.end_headers()
+        if not cached or cached[0] <= generation:
+            LISTINGS[folder] = (generation, body)
 
-    self.wfile.write(json_data)
+    return body
@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: nospell ts=4 expandtab
+
+from __future__ import annotations
+
+from typing import IO, Any, Union
+
+import io
+
+# The size of chunk to send (data is buffered until a chunk is full).
+CHUNK_SIZE = 64 * 1024
+
+
+class ChunkedWriter(io.RawIOBase):
+    """
+    Writable stream that sends data with HTTP/1.1 chunked transfer-encoding.
+
+    Writes are buffered into chunks of CHUNK_SIZE. The stream is not seekable,
+    and tell() is unsupported, so zipfile treats it as a pipe and writes
+    data descriptors rather than seeking back to fill in sizes.
+
+    finish() must be called to send the terminating chunk; if the response
+    is abandoned part way through, the client sees a truncated response
+    rather than a complete one.
+    """
+
+    output: io.BufferedIOBase
+    buffer: bytearray
+
+    def __init__(self: ChunkedWriter, output: io.BufferedIOBase) -> None:
+        super().__init__()
+        self.output = output
+        self.buffer = bytearray()
+
+    def writable(self: ChunkedWriter) -> bool:
+        return True
+
+    def write(self: ChunkedWriter, data: Any) -> int:
+        self.buffer += data
+
+        if len(self.buffer) >= CHUNK_SIZE:
+            self.send_chunk()
+
+        return len(data)
+
+    def flush(self: ChunkedWriter) -> None:
+        self.send_chunk()
+        self.output.flush()
+
+    def send_chunk(self: ChunkedWriter) -> None:
+        if not self.buffer:
+            return
+
+        self.output.write(b"%x\r\n" % len(self.buffer))
+        self.output.write(self.buffer)
+        self.output.write(b"\r\n")
+        self.buffer.clear()
+
+    def finish(self: ChunkedWriter) -> None:
+        """Sends any buffered data, and the terminating zero-length chunk"""
+
+        self.send_chunk()
+        self.output.write(b"0\r\n\r\n")
+        self.output.flush()
+
+
+class TeeWriter(io.RawIOBase):
+    """
+    Writable, non-seekable, stream that copies all data to two other streams.
+    """
+
+    first: Union[IO[bytes], io.RawIOBase]
+    second: Union[IO[bytes], io.RawIOBase]
+
+    def __init__(
+        self: TeeWriter,
+        first: Union[IO[bytes], io.RawIOBase],
+        second: Union[IO[bytes], io.RawIOBase],
+    ) -> None:
+        super().__init__()
+        self.first = first
+        self.second = second
+
+    def writable(self: TeeWriter) -> bool:
+        return True
+
+    def write(self: TeeWriter, data: Any) -> int:
+        self.first.write(data)
+        self.second.write(data)
+
+        return len(data)
+
+    def flush(self: TeeWriter) -> None:
+        self.first.flush()
+        self.second.flush()
@@ -4,19 +4,26 @@
 
 from __future__ import annotations
 
-from typing import Dict, List, Optional, Set
+from typing import IO, Dict, List, Optional, Set, Union
 
-import glob
+import contextlib
 import http.server
-import io
 import os
 import random
-import shutil
 import textwrap
 import urllib.parse
 
 import clauswitz
-import importer
+
+from catalogue import CATALOGUE, CatalogueEntry
+
+from compression import etag_matches, send_headers
+from metrics import METRICS
+from ranges import Body, requested_ranges, send_ranges, send_region
+from workers import WORKERS, PoolFull, send_busy
+from zipcache import MODPACK_CACHE
+
+from .chunked import ChunkedWriter, TeeWriter
 
 
 def download_user_empires(self: http.server.BaseHTTPRequestHandler) -> None:
@@ -45,15 +52,16 @@ def download_user_empires(self: http.server.BaseHTTPRequestHandler) -> None:
     mod.stellaris_versions = "2.7.*"
 
     # Select the empires for the modpack
-    files = select_empires(count, sources, balance)
+    with METRICS.timer("select"):
+        empires = select_empires(count, sources, balance)
 
     # Log for debugging
     self.log_message("Input: %d, %s, %s", count, balance, sources)
-    self.log_message("Output: %s", files)
+    self.log_message("Output: %s", [entry["path"] for entry in empires])
 
-    # Add all the empires to the mod pack
-    for filename in files:
-        add_empire_to_modpack(mod, filename)
+    # Add all the empires to the mod pack, in a stable order
+    for entry in sorted(empires, key=lambda entry: entry["path"]):
+        add_empire_to_modpack(mod, entry)
 
     # Hide all the other default empires
     for filename in [
@@ -68,31 +76,161 @@ def download_user_empires(self: http.server.BaseHTTPRequestHandler) -> None:
     ]:
         mod.get_file_writer(f"prescripted_countries/{filename}.txt")
 
-    zip_buffer = io.BytesIO()
-    mod.write_to_zip(zip_buffer)
+    send_modpack(self, mod)
+
+
+def send_modpack(
+    self: http.server.BaseHTTPRequestHandler, mod: clauswitz.ModPack
+) -> None:
+    """Sends a mod pack to the client as a zip file, building it if needed"""
+
+    key = mod.fingerprint()
+    cached = MODPACK_CACHE.get(key)
+
+    # Zips are built in a worker process if there are any. HTTP/1.0
+    # clients do not support chunked responses, so for them the whole zip
+    # is built first to find its length.
+    if cached is None and (WORKERS.processes or self.request_version != "HTTP/1.1"):
+        try:
+            with METRICS.timer("zip_build"):
+                built = build_modpack(mod, key)
+        except PoolFull:
+            send_busy(self)
+            return
+
+        with built:
+            send_cached_modpack(self, key, built)
+
+        return
+
+    if cached is not None:
+        send_cached_modpack(self, key, cached)
+        return
 
     self.send_response(200)
     self.send_header("Content-Type", "application/zip")
-    self.send_header("Content-Length", str(zip_buffer.tell()))
+    self.send_header("Transfer-Encoding", "chunked")
+    self.send_header("ETag", f'"{key}"')
     self.send_header("Content-Disposition", 'attachment; filename="empires-mod.zip"')
     self.end_headers()
 
-    # Concatenate the files into the output
-    zip_buffer.seek(0, io.SEEK_SET)
-    shutil.copyfileobj(zip_buffer, self.wfile)
+    # If building the zip fails part way, the response can't be completed.
+    keep_alive = not self.close_connection
+    self.close_connection = True
 
+    # Write the zip straight out to the client as it is built,
+    # while also storing it in the cache.
+    stream = ChunkedWriter(self.wfile)
 
-def select_empires(count: int, sources: List[str], balance_authors: bool) -> List[str]:
-    # Find all possible empires
-    files: List[str] = []
+    with METRICS.timer("zip_build"):
+        build_modpack(mod, key, stream).close()
+        stream.finish()
+
+    # Otherwise, the connection is kept open only if the client asked for it.
+    self.close_connection = not keep_alive
+
+
+def build_modpack(
+    mod: clauswitz.ModPack, key: str, stream: Optional[ChunkedWriter] = None
+) -> IO[bytes]:
+    """
+    Builds a mod pack into the cache, either streaming it to the client as it
+    is built, or in a worker process.
+
+    :return: The built zip, open for reading. It is opened before it is
+             added to the cache, so it can be sent even if it is evicted.
+    :raises PoolFull: If there is no room in the worker pool's queue.
+    """
+
+    handle = MODPACK_CACHE.open()
+
+    try:
+        if stream:
+            mod.write_to_zip(TeeWriter(stream, handle))
+        else:
+            WORKERS.run(write_modpack, mod, handle.name)
+            handle.seek(0, os.SEEK_END)
+    except BaseException:
+        MODPACK_CACHE.abort(handle)
+        raise
+
+    built = open(handle.name, "rb")
+
+    try:
+        MODPACK_CACHE.commit(key, handle)
+    except BaseException:
+        built.close()
+        raise
+
+    return built
+
+
+def write_modpack(mod: clauswitz.ModPack, filename: str) -> None:
+    """Writes a mod pack zip to a file (run in a worker process)"""
+
+    mod.write_to_zip(filename)
 
-    for source in sources:
-        files = files + glob.glob(f"{source}/**/*.txt")
+
+def send_cached_modpack(
+    self: http.server.BaseHTTPRequestHandler,
+    key: str,
+    cached: Union[bytes, str, IO[bytes]],
+) -> None:
+    """
+    Sends a zip from the cache, either from memory, from disk, or from an
+    open file, supporting range requests so that downloads can be resumed.
+    """
+
+    etag = f'"{key}"'
+
+    if etag_matches(self.headers["If-None-Match"], etag):
+        send_headers(self, 304, {"ETag": etag})
+        return
+
+    with contextlib.ExitStack() as stack:
+        body: Body
+
+        if isinstance(cached, str):
+            # Open the file first, so it can be sent even if it is evicted.
+            handle = stack.enter_context(open(cached, "rb"))
+            body, size = handle, os.fstat(handle.fileno()).st_size
+        elif not isinstance(cached, bytes):
+            body, size = cached, os.fstat(cached.fileno()).st_size
+        else:
+            body, size = cached, len(cached)
+
+        headers = {
+            "ETag": etag,
+            "Accept-Ranges": "bytes",
+            "Content-Disposition": 'attachment; filename="empires-mod.zip"',
+        }
+
+        ranges = requested_ranges(self, size, etag)
+
+        if ranges is not None:
+            send_ranges(self, body, size, "application/zip", ranges, headers)
+            return
+
+        headers["Content-Type"] = "application/zip"
+        headers["Content-Length"] = str(size)
+
+        send_headers(self, 200, headers)
+        send_region(self, body, 0, size)
+
+
+def select_empires(
+    count: int, sources: List[str], balance_authors: bool
+) -> List[CatalogueEntry]:
+    # Find all possible empires
+    entries = {entry["path"]: entry for entry in CATALOGUE.get(sources)}
+    files: List[str] = list(entries)
 
     if balance_authors:
-        return author_balanced_empires(count, files, sources)
+        files = author_balanced_empires(count, files, sources)
     else:
-        return random_empires(count, files)
+        files = random_empires(count, files)
+
+    return [entries[filename] for filename in files]
 
 
 def random_empires(count: int, files: List[str]) -> List[str]:
@@ -109,107 +247,111 @@ def author_balanced_empires(
     if len(files) <= count:
         return files
 
-    # Split out the list by author
-    author_map = make_author_map(files)
+    # Each author's empires, shuffled, in source order.
+    queues = make_author_queues(files, sources)
 
-    # Create a list of authors
-    author_list: List[str] = [a for a in author_map.keys()]
-    selected: Set[str] = set()
+    # How far through each author's queue we have got.
+    cursors: Dict[str, int] = {author: 0 for author in queues}
+
+    authors: List[str] = list(queues)
+    selected: List[str] = []
     selected_names: Set[str] = set()
 
     # Build the list of empires.
     # On each pass, work through the author list in a random
-    # order, selecting up to one empire each.
-    while True:
-        random.shuffle(author_list)
-
-        # Attempt to add an empire for each Author
-        for author in author_list:
+    # order, selecting up to one empire each. Authors with nothing
+    # left to select are dropped, so every pass makes progress.
+    while authors:
+        random.shuffle(authors)
+        remaining: List[str] = []
 
-            # For this author, shuffle their empire list
-            empires = shuffle_empires(author_map[author], sources)
+        for author in authors:
+            empire = next_empire(queues[author], cursors, author, selected_names)
 
-            # Then add the first valid empire in the shuffled list.
-            for empire in empires:
-                empire_name = os.path.basename(empire)
+            if empire is None:
+                continue
 
-                # Having two empires with the same key breaks things.
-                if empire_name in selected_names:
-                    continue
-
-                selected.add(empire)
-                selected_names.add(empire_name)
-                break
+            selected.append(empire)
+            selected_names.add(os.path.basename(empire))
+            remaining.append(author)
 
             # If we have enough empires, stop.
             if len(selected) >= count:
-                return list(selected)
+                return selected
 
+        authors = remaining
 
-def make_author_map(files: List[str]) -> Dict[str, List[str]]:
-    # Split out the list by author
-    author_map: Dict[str, List[str]] = {}
+    return selected
 
-    for filename in files:
-        author = os.path.basename(os.path.dirname(filename))
 
-        if author not in author_map:
-            author_map[author] = []
+def next_empire(
+    queue: List[str], cursors: Dict[str, int], author: str, selected_names: Set[str]
+) -> Optional[str]:
+    # Find the next empire in the author's queue that does not share
+    # a name with one already selected; having two empires with the
+    # same key breaks things. Skipped empires can never become valid
+    # again, so the cursor only ever moves forward.
+    cursor = cursors[author]
+
+    while cursor < len(queue):
+        empire = queue[cursor]
+        cursor += 1
 
-        author_map[author].append(filename)
+        if os.path.basename(empire) not in selected_names:
+            cursors[author] = cursor
+            return empire
+
+    cursors[author] = cursor
+
+    return None
+
+
+def make_author_queues(files: List[str], sources: List[str]) -> Dict[str, List[str]]:
+    # Split out the list by author, and within that by source (in the
+    # order the sources were given, with anything else at the end).
+    ranks = {source: rank for rank, source in enumerate(sources)}
+    buckets: Dict[str, List[List[str]]] = {}
+
+    for filename in files:
+        folder, _ = os.path.split(filename)
+        source, author = os.path.split(folder)
 
-    return author_map
+        if author not in buckets:
+            buckets[author] = [[] for _ in range(len(sources) + 1)]
 
+        buckets[author][ranks.get(source, len(sources))].append(filename)
 
-def shuffle_empires(empires: List[str], sources: List[str]) -> List[str]:
-    # We shuffle the list of empires but
-    # make sure that they are loaded in source order.
-    output: List[str] = []
+    # We shuffle each author's empires, but make sure that they are
+    # loaded in source order.
+    queues: Dict[str, List[str]] = {}
 
-    for source in sources:
-        sublist = [x for x in empires if x.startswith(source + "/")]
-        random.shuffle(sublist)
-        output = output + sublist
+    for author, sublists in buckets.items():
+        queues[author] = []
 
-    dangling = [x for x in empires if x not in output]
-    random.shuffle(dangling)
+        for sublist in sublists:
+            random.shuffle(sublist)
+            queues[author].extend(sublist)
 
-    return output + dangling
+    return queues
 
 
-def add_empire_to_modpack(mod: clauswitz.ModPack, filename: str) -> None:
+def add_empire_to_modpack(mod: clauswitz.ModPack, entry: CatalogueEntry) -> None:
     # Prepare a file for all the species info
     bios = mod.get_file_writer("species.txt")
 
-    with open(filename, "rb") as empire_file:
-        empire = clauswitz.parser.parse(empire_file)
-
-        if isinstance(empire, list) and len(empire):
-            empire = empire[0]  # type: ignore
-
-        if isinstance(empire, tuple) and isinstance(empire[1], list):
-            empire = empire[1]
-
-        bio: Optional[str] = None
-        name = importer.get_value(empire, "key")
-        author = importer.get_value(empire, "author")
-        species = importer.get_value(empire, "species")
-
-        if isinstance(species, list):
-            bio = importer.get_value(species, "species_bio")
-
-        # Write the file contents into the mod pack
-        writer = mod.get_file_writer(f"prescripted_countries/10_{author}.txt")
-        empire_file.seek(0, io.SEEK_SET)
-        shutil.copyfileobj(empire_file, writer)
-
-        # Write the species info into the data file.
-        header = f"{name} by {author}"
-        bios.write(header.encode("utf-8"))
-        bios.write(b"\n" + (b"=" * len(header)) + b"\n\n")
-        bios.write(
-            textwrap.fill(bio, 60).encode("utf-8")
-            if bio
-            else b"[No Description Provided]"
-        )
-        bios.write(b"\n\n")
+    name = entry["empire"]["name"]
+    author = entry["empire"]["author"]
+    bio = entry["empire"]["bio"]
+
+    # Add the file to the author's file in the mod pack; it is only read
+    # from disk as the mod pack is written.
+    mod.add_file_segment(f"prescripted_countries/10_{author}.txt", entry["path"])
+
+    # Write the species info into the data file.
+    header = f"{name} by {author}"
+    bios.write(header.encode("utf-8"))
+    bios.write(b"\n" + (b"=" * len(header)) + b"\n\n")
+    bios.write(
+        textwrap.fill(bio, 60).encode("utf-8") if bio else b"[No Description Provided]"
+    )
+    bios.write(b"\n\n")
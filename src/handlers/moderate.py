@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: nospell ts=4 expandtab
+
+from __future__ import annotations
+
+import http.server
+import json
+import urllib.parse
+
+from compression import send_body
+from moderation import ModerationError, is_admin, list_empires, moderate
+
+# The largest moderation form that will be read.
+MAX_FORM_SIZE = 64 * 1024
+
+
+def page_pending(self: http.server.BaseHTTPRequestHandler, username: str) -> None:
+    """Lists the empires waiting for moderation, for admins"""
+
+    if not is_admin(username):
+        self.send_error(403, "Moderators only")
+        return
+
+    data = json.dumps(list_empires("pending")).encode("utf-8")
+
+    send_body(self, data, "text/json", headers={"Cache-Control": "no-cache"})
+
+
+def do_moderate(
+    self: http.server.BaseHTTPRequestHandler, username: str, length: int
+) -> None:
+    """Carries out a moderation action posted as a form (action, author, key)"""
+
+    if not is_admin(username):
+        self.send_error(403, "Moderators only")
+        return
+
+    if length > MAX_FORM_SIZE:
+        self.send_error(413, "Form too large")
+        return
+
+    try:
+        form = urllib.parse.parse_qs(self.rfile.read(length).decode("utf-8"))
+    except UnicodeDecodeError:
+        self.send_error(400, "Form is not valid UTF-8")
+        return
+
+    [action, author, key] = [
+        (form.get(f) or [""])[0] for f in ["action", "author", "key"]
+    ]
+
+    try:
+        entry = moderate(action, author, key, username)
+    except ModerationError as ex:
+        self.send_error(400, str(ex))
+        return
+
+    send_body(self, json.dumps(entry).encode("utf-8"), "text/json")
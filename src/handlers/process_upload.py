@@ -4,47 +4,142 @@
 
 from __future__ import annotations
 
-from typing import Dict, List
+from typing import IO, List, Optional, Tuple
 
+import hashlib
 import http.server
 import os
+import shutil
+import tempfile
 
-from clauswitz import ClausObject
+from clauswitz import ClausNode, ClausObject
 
 import importer
 
-PostData = Dict[str, List[bytes]]
+from compression import send_body
+from metrics import METRICS
+from multipart import CHUNK_SIZE, MultipartError, MultipartReader, get_boundary
+from workers import WORKERS, PoolFull, send_busy
+
+# Limit on the size of each form field other than the file.
+MAX_FIELD_SIZE = 4 * 1024
 
 
 def process_upload(
-    self: http.server.BaseHTTPRequestHandler, username: str, msg: PostData
+    self: http.server.BaseHTTPRequestHandler, username: str, length: int
 ) -> None:
-    if "select" not in msg or "file" not in msg:
-        self.send_error(415, "Missing file or empire list in post data")
+    """
+    Imports the selected empires from an uploaded user_empire_designs.txt.
+
+    The body is read as it arrives, with the file copied to a temporary
+    file, which the worker process then parses from the disk.
+    """
+
+    try:
+        boundary = get_boundary(self.headers["Content-Type"])
+    except MultipartError as ex:
+        # None of the body has been read, so the connection can not be reused.
+        self.close_connection = True
+        self.send_error(415, str(ex))
+        return
+
+    received = receive_upload(self, MultipartReader(self.rfile, boundary, length))
+
+    if not received:
         return
 
+    empires, wanted = received
+
+    import_empires(self, empires, wanted, username)
+
+
+def receive_upload(
+    self: http.server.BaseHTTPRequestHandler, reader: MultipartReader
+) -> Optional[Tuple[ClausObject, List[str]]]:
+    """
+    Reads and parses an upload, sending an error response if it fails.
+
+    :return: The uploaded empires, and the names of those to import.
+    """
+
+    with tempfile.NamedTemporaryFile(prefix="upload-", suffix=".txt") as upload:
+        try:
+            wanted = read_upload(reader, upload)
+        except MultipartError as ex:
+            # The rest of the body is unread, so the connection can not be reused.
+            self.close_connection = True
+            self.send_error(400, str(ex))
+            return None
+
+        if not wanted or not upload.tell():
+            self.send_error(415, "Missing file or empire list in post data")
+            return None
+
+        empires = parse_upload(self, upload)
+
+        return (empires, wanted) if empires is not None else None
+
+
+def read_upload(
+    reader: MultipartReader, upload: IO[bytes], digest: Optional[hashlib._Hash] = None
+) -> List[str]:
+    """
+    Reads an upload form, copying the file into `upload` (and `digest`).
+
+    :return: The names of the empires to import.
+    """
+
+    wanted: List[str] = []
+
+    for part in reader.parts():
+        if part.name == "file" and not upload.tell():
+            if digest is None:
+                shutil.copyfileobj(part, upload)
+                continue
+
+            for chunk in iter(lambda: part.read(CHUNK_SIZE), b""):
+                upload.write(chunk)
+                digest.update(chunk)
+        elif part.name == "select":
+            wanted.append(part.read_field(MAX_FIELD_SIZE).strip().strip('"'))
+
+    return wanted
+
+
+def parse_upload(
+    self: http.server.BaseHTTPRequestHandler, upload: IO[bytes]
+) -> Optional[ClausObject]:
+    """Parses an uploaded file in a worker process, sending 503 if they are busy"""
+
+    upload.flush()
+
+    try:
+        with METRICS.timer("parse_upload"):
+            return WORKERS.run(importer.read_user_empires, upload.name)
+    except PoolFull:
+        send_busy(self)
+        return None
+
+
+def import_empires(
+    self: http.server.BaseHTTPRequestHandler,
+    empires: ClausObject,
+    wanted: List[str],
+    username: str,
+) -> None:
+    """Imports the wanted empires for a user, and sends the report"""
+
     for folder in ["approved", "pending"]:
         if not os.path.exists(f"{folder}/{username}"):
             os.mkdir(f"{folder}/{username}")
 
-    # Extract and load the user_empire_designs.txt data.
-    upload = msg["file"][0].decode("utf-8")
-    empires = importer.parse_user_empires(upload)
-
-    # Get the list of empires we want to import
-    wanted: List[str] = [str(t).strip().strip('"') for t in msg["select"]]
-
     report = do_import(empires, wanted, username)
 
     report_bytes: bytes = report.encode("utf-8")
 
-    self.send_response(201)
-    self.send_header("Refresh", "5; url=/upload")
-    self.send_header("Content-Type", "text/plain")
-    self.send_header("Content-Length", str(len(report_bytes)))
-    self.end_headers()
-
-    self.wfile.write(report_bytes)
+    send_body(
+        self, report_bytes, "text/plain", 201, headers={"Refresh": "5; url=/upload"}
+    )
 
 
 def do_import(empires: ClausObject, wanted: List[str], username: str) -> str:
@@ -57,6 +152,10 @@ def do_import(empires: ClausObject, wanted: List[str], username: str) -> str:
         if not isinstance(empire, list):
             continue
 
+        # The parsed upload may be cached for other requests, so the
+        # changes are made to a copy (all of them are top level keys).
+        empire = ClausNode(empire)
+
         if not importer.is_valid_empire(empire):
             report += f"{name} does not appear to be a valid empire?\n"
             continue
@@ -6,14 +6,10 @@ from __future__ import annotations
 
 import http.server
 
+from compression import send_body
+
 
 def send_username(self: http.server.BaseHTTPRequestHandler, username: str) -> None:
     userbytes = username.encode("utf-8")
 
-    self.send_response(200)
-    self.send_header("Refresh", "5; url=/")
-    self.send_header("Content-Type", "text/plain")
-    self.send_header("Content-Length", str(len(userbytes)))
-    self.end_headers()
-
-    self.wfile.write(userbytes)
+    send_body(self, userbytes, "text/plain", headers={"Refresh": "5; url=/"})
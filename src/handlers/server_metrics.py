@@ -0,0 +1,29 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: nospell ts=4 expandtab
+
+from __future__ import annotations
+
+import http.server
+
+from compression import send_body
+from metrics import METRICS
+from moderation import is_admin
+
+
+def page_metrics(self: http.server.BaseHTTPRequestHandler, username: str) -> None:
+    """Sends the request and operation metrics in Prometheus' text format"""
+
+    # Any credentials create an account, so being logged in is not enough.
+    if not is_admin(username):
+        self.send_error(403, "Moderators only")
+        return
+
+    data = METRICS.render().encode("utf-8")
+
+    send_body(
+        self,
+        data,
+        "text/plain; version=0.0.4",
+        headers={"Cache-Control": "no-cache"},
+    )
@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: nospell ts=4 expandtab
+
+from __future__ import annotations
+
+from typing import Optional
+
+import hashlib
+import http.server
+import json
+import tempfile
+import urllib.parse
+
+from compression import send_body
+from multipart import MultipartError, MultipartReader, get_boundary
+from uploads import UPLOADS, VALID_KEY, UploadSession
+
+from .process_upload import import_empires, parse_upload, read_upload
+
+# The largest selection form that will be read.
+MAX_SELECTION_SIZE = 64 * 1024
+
+
+def create_upload_session(
+    self: http.server.BaseHTTPRequestHandler, username: str, length: int
+) -> None:
+    """
+    Parses an uploaded user_empire_designs.txt, and lists the empires in it.
+
+    The parsed file is kept as an upload session, so that the user can
+    then pick the empires to import (with import_upload_session) without
+    sending the file again. A file that is already cached is not parsed.
+    """
+
+    try:
+        boundary = get_boundary(self.headers["Content-Type"])
+    except MultipartError as ex:
+        # None of the body has been read, so the connection can not be reused.
+        self.close_connection = True
+        self.send_error(415, str(ex))
+        return
+
+    session = receive_session(self, MultipartReader(self.rfile, boundary, length))
+
+    if not session:
+        return
+
+    session = UPLOADS.add(session, username)
+    data = json.dumps({"session": session.key, "empires": session.listing})
+
+    send_body(
+        self,
+        data.encode("utf-8"),
+        "text/json",
+        201,
+        headers={
+            "Location": f"/upload-session/{session.key}",
+            "Cache-Control": "no-cache",
+        },
+    )
+
+
+def receive_session(
+    self: http.server.BaseHTTPRequestHandler, reader: MultipartReader
+) -> Optional[UploadSession]:
+    """Reads an upload into a session, sending an error response if it fails"""
+
+    digest = hashlib.sha256()
+
+    with tempfile.NamedTemporaryFile(prefix="upload-", suffix=".txt") as upload:
+        try:
+            read_upload(reader, upload, digest)
+        except MultipartError as ex:
+            # The rest of the body is unread, so the connection can not be reused.
+            self.close_connection = True
+            self.send_error(400, str(ex))
+            return None
+
+        if not upload.tell():
+            self.send_error(415, "Missing file in post data")
+            return None
+
+        cached = UPLOADS.get(digest.hexdigest())
+
+        if cached:
+            return cached
+
+        empires = parse_upload(self, upload)
+
+        if empires is None:
+            return None
+
+        return UploadSession(digest.hexdigest(), upload.tell(), empires)
+
+
+def import_upload_session(
+    self: http.server.BaseHTTPRequestHandler, username: str, key: str, length: int
+) -> None:
+    """Imports the empires selected (as a form) from an upload session"""
+
+    if length > MAX_SELECTION_SIZE:
+        self.close_connection = True
+        self.send_error(413, "Form too large")
+        return
+
+    try:
+        form = urllib.parse.parse_qs(self.rfile.read(length).decode("utf-8"))
+    except UnicodeDecodeError:
+        self.send_error(400, "Form is not valid UTF-8")
+        return
+
+    wanted = [name.strip().strip('"') for name in form.get("select", [])]
+
+    session = UPLOADS.get(key, username) if VALID_KEY.match(key) else None
+
+    if not session:
+        self.send_error(404, "Upload expired, please upload the file again")
+        return
+
+    if not wanted:
+        self.send_error(400, "No empires selected")
+        return
+
+    import_empires(self, session.empires, wanted, username)
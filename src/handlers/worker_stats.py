@@ -0,0 +1,24 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: nospell ts=4 expandtab
+
+from __future__ import annotations
+
+import http.server
+import json
+
+from compression import send_body
+from moderation import is_admin
+from workers import WORKERS
+
+
+def page_worker_stats(self: http.server.BaseHTTPRequestHandler, username: str) -> None:
+    """Sends the worker pool's queue depth and job latency as JSON, for admins"""
+
+    if not is_admin(username):
+        self.send_error(403, "Moderators only")
+        return
+
+    data = json.dumps(WORKERS.stats()).encode("utf-8")
+
+    send_body(self, data, "text/json", headers={"Cache-Control": "no-cache"})
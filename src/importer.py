@@ -6,64 +6,58 @@ from __future__ import annotations
 
 from typing import List, Optional, Union
 
-import re
 import io
 
-from clauswitz.parser import ClausObject, ClausDatum, parse, write
+from clauswitz.parser import (
+    ClausNode,
+    ClausObject,
+    ClausDatum,
+    parse,
+    quote,
+    write_bytes,
+)
+
+# Keys which must appear exactly once in a valid empire.
+REQUIRED_KEYS = [
+    "key",
+    "origin",
+    "empire_flag",
+    "ruler",
+    "civics",
+    "spawn_enabled",
+    "spawn_as_fallen",
+]
 
 
 def parse_user_empires(data: str) -> ClausObject:
-    # Normalise line endings.
-    data = data.replace("\r", "")
+    return parse(io.StringIO(data))
 
-    # Solve phrases without equal sign
-    data = re.sub(r"([A-Za-z0-9_.\-]+){", r"\1={", data)
-    data = re.sub(r"=\s*{", r"={", data, 0, re.MULTILINE)
-    data = re.sub(r"\n={", r"={", data, 0, re.MULTILINE)
-    data = re.sub(r"={(.)", r"={\n\1", data, 0, re.MULTILINE)
 
-    # Hack for random empty objects start of the line
-    data = re.sub(r"^\s*{\s*\}", r"", data, 0, re.MULTILINE)
+def read_user_empires(filename: str) -> ClausObject:
+    """Parses a user_empire_designs.txt, reading it a chunk at a time"""
 
-    return parse(io.StringIO(data))
+    with open(filename, "rb") as handle:
+        return parse(handle)
 
 
 def store(empire: ClausObject, folder: str = "pending") -> None:
     name = get_value(empire, "key")
     filename = f"{folder}/{name}.txt"
 
-    with open(filename, "w") as handle:
-        handle.write(f'"{name}"={{\n')
-        write(empire, handle, 1)
-        handle.write("}\n")
+    with open(filename, "wb") as handle:
+        handle.write(f"{quote(str(name))}={{\n".encode("utf-8"))
+        write_bytes(empire, handle, 1)
+        handle.write(b"}\n")
 
 
 def is_valid_empire(data: ClausObject) -> bool:
-    if not has_value(data, "key"):
-        return False
-
-    if not has_value(data, "origin"):
-        return False
-
-    if not has_value(data, "empire_flag"):
-        return False
-
-    if not has_value(data, "ruler"):
-        return False
-
-    if not has_value(data, "civics"):
-        return False
-
-    if not has_value(data, "spawn_enabled"):
-        return False
-
-    if not has_value(data, "spawn_as_fallen"):
-        return False
-
-    return True
+    return all(has_value(data, key) for key in REQUIRED_KEYS)
 
 
 def get_values(data: ClausObject, key: str) -> List[ClausDatum]:
+    if isinstance(data, ClausNode):
+        return data.get_values(key)
+
     tuples = [t for t in data if isinstance(t, tuple)]
 
     return [t[1] for t in tuples if t[0] == key]
@@ -0,0 +1,266 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: nospell ts=4 expandtab
+
+"""
+Request and operation metrics, in the Prometheus text exposition format.
+
+Each request that passes through the record_metrics middleware is
+counted by method, route and status, along with the bytes sent and how
+long it took. The expensive operations within requests (bcrypt, parsing, selecting
+empires and building zips) are timed separately with METRICS.timer().
+"""
+
+from __future__ import annotations
+
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import bisect
+import contextlib
+import http.server
+import io
+import threading
+import time
+
+from router import Next, Request
+
+# Upper bounds of the histogram buckets, in seconds.
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+# (method, route)
+RouteKey = Tuple[str, str]
+
+
+class Histogram:
+    """Counts of observed values, in LATENCY_BUCKETS"""
+
+    # The count of values in each bucket (not cumulative), with the
+    # final bucket for values above the largest bound.
+    counts: List[int]
+
+    total: float
+    count: int
+
+    def __init__(self: Histogram) -> None:
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self: Histogram, value: float) -> None:
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def render(self: Histogram, name: str, labels: str) -> Iterator[str]:
+        """The sample lines for the histogram, with the given labels"""
+
+        prefix = labels + "," if labels else ""
+        cumulative = 0
+
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}'
+
+        yield f'{name}_bucket{{{prefix}le="+Inf"}} {self.count}'
+        yield f"{name}_sum{{{labels}}} {self.total}"
+        yield f"{name}_count{{{labels}}} {self.count}"
+
+
+def label(value: Any) -> str:
+    """Escapes a label value"""
+
+    text = str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+    return text.replace("\n", "\\n")
+
+
+class Metrics:
+    """The metrics for the server, shared by all request threads"""
+
+    # The number of requests { (method, route, status) => count }
+    requests: Dict[Tuple[str, str, int], int]
+
+    # The bytes sent in responses, including headers { (method, route) => bytes }
+    sent: Dict[RouteKey, int]
+
+    # The time taken to serve requests { (method, route) => seconds }
+    latency: Dict[RouteKey, Histogram]
+
+    # The time taken by operations within requests { operation => seconds }
+    timers: Dict[str, Histogram]
+
+    lock: threading.Lock
+
+    def __init__(self: Metrics) -> None:
+        self.requests = {}
+        self.sent = {}
+        self.latency = {}
+        self.timers = {}
+        self.lock = threading.Lock()
+
+    def record_request(
+        self: Metrics, method: str, route: str, status: int, sent: int, seconds: float
+    ) -> None:
+        key = (method, route)
+
+        with self.lock:
+            counter = (method, route, status)
+            self.requests[counter] = self.requests.get(counter, 0) + 1
+            self.sent[key] = self.sent.get(key, 0) + sent
+
+            if key not in self.latency:
+                self.latency[key] = Histogram()
+
+            self.latency[key].observe(seconds)
+
+    def observe(self: Metrics, operation: str, seconds: float) -> None:
+        with self.lock:
+            if operation not in self.timers:
+                self.timers[operation] = Histogram()
+
+            self.timers[operation].observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self: Metrics, operation: str) -> Iterator[None]:
+        """Times the body of a `with` statement as an operation"""
+
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(operation, time.perf_counter() - start)
+
+    def render(self: Metrics) -> str:
+        """Writes out all the metrics in the Prometheus text format"""
+
+        lines = [
+            "# HELP stellaris_http_requests_total Requests served.",
+            "# TYPE stellaris_http_requests_total counter",
+        ]
+
+        with self.lock:
+            for (method, route, status), count in sorted(self.requests.items()):
+                lines.append(
+                    "stellaris_http_requests_total{"
+                    f'method="{label(method)}",route="{label(route)}",'
+                    f'status="{status}"}} {count}'
+                )
+
+            lines.append(
+                "# HELP stellaris_http_response_bytes_total Bytes sent in responses."
+            )
+            lines.append("# TYPE stellaris_http_response_bytes_total counter")
+
+            for (method, route), sent in sorted(self.sent.items()):
+                lines.append(
+                    "stellaris_http_response_bytes_total{"
+                    f'method="{label(method)}",route="{label(route)}"}} {sent}'
+                )
+
+            name = "stellaris_http_request_duration_seconds"
+            lines.append(f"# HELP {name} Time taken to serve requests.")
+            lines.append(f"# TYPE {name} histogram")
+
+            for (method, route), histogram in sorted(self.latency.items()):
+                labels = f'method="{label(method)}",route="{label(route)}"'
+                lines.extend(histogram.render(name, labels))
+
+            name = "stellaris_operation_duration_seconds"
+            lines.append(f"# HELP {name} Time taken by operations within requests.")
+            lines.append(f"# TYPE {name} histogram")
+
+            for operation, histogram in sorted(self.timers.items()):
+                lines.extend(histogram.render(name, f'operation="{label(operation)}"'))
+
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+class CountingWriter(io.BufferedIOBase):
+    """Writable stream which counts the bytes written through it"""
+
+    output: io.BufferedIOBase
+
+    # The number of bytes sent, including any sent around this stream.
+    written: int
+
+    def __init__(self: CountingWriter, output: io.BufferedIOBase) -> None:
+        super().__init__()
+        self.output = output
+        self.written = 0
+
+    def writable(self: CountingWriter) -> bool:
+        return True
+
+    def write(self: CountingWriter, data: Any) -> int:
+        self.output.write(data)
+        count = memoryview(data).nbytes
+        self.written += count
+
+        return count
+
+    def flush(self: CountingWriter) -> None:
+        self.output.flush()
+
+
+class InstrumentedHandler(http.server.BaseHTTPRequestHandler):
+    """Request handler which remembers the status of its response, for the metrics"""
+
+    # The status code of the response, or 0 if none has been sent.
+    status: int = 0
+
+    def send_response(
+        self: InstrumentedHandler, code: int, message: Optional[str] = None
+    ) -> None:
+        self.status = code
+        super().send_response(code, message)
+
+
+def record_metrics(request: Request, call_next: Next) -> None:
+    """
+    Middleware which records the metrics of each request.
+
+    Requests are recorded under their route's pattern, so the number of
+    metrics is bounded. The status is only known for InstrumentedHandlers.
+    """
+
+    handler = request.handler
+    stream = handler.wfile
+    counter = CountingWriter(stream)
+
+    handler.wfile = counter
+    start = time.perf_counter()
+
+    if isinstance(handler, InstrumentedHandler):
+        handler.status = 0
+
+    try:
+        call_next(request)
+    finally:
+        handler.wfile = stream
+        status = handler.status if isinstance(handler, InstrumentedHandler) else 0
+
+        METRICS.record_request(
+            request.method,
+            request.name(),
+            status or 500,
+            counter.written,
+            time.perf_counter() - start,
+        )
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: nospell ts=4 expandtab
+
+"""
+Moderation of uploaded empires: moving them between the pending, approved
+and historical folders.
+
+Each move goes through the catalogue, so the empire's metadata, validity
+and hash are recorded as it is moved, and the listings never need to
+parse it again. Every move is appended to moderation.log.
+
+Moderators are the users listed (one per line) in admins.txt. Moves can
+be made through /admin/moderate, or from the command line with:
+
+    python3 src/moderation.py list [pending]
+    python3 src/moderation.py approve|retire|restore <author> <key> [--by user]
+"""
+
+from __future__ import annotations
+
+from typing import Dict, List, Tuple
+
+import argparse
+import json
+import os
+import threading
+import time
+
+from catalogue import CATALOGUE, CatalogueEntry
+
+# The source and destination of each moderation action.
+ACTIONS: Dict[str, Tuple[str, str]] = {
+    "approve": ("pending", "approved"),
+    "retire": ("approved", "historical"),
+    "restore": ("historical", "approved"),
+}
+
+ADMINS_FILE = "admins.txt"
+LOG_FILE = "moderation.log"
+
+LOG_LOCK = threading.Lock()
+
+
+class ModerationError(Exception):
+    """Raised when a moderation action can not be carried out"""
+
+
+def is_admin(user: str) -> bool:
+    """Checks if a user is listed in the admins file"""
+
+    if not os.path.exists(ADMINS_FILE):
+        return False
+
+    with open(ADMINS_FILE, "r", encoding="utf-8") as handle:
+        admins = [line.strip().lower() for line in handle]
+
+    return user.lower() in admins
+
+
+def moderate(action: str, author: str, key: str, moderator: str) -> CatalogueEntry:
+    """
+    Moves an empire according to a moderation action.
+
+    :raises ModerationError: If the action, or the empire, is not valid.
+    """
+
+    if action not in ACTIONS:
+        raise ModerationError(f"Unknown action {action}")
+
+    source, destination = ACTIONS[action]
+
+    if "/" in author or "/" in key or author.startswith(".") or key.startswith("."):
+        raise ModerationError(f"Invalid empire {author}/{key}")
+
+    CATALOGUE.refresh(source, force=True)
+    entry = next(
+        (
+            e
+            for e in CATALOGUE.get([source])
+            if (e["author"], e["key"]) == (author, key)
+        ),
+        None,
+    )
+
+    if not entry:
+        raise ModerationError(f"No empire {author}/{key} in {source}")
+
+    if action == "approve" and not entry["valid"]:
+        raise ModerationError(f"{author}/{key} is not a valid empire")
+
+    try:
+        moved = CATALOGUE.move((source, author, key), destination)
+    except FileExistsError as ex:
+        raise ModerationError(f"{author}/{key} is already in {destination}") from ex
+
+    log(action, moved, moderator)
+
+    return moved
+
+
+def log(action: str, entry: CatalogueEntry, moderator: str) -> None:
+    """Appends a moderation action to the log"""
+
+    record = {
+        "time": int(time.time()),
+        "action": action,
+        "moderator": moderator,
+        "path": entry["path"],
+        "sha256": entry["sha256"],
+    }
+
+    with LOG_LOCK, open(LOG_FILE, "a", encoding="utf-8") as handle:
+        handle.write(json.dumps(record) + "\n")
+
+
+def list_empires(source: str) -> List[CatalogueEntry]:
+    """Lists the empires in a source, indexing any new ones"""
+
+    CATALOGUE.refresh(source, force=True)
+
+    return CATALOGUE.get([source])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Moderate uploaded empires")
+    parser.add_argument("action", choices=["list", *ACTIONS])
+    parser.add_argument("author", nargs="?", help="author, or the source to list")
+    parser.add_argument("key", nargs="?", help="the empire's key")
+    parser.add_argument("--by", default=os.environ.get("USER", "cli"))
+    args = parser.parse_args()
+
+    os.chdir(os.path.dirname(os.path.realpath(__file__)))
+    os.chdir("..")
+
+    CATALOGUE.load("catalogue.json")
+
+    if args.action == "list":
+        for entry in list_empires(args.author or "pending"):
+            status = "ok" if entry["valid"] else "INVALID"
+            print(f"{entry['author']}\t{entry['key']}\t{status}")
+        return
+
+    if not args.author or not args.key:
+        parser.error("an author and key are required")
+
+    try:
+        moved = moderate(args.action, args.author, args.key, args.by)
+    except ModerationError as ex:
+        parser.exit(1, f"{ex}\n")
+
+    print(f"Moved to {moved['path']}")
+
+
+if __name__ == "__main__":
+    main()
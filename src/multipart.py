@@ -0,0 +1,243 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: nospell ts=4 expandtab
+
+"""
+Streaming reader for multipart/form-data request bodies (RFC 7578).
+
+Unlike cgi.parse_multipart (which is deprecated, and removed in Python
+3.13), parts are read one at a time, in chunks, straight from the request
+stream; so memory use is bounded by CHUNK_SIZE, however large the upload.
+"""
+
+from __future__ import annotations
+
+from typing import IO, Iterator, Optional, Union
+
+import email.message
+import email.parser
+import io
+
+# Default limit on the size of a request body, in bytes.
+MAX_BODY_SIZE = 16 * 1024 * 1024
+
+# Limit on the size of the headers of each part.
+MAX_PART_HEAD_SIZE = 16 * 1024
+
+# Amount of data read from the request at a time.
+CHUNK_SIZE = 64 * 1024
+
+
+class MultipartError(ValueError):
+    """Raised when a request body is not valid multipart/form-data"""
+
+
+def get_boundary(content_type: Optional[str]) -> bytes:
+    """
+    Gets the boundary from a multipart/form-data Content-Type header.
+
+    :raises MultipartError: If the content type is not multipart/form-data.
+    """
+
+    message = email.message.Message()
+    message["Content-Type"] = content_type or ""
+
+    boundary = message.get_param("boundary")
+
+    if message.get_content_type() != "multipart/form-data" or not boundary:
+        raise MultipartError(f"Invalid Content-Type: {content_type}")
+
+    return str(boundary).encode("ascii")
+
+
+class MultipartReader:
+    """Reads the parts of a multipart/form-data body from a stream"""
+
+    stream: Union[IO[bytes], io.BufferedIOBase]
+
+    # The bytes of the body not yet read from the stream.
+    remaining: int
+
+    # Data read from the stream, and not yet consumed.
+    buffer: bytearray
+
+    # The marker at the end of each part.
+    delimiter: bytes
+
+    def __init__(
+        self: MultipartReader,
+        stream: Union[IO[bytes], io.BufferedIOBase],
+        boundary: bytes,
+        length: int,
+    ) -> None:
+        self.stream = stream
+        self.remaining = length
+        self.buffer = bytearray()
+        self.delimiter = b"\r\n--" + boundary
+
+    def fill(self: MultipartReader) -> bool:
+        """Reads more of the body into the buffer, returning False at the end"""
+
+        if self.remaining <= 0:
+            return False
+
+        data = self.stream.read(min(self.remaining, CHUNK_SIZE))
+
+        if not data:
+            raise MultipartError("Request body ended early")
+
+        self.remaining -= len(data)
+        self.buffer += data
+
+        return True
+
+    def find(self: MultipartReader, marker: bytes, limit: int) -> int:
+        """
+        Reads until a marker is in the buffer, returning its position.
+
+        :raises MultipartError: If the marker is not in the first `limit` bytes.
+        """
+
+        while True:
+            position = self.buffer.find(marker)
+
+            if 0 <= position <= limit:
+                return position
+
+            if len(self.buffer) > limit + len(marker) or not self.fill():
+                raise MultipartError("Invalid multipart body")
+
+    def parts(self: MultipartReader) -> Iterator[Part]:
+        """
+        Reads each part in turn.
+
+        Each part must be read (or skipped) before the next one is read.
+        """
+
+        # The body starts with the delimiter, without its leading newline.
+        self.buffer += b"\r\n"
+
+        while True:
+            end = self.find(self.delimiter, MAX_PART_HEAD_SIZE)
+            del self.buffer[: end + len(self.delimiter)]
+
+            # The delimiter is followed by "--" after the last part.
+            while len(self.buffer) < 2 and self.fill():
+                pass
+
+            if self.buffer.startswith(b"--"):
+                self.discard()
+                return
+
+            if not self.buffer.startswith(b"\r\n"):
+                raise MultipartError("Invalid multipart body")
+
+            head_end = self.find(b"\r\n\r\n", MAX_PART_HEAD_SIZE)
+            headers = email.parser.BytesHeaderParser().parsebytes(
+                bytes(self.buffer[2:head_end])
+            )
+            del self.buffer[: head_end + 4]
+
+            part = Part(self, headers)
+            yield part
+
+            part.skip()
+
+    def discard(self: MultipartReader) -> None:
+        """Reads and drops the rest of the body, such as the epilogue"""
+
+        self.buffer.clear()
+
+        while self.fill():
+            self.buffer.clear()
+
+    def read_part(self: MultipartReader, size: int) -> bytes:
+        """Reads up to `size` bytes of the current part (b"" at its end)"""
+
+        while True:
+            end = self.buffer.find(self.delimiter)
+
+            # Keep anything that might be the start of a delimiter.
+            available = end if end >= 0 else len(self.buffer) - len(self.delimiter) + 1
+
+            if available > 0 or end == 0:
+                count = min(size, available)
+                data = bytes(self.buffer[:count])
+                del self.buffer[:count]
+                return data
+
+            if not self.fill():
+                raise MultipartError("Request body ended early")
+
+
+class Part:
+    """One field (or file) of a multipart/form-data body"""
+
+    reader: MultipartReader
+    headers: email.message.Message
+
+    # The name of the form field.
+    name: str
+
+    # The name of the uploaded file, if the part is a file.
+    filename: Optional[str]
+
+    # Whether all of the part has been read.
+    done: bool
+
+    def __init__(
+        self: Part, reader: MultipartReader, headers: email.message.Message
+    ) -> None:
+        self.reader = reader
+        self.headers = headers
+        self.name = str(headers.get_param("name", "", "content-disposition"))
+        self.filename = headers.get_filename()
+        self.done = False
+
+    def read(self: Part, size: int = -1) -> bytes:
+        """Reads up to `size` bytes of the part, or all of it if negative"""
+
+        if size < 0:
+            return b"".join(iter(lambda: self.read(CHUNK_SIZE), b""))
+
+        if self.done or not size:
+            return b""
+
+        data = self.reader.read_part(size)
+
+        if not data:
+            self.done = True
+
+        return data
+
+    def read_field(self: Part, limit: int) -> str:
+        """
+        Reads the part as a text field.
+
+        :raises MultipartError: If the field is larger than `limit` bytes,
+                                or is not valid UTF-8.
+        """
+
+        data = b""
+
+        while True:
+            chunk = self.read(limit + 1 - len(data))
+
+            if not chunk:
+                break
+
+            data += chunk
+
+            if len(data) > limit:
+                raise MultipartError(f"Field {self.name} is too large")
+
+        try:
+            return data.decode("utf-8")
+        except UnicodeDecodeError as ex:
+            raise MultipartError(f"Field {self.name} is not valid UTF-8") from ex
+
+    def skip(self: Part) -> None:
+        """Discards the rest of the part"""
+
+        while self.read(CHUNK_SIZE):
+            pass
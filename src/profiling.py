@@ -0,0 +1,210 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: nospell ts=4 expandtab
+
+"""
+On-demand profiling of single requests.
+
+A request is profiled if an admin asks for it, with an `X-Profile` header
+or a `profile` query parameter, or if it is picked at random at the
+server's sampling rate (--profile-rate). While the handler runs, another
+thread samples its stack every SAMPLE_INTERVAL seconds; the samples are
+written to PROFILE_DIR in the "collapsed stack" format read by
+flamegraph.pl, speedscope and similar tools:
+
+    handlers/download_modpack.py:download_user_empires;...;zipfile.py:write 12
+
+Only the newest PROFILE_LIMIT profiles are kept.
+"""
+
+from __future__ import annotations
+
+from typing import Callable, Dict, Optional
+
+import http.server
+import os
+import random
+import sys
+import threading
+import time
+import types
+import urllib.parse
+
+from moderation import is_admin
+from router import Next, Request
+
+# The folder profiles are written to.
+PROFILE_DIR = "profiles"
+
+# The number of profiles kept; older ones are deleted.
+PROFILE_LIMIT = 100
+
+# Frames are named by their file's path relative to this folder.
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Seconds between samples of the profiled thread's stack.
+SAMPLE_INTERVAL = 0.005
+
+
+def collapse(frame: Optional[types.FrameType], base: types.FrameType) -> str:
+    """Describes a stack, from just above `base` down to `frame`, as a;b;c"""
+
+    names = []
+
+    while frame is not None and frame is not base:
+        code = frame.f_code
+        filename = os.path.relpath(code.co_filename, SOURCE_DIR)
+
+        # Library frames are named by their path within the library.
+        if filename.startswith(".."):
+            filename = "/".join(filename.split(os.sep)[-2:])
+
+        names.append(f"{filename}:{code.co_name}")
+        frame = frame.f_back
+
+    return ";".join(reversed(names))
+
+
+class StackSampler:
+    """Samples the stack of a thread, from another thread, until stopped"""
+
+    # The thread being sampled.
+    thread_id: int
+
+    # The frame the samples are taken relative to.
+    base: types.FrameType
+
+    # The number of times each stack was seen { stack => count }
+    samples: Dict[str, int]
+
+    stopped: threading.Event
+    thread: threading.Thread
+
+    def __init__(self: StackSampler, base: types.FrameType) -> None:
+        self.thread_id = threading.get_ident()
+        self.base = base
+        self.samples = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+
+    def start(self: StackSampler) -> None:
+        self.thread.start()
+
+    def stop(self: StackSampler) -> Dict[str, int]:
+        self.stopped.set()
+        self.thread.join()
+
+        return self.samples
+
+    def run(self: StackSampler) -> None:
+        while not self.stopped.wait(SAMPLE_INTERVAL):
+            stack = collapse(sys._current_frames().get(self.thread_id), self.base)
+
+            if stack:
+                self.samples[stack] = self.samples.get(stack, 0) + 1
+
+
+class Profiler:
+    """Decides which requests to profile, and stores their profiles"""
+
+    # The fraction of requests profiled without being asked for.
+    rate: float
+
+    directory: str
+    limit: int
+
+    # Serialises writing and pruning the profiles.
+    lock: threading.Lock
+
+    def __init__(self: Profiler) -> None:
+        self.rate = 0.0
+        self.directory = PROFILE_DIR
+        self.limit = PROFILE_LIMIT
+        self.lock = threading.Lock()
+
+    def is_wanted(
+        self: Profiler, handler: http.server.BaseHTTPRequestHandler, user: str
+    ) -> bool:
+        """Checks if a request should be profiled"""
+
+        query = urllib.parse.urlparse(handler.path).query
+        query_params = urllib.parse.parse_qs(query, keep_blank_values=True)
+
+        if handler.headers["X-Profile"] or "profile" in query_params:
+            return bool(user) and is_admin(user)
+
+        return self.rate > 0 and random.random() < self.rate
+
+    def run(
+        self: Profiler,
+        handler: http.server.BaseHTTPRequestHandler,
+        user: str,
+        call: Callable[[], None],
+    ) -> None:
+        """Serves a request, profiling it if wanted"""
+
+        if not self.is_wanted(handler, user):
+            call()
+            return
+
+        sampler = StackSampler(sys._getframe())
+        sampler.start()
+        start = time.monotonic()
+
+        try:
+            call()
+        finally:
+            samples = sampler.stop()
+            elapsed = time.monotonic() - start
+
+            path = urllib.parse.urlparse(handler.path).path
+            filename = self.store(handler.command, path, samples)
+            handler.log_message("Profiled %s in %.3fs: %s", path, elapsed, filename)
+
+    def store(self: Profiler, command: str, path: str, samples: Dict[str, int]) -> str:
+        """Writes a profile, and removes the oldest if there are too many"""
+
+        name = "".join(c if c.isalnum() else "_" for c in path.strip("/")[:64])
+
+        # Named so that sorting the names sorts the profiles by age.
+        now = time.time_ns()
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.gmtime(now // 10**9))
+        filename = os.path.join(
+            self.directory,
+            f"{stamp}.{now % 10**9:09d}-{command}-{name or 'root'}.folded",
+        )
+
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+
+            with open(filename, "w", encoding="utf-8") as handle:
+                for stack, count in sorted(samples.items()):
+                    handle.write(f"{stack} {count}\n")
+
+            self.prune()
+
+        return filename
+
+    def prune(self: Profiler) -> None:
+        """Deletes the oldest profiles, keeping the newest `limit` of them"""
+
+        profiles = sorted(
+            name for name in os.listdir(self.directory) if name.endswith(".folded")
+        )
+
+        for name in profiles[: max(0, len(profiles) - self.limit)]:
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+
+PROFILER = Profiler()
+
+
+def profile_request(request: Request, call_next: Next) -> None:
+    """Middleware which profiles the requests that PROFILER picks"""
+
+    user = request.params.get("user", "")
+
+    PROFILER.run(request.handler, user, lambda: call_next(request))
@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: nospell ts=4 expandtab
+
+"""
+HTTP Range requests (RFC 7233), for static files and mod pack zips.
+
+Bodies are either bytes in memory, or open files. Files are sent with
+socket.sendfile(), which uses os.sendfile() for zero-copy transfer on plain
+sockets, and falls back to reading and sending chunks over TLS.
+"""
+
+from __future__ import annotations
+
+from typing import IO, Dict, List, Optional, Tuple, Union
+
+import email.utils
+import http.server
+import secrets
+import socket
+
+from metrics import CountingWriter
+
+# The first and last byte positions (inclusive) of a range.
+Range = Tuple[int, int]
+
+# A body to send ranges of.
+Body = Union[bytes, IO[bytes]]
+
+# Requests with more ranges than this are sent the whole body instead.
+MAX_RANGES = 16
+
+# Size of the chunks used when a body can not be sent with sendfile().
+COPY_CHUNK_SIZE = 64 * 1024
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[List[Range]]:
+    """
+    Parses a Range header for a body of the given size.
+
+    :return: The ranges to send, an empty list if none of them can be
+             satisfied, or None if the whole body should be sent.
+    """
+
+    if not header or not header.startswith("bytes="):
+        return None
+
+    specs = header[6:].split(",")
+
+    if len(specs) > MAX_RANGES:
+        return None
+
+    ranges: List[Range] = []
+
+    for spec in specs:
+        try:
+            ranges.append(parse_range_spec(spec.strip(), size))
+        except ValueError:
+            return None
+
+    return [(first, last) for first, last in ranges if first <= last and first < size]
+
+
+def parse_range_spec(spec: str, size: int) -> Range:
+    """
+    Parses one range, e.g. "0-499", "500-" or "-500" (the last 500 bytes).
+
+    :raises ValueError: If the range is not valid.
+    """
+
+    [first, sep, last] = spec.partition("-")
+
+    if not sep or not (first or last):
+        raise ValueError(f"Invalid range {spec}")
+
+    if not first:
+        return max(0, size - int(last)), size - 1
+
+    if last and int(last) < int(first):
+        raise ValueError(f"Invalid range {spec}")
+
+    return int(first), min(int(last), size - 1) if last else size - 1
+
+
+def requested_ranges(
+    self: http.server.BaseHTTPRequestHandler,
+    size: int,
+    etag: str,
+    last_modified: Optional[int] = None,
+) -> Optional[List[Range]]:
+    """
+    Gets the ranges of a body that the client asked for, taking If-Range
+    into account.
+
+    :return: As for parse_range.
+    """
+
+    condition = self.headers["If-Range"]
+
+    if condition and condition != etag:
+        try:
+            since = email.utils.parsedate_to_datetime(condition).timestamp()
+        except (TypeError, ValueError):
+            return None
+
+        if last_modified is None or int(since) != last_modified:
+            return None
+
+    return parse_range(self.headers["Range"], size)
+
+
+def send_ranges(
+    self: http.server.BaseHTTPRequestHandler,
+    body: Body,
+    size: int,
+    mime: str,
+    ranges: List[Range],
+    headers: Dict[str, str],
+) -> None:
+    """
+    Sends a 206 response with the requested ranges of a body (or a 416
+    if there are none), as multipart/byteranges if there is more than one.
+
+    :param headers: Extra headers for the response, such as the ETag.
+    """
+
+    if not ranges:
+        self.send_response(416)
+        self.send_header("Content-Range", f"bytes */{size}")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        return
+
+    self.send_response(206)
+
+    for name, value in headers.items():
+        self.send_header(name, value)
+
+    if len(ranges) == 1:
+        [(first, last)] = ranges
+
+        self.send_header("Content-Type", mime)
+        self.send_header("Content-Range", f"bytes {first}-{last}/{size}")
+        self.send_header("Content-Length", str(last - first + 1))
+        self.end_headers()
+
+        send_region(self, body, first, last - first + 1)
+        return
+
+    boundary = secrets.token_hex(16)
+    parts = [
+        (
+            f"\r\n--{boundary}\r\nContent-Type: {mime}\r\n"
+            f"Content-Range: bytes {first}-{last}/{size}\r\n\r\n"
+        ).encode("ascii")
+        for first, last in ranges
+    ]
+    end = f"\r\n--{boundary}--\r\n".encode("ascii")
+    length = sum(len(part) for part in parts) + len(end)
+    length += sum(last - first + 1 for first, last in ranges)
+
+    self.send_header("Content-Type", f"multipart/byteranges; boundary={boundary}")
+    self.send_header("Content-Length", str(length))
+    self.end_headers()
+
+    for part, (first, last) in zip(parts, ranges):
+        self.wfile.write(part)
+        send_region(self, body, first, last - first + 1)
+
+    self.wfile.write(end)
+
+
+def send_region(
+    self: http.server.BaseHTTPRequestHandler, body: Body, offset: int, count: int
+) -> None:
+    """Sends `count` bytes of a body, starting from `offset`"""
+
+    if isinstance(body, bytes):
+        end = offset + count
+        self.wfile.write(memoryview(body)[offset:end])
+        return
+
+    connection = getattr(self, "connection", None)
+
+    # Anything already buffered must be sent before writing to the socket.
+    self.wfile.flush()
+
+    if isinstance(connection, socket.socket):
+        # Uses sendfile(2), except for TLS sockets, which fall back to send().
+        sent = connection.sendfile(body, offset, count)
+
+        # The bytes bypassed the writer, but still count as sent.
+        if isinstance(self.wfile, CountingWriter):
+            self.wfile.written += sent
+
+        return
+
+    body.seek(offset)
+
+    while count > 0:
+        chunk = body.read(min(count, COPY_CHUNK_SIZE))
+
+        if not chunk:
+            break
+
+        self.wfile.write(chunk)
+        count -= len(chunk)
@@ -0,0 +1,366 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: nospell ts=4 expandtab
+
+"""
+Request routing: a trie of path segments, built once, and a chain of
+middleware which every request passes through on the way to its handler.
+
+A route's path is a list of "/"-separated segments, each of which is
+either literal, or captures a parameter: `{name}`, or `{name:int}` for a
+number, optionally after a literal prefix, as in `event-{name}`. Literal
+segments take precedence over parameters.
+
+A route's arguments are passed to its handler after the request handler.
+An argument of just `{name}` is replaced by that parameter's value (with
+its type); other arguments are formatted with the parameters, so
+`"event-{name}"` gives the whole segment back. Middleware may add
+parameters of its own, such as the logged in user.
+"""
+
+from __future__ import annotations
+
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import http.server
+import re
+import urllib.parse
+
+# Converts a captured segment to a parameter's value (or raises ValueError).
+Converter = Callable[[str], Any]
+
+
+def to_int(value: str) -> int:
+    """Converts a segment of digits (with no sign or spaces) to a number"""
+
+    if not value.isdigit():
+        raise ValueError(f"Not a number: {value}")
+
+    return int(value)
+
+
+CONVERTERS: Dict[str, Converter] = {"str": str, "int": to_int}
+
+# `{name}` or `{name:type}`, with any literal text before it.
+PARAMETER = re.compile(r"^([^{}]*)\{(\w+)(?::(\w+))?\}$")
+
+# An argument which is exactly one parameter.
+WHOLE_PARAMETER = re.compile(r"^\{(\w+)\}$")
+
+
+class Route:
+    """A handler, and the requests it serves"""
+
+    method: str
+
+    # The path pattern, which is also the route's name in the metrics.
+    pattern: str
+
+    handler: Callable[..., None]
+
+    # Templates for the arguments passed to the handler.
+    args: List[str]
+
+    # Whether the route needs a logged in user.
+    auth: bool
+
+    # Whether the handler does CPU-heavy work (bcrypt, parsing, zip building).
+    blocking: bool
+
+    # How to build each argument: (parameter or template, is whole parameter)
+    compiled_args: List[Tuple[str, bool]]
+
+    def __init__(
+        self: Route,
+        method: str,
+        pattern: str,
+        handler: Callable[..., None],
+        args: Iterable[str] = (),
+        auth: bool = False,
+        blocking: bool = False,
+    ) -> None:
+        self.method = method
+        self.pattern = pattern
+        self.handler = handler
+        self.args = list(args)
+        self.auth = auth
+        self.blocking = blocking
+        self.compiled_args = []
+
+        for arg in self.args:
+            whole = WHOLE_PARAMETER.match(arg)
+            self.compiled_args.append((whole.group(1), True) if whole else (arg, False))
+
+    def get_args(self: Route, params: Dict[str, Any]) -> List[Any]:
+        """
+        Builds the arguments for the handler.
+
+        :raises KeyError: If an argument uses a parameter that was not set.
+        """
+
+        return [
+            params[arg] if whole else arg.format(**params) if "{" in arg else arg
+            for arg, whole in self.compiled_args
+        ]
+
+    def call(
+        self: Route, handler: http.server.BaseHTTPRequestHandler, params: Dict[str, Any]
+    ) -> None:
+        self.handler(handler, *self.get_args(params))
+
+
+class Parameter:
+    """A segment which captures a parameter"""
+
+    __slots__ = ("prefix", "name", "convert")
+
+    # Literal text that must start the segment (not part of the value).
+    prefix: str
+
+    name: str
+    convert: Converter
+
+    def __init__(self: Parameter, segment: str) -> None:
+        """:raises ValueError: If the segment is not a valid parameter"""
+
+        match = PARAMETER.match(segment)
+
+        if not match:
+            raise ValueError(f"Invalid path segment {segment}")
+
+        self.prefix, self.name, kind = match.groups()
+
+        if (kind or "str") not in CONVERTERS:
+            raise ValueError(f"Unknown parameter type {kind}")
+
+        self.convert = CONVERTERS[kind or "str"]
+
+    def key(self: Parameter) -> Tuple[str, str, Converter]:
+        return (self.prefix, self.name, self.convert)
+
+    def capture(self: Parameter, segment: str) -> Optional[Any]:
+        """Gets the value of the parameter from a segment, if it matches"""
+
+        start = len(self.prefix)
+
+        if not segment.startswith(self.prefix) or len(segment) == start:
+            return None
+
+        try:
+            return self.convert(segment[start:])
+        except ValueError:
+            return None
+
+
+class Node:
+    """A point in the trie of path segments"""
+
+    __slots__ = ("children", "parameters", "routes")
+
+    # The nodes for literal segments { segment => node }
+    children: Dict[str, Node]
+
+    # The nodes for parameter segments, longest prefix first.
+    parameters: List[Tuple[Parameter, Node]]
+
+    # The routes for the path ending at this node { method => route }
+    routes: Dict[str, Route]
+
+    def __init__(self: Node) -> None:
+        self.children = {}
+        self.parameters = []
+        self.routes = {}
+
+    def add(self: Node, segment: str) -> Node:
+        """Gets the node for a segment of a pattern, adding it if needed"""
+
+        if "{" not in segment:
+            return self.children.setdefault(segment, Node())
+
+        parameter = Parameter(segment)
+
+        for existing, node in self.parameters:
+            if existing.key() == parameter.key():
+                return node
+
+        node = Node()
+        self.parameters.append((parameter, node))
+        self.parameters.sort(key=lambda item: -len(item[0].prefix))
+
+        return node
+
+    def find(
+        self: Node, segments: List[str], index: int, params: Dict[str, Any]
+    ) -> Optional[Node]:
+        """Finds the node for a path, capturing its parameters into `params`"""
+
+        if index == len(segments):
+            return self if self.routes else None
+
+        segment = segments[index]
+        child = self.children.get(segment)
+
+        if child:
+            found = child.find(segments, index + 1, params)
+
+            if found:
+                return found
+
+        for parameter, node in self.parameters:
+            value = parameter.capture(segment)
+
+            if value is None:
+                continue
+
+            found = node.find(segments, index + 1, params)
+
+            if found:
+                params[parameter.name] = value
+                return found
+
+        return None
+
+
+class Request:
+    """A request on its way through the middleware"""
+
+    handler: http.server.BaseHTTPRequestHandler
+
+    method: str
+
+    # The request's path, without the query string.
+    path: str
+
+    # The matched route, or None if there is no route for the request.
+    route: Optional[Route]
+
+    # Whether a route matched the path, but not the method.
+    wrong_method: bool
+
+    # The captured path parameters, and any added by the middleware.
+    params: Dict[str, Any]
+
+    def __init__(
+        self: Request,
+        handler: http.server.BaseHTTPRequestHandler,
+        path: str,
+        route: Optional[Route],
+        wrong_method: bool,
+        params: Dict[str, Any],
+    ) -> None:
+        self.handler = handler
+        self.method = handler.command
+        self.path = path
+        self.route = route
+        self.wrong_method = wrong_method
+        self.params = params
+
+    def name(self: Request) -> str:
+        """The name of the request's route, or "other" if it has none"""
+
+        return self.route.pattern if self.route else "other"
+
+
+# Passes a request on to the rest of the chain.
+Next = Callable[[Request], None]
+
+# A step in the chain, which calls `next` to continue, or sends a response.
+Middleware = Callable[[Request, Next], None]
+
+
+def chain(middleware: Middleware, call_next: Next) -> Next:
+    return lambda request: middleware(request, call_next)
+
+
+class Router:
+    """The routes for a server, and the middleware they are all called through"""
+
+    routes: List[Route]
+    root: Node
+
+    # The nodes for patterns without parameters, which are looked up directly.
+    literal: Dict[str, Node]
+
+    middleware: List[Middleware]
+
+    # The first middleware, with the rest of the chain bound to it.
+    entry: Next
+
+    def __init__(
+        self: Router, routes: Iterable[Route], middleware: Iterable[Middleware] = ()
+    ) -> None:
+        self.routes = []
+        self.root = Node()
+        self.literal = {}
+        self.middleware = list(middleware)
+        self.entry = self.call_route
+
+        for route in routes:
+            self.add(route)
+
+        self.use()
+
+    def add(self: Router, route: Route) -> None:
+        """:raises ValueError: If the route's pattern is invalid, or already used"""
+
+        node = self.root
+
+        for segment in route.pattern.split("/")[1:]:
+            node = node.add(segment)
+
+        if route.method in node.routes:
+            raise ValueError(f"Duplicate route {route.method} {route.pattern}")
+
+        node.routes[route.method] = route
+        self.routes.append(route)
+
+        if "{" not in route.pattern:
+            self.literal[route.pattern] = node
+
+    def use(self: Router, *middleware: Middleware) -> None:
+        """Adds middleware to the end of the chain (nearest the handlers)"""
+
+        self.middleware.extend(middleware)
+        self.entry = self.call_route
+
+        for step in reversed(self.middleware):
+            self.entry = chain(step, self.entry)
+
+    def match(
+        self: Router, method: str, path: str
+    ) -> Tuple[Optional[Route], bool, Dict[str, Any]]:
+        """
+        Finds the route for a request.
+
+        :return: The route (if any), whether a route matched the path but
+                 not the method, and the captured parameters.
+        """
+
+        params: Dict[str, Any] = {}
+        node = self.literal.get(path) or self.root.find(path.split("/")[1:], 0, params)
+
+        if not node:
+            return None, False, {}
+
+        route = node.routes.get(method)
+
+        return route, route is None, params
+
+    def dispatch(self: Router, handler: http.server.BaseHTTPRequestHandler) -> None:
+        """Serves a request, through the middleware"""
+
+        path = urllib.parse.urlparse(handler.path).path
+        route, wrong_method, params = self.match(handler.command, path)
+
+        self.entry(Request(handler, path, route, wrong_method, params))
+
+    @staticmethod
+    def call_route(request: Request) -> None:
+        """The end of the chain: calls the route's handler"""
+
+        if request.route:
+            request.route.call(request.handler, request.params)
+        elif request.wrong_method:
+            request.handler.send_error(405, f"Can not {request.method} {request.path}")
+        else:
+            request.handler.send_error(404, f"Path not found {request.path}")
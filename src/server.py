@@ -4,186 +4,212 @@
 
 from __future__ import annotations
 
-from typing import Callable, Dict, List, Optional, Tuple, Union
+from typing import List, Optional, Tuple
 
+import argparse
 import base64
-import cgi
+import email.message
 import os
 import ssl
 import urllib.parse
 
-import bcrypt  # type: ignore
-
 from http.server import ThreadingHTTPServer
-from http.server import BaseHTTPRequestHandler as Handler
 
+import aioserver
+import multipart
+import users
+
+from assets import ASSETS, AssetKey
+from metrics import InstrumentedHandler, record_metrics
+from profiling import PROFILER, profile_request
+from router import Next, Request, Route, Router
+from watcher import WATCHER
+from workers import WORKERS
+
+from catalogue import CATALOGUE, SOURCES
 from handlers import (
+    create_upload_session,
+    do_moderate,
     download_user_empires,
+    import_upload_session,
     page_file,
     page_ajax_list,
+    page_metrics,
+    page_pending,
+    page_worker_stats,
     process_upload,
     send_username,
 )
 
-HandlerWithNoArg = Callable[[Handler], None]
-HandlerWithOneArg = Callable[[Handler, str], None]
-HandlerWithTwoArgs = Callable[[Handler, str, str], None]
-HandlerWithThreeArgs = Callable[[Handler, str, str, str], None]
-
-Handlers = Union[
-    HandlerWithNoArg, HandlerWithOneArg, HandlerWithTwoArgs, HandlerWithThreeArgs
-]
-
-RouteWithNoArg = Tuple[HandlerWithNoArg, bool]
-RouteWithOneArg = Tuple[HandlerWithOneArg, bool, str]
-RouteWithTwoArg = Tuple[Union[HandlerWithTwoArgs, HandlerWithThreeArgs], bool, str, str]
-RouteWithThreeArg = Tuple[
-    Union[HandlerWithTwoArgs, HandlerWithThreeArgs], bool, str, str, str
-]
-
-Route = Union[RouteWithNoArg, RouteWithOneArg, RouteWithTwoArg, RouteWithThreeArg]
-
-ROUTING: Dict[str, Route] = {
-    "/": (page_file, False, "html/welcome.html", "text/html"),
-    "/upload": (page_file, True, "html/upload.html", "text/html"),
-    "/download": (page_file, False, "html/download.html", "text/html"),
-    "/generate": (download_user_empires, True),
-    "/username": (send_username, True, "$user"),
-    "/sources-list": (page_file, True, "sources.json", "application_json"),
-    "/common.js": (page_file, False, "html/upload.js", "application/javascript"),
-    "/upload.js": (page_file, False, "html/upload.js", "application/javascript"),
-    "/sources.js": (page_file, False, "html/sources.js", "application/javascript"),
-    "/style.css": (page_file, False, "html/style.css", "text/css"),
-    "/menu.png": (page_file, False, "images/menu.png", "image/png"),
-}
-
-PREFIX_ROUTING: Dict[str, Route] = {
-    "/ethic/": (page_file, False, "2", "image/png", "images/"),
-    "/event-": (page_file, False, "1", "image/jpg", "images/"),
-    "/ajax/": (page_ajax_list, True, "2"),
-}
-
-
-class StellarisHandler(Handler):
-    server_version = "StellarisEmpireSharer"
-    protocol_version = "HTTP/1.1"
+JAVASCRIPT = "application/javascript"
+
+# The middleware is added below, once StellarisHandler is defined.
+ROUTER = Router(
+    [
+        Route("GET", "/", page_file, ["html/welcome.html", "text/html"]),
+        Route(
+            "GET", "/upload", page_file, ["html/upload.html", "text/html"], auth=True
+        ),
+        Route("GET", "/download", page_file, ["html/download.html", "text/html"]),
+        Route("GET", "/generate", download_user_empires, auth=True, blocking=True),
+        Route("GET", "/username", send_username, ["{user}"], auth=True),
+        Route("GET", "/worker-stats", page_worker_stats, ["{user}"], auth=True),
+        Route("GET", "/metrics", page_metrics, ["{user}"], auth=True),
+        Route("GET", "/admin/pending", page_pending, ["{user}"], auth=True),
+        Route(
+            "GET",
+            "/sources-list",
+            page_file,
+            ["sources.json", "application_json"],
+            auth=True,
+        ),
+        Route("GET", "/common.js", page_file, ["html/upload.js", JAVASCRIPT]),
+        Route("GET", "/upload.js", page_file, ["html/upload.js", JAVASCRIPT]),
+        Route("GET", "/sources.js", page_file, ["html/sources.js", JAVASCRIPT]),
+        Route("GET", "/style.css", page_file, ["html/style.css", "text/css"]),
+        Route("GET", "/menu.png", page_file, ["images/menu.png", "image/png"]),
+        Route("GET", "/ethic/{name}", page_file, ["{name}", "image/png", "images/"]),
+        Route(
+            "GET", "/event-{name}", page_file, ["event-{name}", "image/jpg", "images/"]
+        ),
+        Route("GET", "/ajax/{source}", page_ajax_list, ["{source}"], auth=True),
+        Route(
+            "POST",
+            "/do-upload",
+            process_upload,
+            ["{user}", "{length}"],
+            auth=True,
+            blocking=True,
+        ),
+        Route(
+            "POST",
+            "/upload-session",
+            create_upload_session,
+            ["{user}", "{length}"],
+            auth=True,
+            blocking=True,
+        ),
+        Route(
+            "POST",
+            "/upload-session/{session}",
+            import_upload_session,
+            ["{user}", "{session}", "{length}"],
+            auth=True,
+        ),
+        Route(
+            "POST", "/admin/moderate", do_moderate, ["{user}", "{length}"], auth=True
+        ),
+    ]
+)
 
-    def do_GET(self: StellarisHandler) -> None:
-        """Serve a GET request."""
 
-        # Get the actual request path, excluding the query string.
-        path: str = urllib.parse.urlparse(self.path).path
+def static_assets() -> List[AssetKey]:
+    """Lists the files that page_file routes can serve, with their mime types"""
 
-        # See if we have a route to the current request
-        route: Optional[Route] = self.route(path)
+    files: List[AssetKey] = []
 
-        if not route:
-            self.send_error(404, f"Path not found {path}")
-            return
+    for route in ROUTER.routes:
+        if route.handler is not page_file:
+            continue
 
-        username: Optional[bytes] = None
-        handler: Handlers
-        need_auth: bool
-        params: List[str] = []
-        [handler, need_auth, *params] = route
+        [filename, mime, *folder] = route.args
 
-        if need_auth:
-            # Get the currently logged in user.
-            username = self.auth()
+        if "{" not in filename:
+            files.append((filename, mime))
+            continue
 
-            # A user must be logged in for everything other than the home page.
-            if not username and path != "/":
-                self.send_auth_challenge()
-                return
+        # Routes with a parameter serve any file from a folder; load the
+        # ones which match the route, with the extension for its mime type.
+        prefix = filename.split("{")[0]
+        extension = "." + mime.split("/")[-1]
 
-        # Sub in path elements in params.
-        segments = path.split("/")
-        params = [segments[int(x)] if x.isnumeric() else x for x in params]
+        if not folder or not os.path.isdir(folder[0]):
+            continue
 
-        # Sub in username in params
-        user = username.decode("utf-8") if username else ""
-        params = [user if x == "$user" else x for x in params]
+        for name in sorted(os.listdir(folder[0])):
+            if name.startswith(prefix) and name.endswith(extension):
+                files.append((folder[0] + name, mime))
 
-        # Call the current request handler.
-        handler(self, *params)
+    return files
 
-    def route(self: StellarisHandler, path: str) -> Optional[Route]:
-        if path in ROUTING:
-            return ROUTING[path]
 
-        for prefix in PREFIX_ROUTING:
-            if path.startswith(prefix):
-                return PREFIX_ROUTING[prefix]
+def read_credentials(header: Optional[str]) -> Optional[Tuple[bytes, bytes]]:
+    """
+    Decodes a basic Authorization header into a user and password.
 
+    :raises ValueError: If the header is not valid.
+    """
+
+    if not header:
         return None
 
-    def do_POST(self: StellarisHandler) -> None:
-        username = self.auth()
+    [user, password] = base64.b64decode(header[6:]).split(b":", 1)
 
-        if not username:
-            self.send_auth_challenge()
-            return
+    return user, password
 
-        if self.path != "/do-upload":
-            self.send_error(405, "Can not post to {self.path}")
-            return
 
-        content_type = str(self.headers["content-type"]).strip()
+class StellarisHandler(InstrumentedHandler):
+    server_version = "StellarisEmpireSharer"
+    protocol_version = "HTTP/1.1"
 
-        if ";" not in content_type:
-            self.send_error(415, f"Invalid Content-Type: {content_type}")
-            return
+    # The largest request body that will be accepted, in bytes.
+    max_body_size = multipart.MAX_BODY_SIZE
 
-        [content_type, boundary] = content_type.split(";")
+    def do_GET(self: StellarisHandler) -> None:
+        ROUTER.dispatch(self)
 
-        if content_type.strip() != "multipart/form-data":
-            self.send_error(415, f"Invalid Content-Type: {content_type}")
-            return
+    def do_POST(self: StellarisHandler) -> None:
+        ROUTER.dispatch(self)
 
-        bound_bytes: bytes = boundary.strip().replace("boundary=", "").encode("ascii")
+    @staticmethod
+    def is_blocking(command: str, path: str, headers: email.message.Message) -> bool:
+        """Whether a request may run bcrypt, parsing or zip building"""
 
-        length = str(self.headers["content-length"]).strip()
-        length_bytes = length.encode("ascii")
+        if command != "GET":
+            return True
 
-        msg = cgi.parse_multipart(
-            self.rfile, {"boundary": bound_bytes, "CONTENT-LENGTH": length_bytes}
-        )
+        route, _, _ = ROUTER.match(command, urllib.parse.urlparse(path).path)
 
-        process_upload(self, username.decode("utf-8"), msg)
+        if not route:
+            return False
 
-    def auth(self) -> Optional[bytes]:
-        """Checks if a user is authorised"""
+        if route.blocking:
+            return True
 
-        auth: bytes = self.headers["authorization"]
+        if not route.auth:
+            return False
 
-        if not auth:
-            print("No auth header")
-            return None
+        try:
+            credentials = read_credentials(headers["authorization"])
+        except ValueError:
+            return False
+
+        if not credentials:
+            return False
+
+        # Without recently verified credentials, the request needs bcrypt.
+        return not users.is_verified(*credentials)
+
+    def auth(self) -> Optional[bytes]:
+        """Checks if a user is authorised"""
 
         try:
-            auth = base64.b64decode(auth[6:])
-            [user, password] = auth.split(b":", 1)
-        except Exception as ex:
+            credentials = read_credentials(self.headers["authorization"])
+        except ValueError as ex:
             print("Invalid auth header " + str(ex))
             return None
 
-        if not user or not password:
+        if not credentials:
+            print("No auth header")
             return None
 
-        # Open up the current user database.
-        with open("users.txt", "r+b") as user_file:
-            for line in user_file:
-                if line.startswith(b"#") or b":" not in line:
-                    continue
-
-                [file_user, hashed] = line.strip(b"\n").split(b":", 1)
+        [user, password] = credentials
 
-                if file_user == user.lower():
-                    return user if bcrypt.checkpw(password, hashed) else None
+        if not user or not password:
+            return None
 
-            # If not matched, add a new user to the file.
-            hashed = bcrypt.hashpw(password, bcrypt.gensalt())
-            user_file.write(user.lower() + b":" + hashed + b"\n")
+        if not users.authenticate(user, password):
+            return None
 
         return user
 
@@ -201,14 +227,149 @@ class StellarisHandler(Handler):
         self.wfile.write(b"Hello")
 
 
+def limit_body(request: Request, call_next: Next) -> None:
+    """
+    Middleware which checks the size of a POST body, and adds it to the
+    parameters as `length`.
+
+    Bodies are refused before any of them is read, or credentials are checked.
+    Requests without a route are left to be refused with a 404 or 405.
+    """
+
+    handler = request.handler
+
+    if request.method != "POST":
+        call_next(request)
+        return
+
+    if not request.route:
+        # The body is never read, so the connection can not be reused.
+        handler.close_connection = True
+        call_next(request)
+        return
+
+    try:
+        length = int(handler.headers["Content-Length"])
+    except (TypeError, ValueError):
+        handler.send_error(411, "Content-Length required")
+        return
+
+    if length > StellarisHandler.max_body_size:
+        handler.send_error(
+            413, f"Uploads are limited to {StellarisHandler.max_body_size} bytes"
+        )
+        return
+
+    request.params["length"] = length
+    call_next(request)
+
+
+def require_user(request: Request, call_next: Next) -> None:
+    """
+    Middleware which checks the credentials for routes that need a logged
+    in user, and adds their name to the parameters as `user`.
+    """
+
+    handler = request.handler
+
+    if not request.route or not request.route.auth:
+        call_next(request)
+        return
+
+    assert isinstance(handler, StellarisHandler)
+
+    username = handler.auth()
+
+    if not username:
+        handler.send_auth_challenge()
+        return
+
+    request.params["user"] = username.decode("utf-8")
+    call_next(request)
+
+
+ROUTER.use(record_metrics, limit_body, require_user, profile_request)
+
+
 def main() -> None:
+    parser = argparse.ArgumentParser(description="Stellaris Empire Exchange server")
+    parser.add_argument(
+        "--asyncio",
+        action="store_true",
+        help="serve connections from an event loop, rather than a thread each",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="threads for CPU-heavy requests when using --asyncio",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="worker processes for parsing uploads and building mod packs",
+    )
+    parser.add_argument(
+        "--queue",
+        type=int,
+        default=16,
+        help="jobs that may wait for a worker process before returning 503",
+    )
+    parser.add_argument(
+        "--max-upload",
+        type=int,
+        default=multipart.MAX_BODY_SIZE // 1024 // 1024,
+        help="largest request body accepted, in MiB",
+    )
+    parser.add_argument(
+        "--profile-rate",
+        type=float,
+        default=0.0,
+        help="fraction of requests to profile into profiles/ (admins can also ask "
+        "for a profile with an X-Profile header or ?profile)",
+    )
+    parser.add_argument(
+        "--profile-limit",
+        type=int,
+        default=PROFILER.limit,
+        help="number of profiles to keep",
+    )
+    args = parser.parse_args()
+
+    PROFILER.rate = args.profile_rate
+    PROFILER.limit = args.profile_limit
+    StellarisHandler.max_body_size = args.max_upload * 1024 * 1024
+
     os.chdir(os.path.dirname(os.path.realpath(__file__)))
     os.chdir("..")
 
-    for folder in ["approved", "pending", "historical"]:
+    for folder in SOURCES:
         if not os.path.exists(folder):
             os.mkdir(folder)
 
+    CATALOGUE.load("catalogue.json")
+    users.USERS.load()
+    ASSETS.preload(static_assets())
+    WORKERS.start(args.processes, args.queue)
+
+    # The watcher thread must start after the worker processes are forked.
+    CATALOGUE.attach(WATCHER)
+    WATCHER.start()
+
+    for source in SOURCES:
+        CATALOGUE.refresh(source)
+
+    if args.asyncio:
+        context: Optional[ssl.SSLContext] = None
+
+        if os.path.exists("ssl.cert"):
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain("ssl.cert")
+
+        aioserver.serve(StellarisHandler, ("", 8080), args.workers, context)
+        return
+
     httpd = ThreadingHTTPServer(("", 8080), StellarisHandler)
     address = httpd.socket.getsockname()
     print(f"Serving HTTP on {address}…")
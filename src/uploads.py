@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: nospell ts=4 expandtab
+
+"""
+Cache of parsed uploads, so that picking empires from a design file does
+not need the file to be sent (and parsed) again.
+
+An upload session is keyed by the SHA-256 of the uploaded file, and can
+only be used by the users who uploaded that file. Sessions expire
+SESSION_TTL seconds after they were last used, and the least recently
+used are dropped once there are more than `limit` of them, or they take
+more than `max_memory` bytes. The memory a parsed file takes is estimated
+from the file's size, as walking the parsed objects takes as long as
+parsing them.
+"""
+
+from __future__ import annotations
+
+from typing import List, Optional, Set
+
+from typing_extensions import TypedDict
+
+import collections
+import re
+import threading
+import time
+
+from clauswitz import ClausObject
+
+import importer
+
+# Sessions are hex SHA-256 digests.
+VALID_KEY = re.compile("^[0-9a-f]{64}$")
+
+# Seconds a session is kept after it was last used.
+SESSION_TTL = 30 * 60
+
+# The number of sessions kept.
+SESSION_LIMIT = 32
+
+# The total (estimated) memory used by the sessions' parsed files.
+SESSION_MAX_MEMORY = 128 * 1024 * 1024
+
+# The memory a parsed design file takes, relative to the file's size
+# (measured at just over 5 for both small and large design files).
+PARSED_SIZE_FACTOR = 6
+
+UploadedEmpire = TypedDict(
+    "UploadedEmpire", {"name": str, "valid": bool, "ethics": List[str]}
+)
+
+
+def list_empires(empires: ClausObject) -> List[UploadedEmpire]:
+    """Lists the empires in a parsed design file, in the order of the file"""
+
+    output: List[UploadedEmpire] = []
+
+    for item in empires:
+        if not isinstance(item, tuple):
+            continue
+
+        name, empire = item
+
+        if not isinstance(empire, list):
+            continue
+
+        ethics = [
+            str(ethic).replace("ethic_", "").replace("_", " ")
+            for ethic in importer.get_values(empire, "ethic")
+        ]
+
+        output.append(
+            UploadedEmpire(
+                name=name, valid=importer.is_valid_empire(empire), ethics=ethics
+            )
+        )
+
+    return output
+
+
+class UploadSession:
+    """A parsed upload, and the users who uploaded it"""
+
+    # The SHA-256 of the uploaded file.
+    key: str
+
+    # The estimated memory used by the parsed file.
+    memory: int
+
+    # The parsed file. This is shared between requests, so must not be modified.
+    empires: ClausObject
+
+    listing: List[UploadedEmpire]
+    users: Set[str]
+
+    # When the session expires (monotonic clock).
+    expiry: float
+
+    def __init__(
+        self: UploadSession, key: str, size: int, empires: ClausObject
+    ) -> None:
+        """:param size: The size of the uploaded file"""
+
+        self.key = key
+        self.memory = size * PARSED_SIZE_FACTOR
+        self.empires = empires
+        self.listing = list_empires(empires)
+        self.users = set()
+        self.expiry = 0.0
+
+
+class UploadSessions:
+    """Bounded, expiring LRU cache of upload sessions"""
+
+    ttl: float
+    limit: int
+    max_memory: int
+
+    # The sessions, least recently used first { key => session }
+    sessions: collections.OrderedDict[str, UploadSession]
+
+    # The total estimated memory used by the sessions.
+    memory: int
+
+    lock: threading.Lock
+
+    def __init__(
+        self: UploadSessions,
+        ttl: float = SESSION_TTL,
+        limit: int = SESSION_LIMIT,
+        max_memory: int = SESSION_MAX_MEMORY,
+    ) -> None:
+        self.ttl = ttl
+        self.limit = limit
+        self.max_memory = max_memory
+        self.sessions = collections.OrderedDict()
+        self.memory = 0
+        self.lock = threading.Lock()
+
+    def get(
+        self: UploadSessions, key: str, user: Optional[str] = None
+    ) -> Optional[UploadSession]:
+        """
+        Looks up a session, and keeps it alive for another `ttl` seconds.
+
+        If a user is given, the session is only returned if they uploaded it.
+        """
+
+        with self.lock:
+            self.expire()
+            session = self.sessions.get(key)
+
+            if not session or (user is not None and user not in session.users):
+                return None
+
+            session.expiry = time.monotonic() + self.ttl
+            self.sessions.move_to_end(key)
+
+            return session
+
+    def add(self: UploadSessions, session: UploadSession, user: str) -> UploadSession:
+        """
+        Adds a user to a session, storing the session if it is new.
+
+        :return: The stored session, which is an existing one with the same
+                 key if the same file was parsed by two requests at once.
+        """
+
+        with self.lock:
+            existing = self.sessions.get(session.key)
+
+            if existing:
+                session = existing
+            else:
+                self.sessions[session.key] = session
+                self.memory += session.memory
+
+            session.users.add(user)
+            session.expiry = time.monotonic() + self.ttl
+            self.sessions.move_to_end(session.key)
+
+            while len(self.sessions) > self.limit or (
+                self.memory > self.max_memory and len(self.sessions) > 1
+            ):
+                self.remove(next(iter(self.sessions)))
+
+            return session
+
+    def expire(self: UploadSessions) -> None:
+        """Removes the expired sessions; the lock must be held"""
+
+        now = time.monotonic()
+        expired = [key for key, s in self.sessions.items() if s.expiry < now]
+
+        for key in expired:
+            self.remove(key)
+
+    def remove(self: UploadSessions, key: str) -> None:
+        session = self.sessions.pop(key)
+        self.memory -= session.memory
+
+
+UPLOADS = UploadSessions()
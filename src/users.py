@@ -0,0 +1,249 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: nospell ts=4 expandtab
+
+"""
+User accounts, stored as `user:bcrypt-hash` lines in users.txt.
+
+Checking a password with bcrypt is deliberately slow, so credentials which
+have been verified are remembered (as a keyed digest, never in plain text)
+for a while, and further requests with the same credentials skip bcrypt.
+"""
+
+from __future__ import annotations
+
+from typing import Dict, Optional, Tuple
+
+import collections
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+
+import bcrypt  # type: ignore[import,unused-ignore]
+
+from metrics import METRICS
+
+# How long, in seconds, a verified credential is trusted for.
+CREDENTIAL_TTL = 15 * 60
+
+# The maximum number of verified credentials remembered at once.
+CREDENTIAL_LIMIT = 1024
+
+
+class UserStore:
+    """
+    The user file, indexed in memory by user name.
+
+    Lookups are dict lookups; the file is only re-read (in bulk) when its
+    mtime or size changes, e.g. after being edited by hand. All appends go
+    through a single lock, which also re-checks for the user, so two
+    concurrent registrations of the same name can not both be written.
+    Each append is fsync'd before the new user is visible to lookups.
+    """
+
+    # The file the users are stored in.
+    filename: str
+
+    # The hashed password for each user { user => hash }
+    users: Dict[bytes, bytes]
+
+    # The (mtime, size) of the file when it was last loaded.
+    loaded: Optional[Tuple[float, int]]
+
+    # Serialises reloads and appends.
+    lock: threading.Lock
+
+    def __init__(self: UserStore, filename: str) -> None:
+        self.filename = filename
+        self.users = {}
+        self.loaded = None
+        self.lock = threading.Lock()
+
+    def load(self: UserStore) -> None:
+        """Loads the whole user file, creating it if needed"""
+
+        with self.lock:
+            if not os.path.exists(self.filename):
+                open(self.filename, "ab").close()
+
+            self.reload()
+
+    def get(self: UserStore, user: bytes) -> Optional[bytes]:
+        """Gets the password hash for a user, if they exist"""
+
+        with self.lock:
+            self.reload()
+
+            return self.users.get(user.lower())
+
+    def register(self: UserStore, user: bytes, hashed: bytes) -> bytes:
+        """
+        Adds a new user to the store, unless they already exist.
+
+        :return: The user's stored hash. If another thread registered the
+                 same user first, this is their hash, not `hashed`.
+        """
+
+        user = user.lower()
+
+        with self.lock:
+            self.reload()
+
+            if user in self.users:
+                return self.users[user]
+
+            handle = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+
+            try:
+                os.write(handle, user + b":" + hashed + b"\n")
+                os.fsync(handle)
+                stat = os.fstat(handle)
+            finally:
+                os.close(handle)
+
+            self.users[user] = hashed
+            self.loaded = (stat.st_mtime, stat.st_size)
+
+            return hashed
+
+    def reload(self: UserStore) -> None:
+        """Re-reads the user file if it has changed since it was last read"""
+
+        stat = os.stat(self.filename)
+
+        if self.loaded == (stat.st_mtime, stat.st_size):
+            return
+
+        users: Dict[bytes, bytes] = {}
+
+        with open(self.filename, "rb") as user_file:
+            for line in user_file:
+                if line.startswith(b"#") or b":" not in line:
+                    continue
+
+                [file_user, hashed] = line.strip(b"\n").split(b":", 1)
+
+                # The first entry for a user is the one that counts.
+                users.setdefault(file_user, hashed)
+
+        self.users = users
+        self.loaded = (stat.st_mtime, stat.st_size)
+
+
+class CredentialCache:
+    """
+    Bounded, expiring set of recently verified credentials.
+
+    Entries are keyed by an HMAC (with a per-process random key) of the
+    user, password and stored hash, so changing a user's stored hash
+    invalidates their cached credentials.
+    """
+
+    secret: bytes
+    ttl: float
+    limit: int
+
+    # { digest => expiry time (monotonic clock) }
+    entries: collections.OrderedDict[bytes, float]
+
+    lock: threading.Lock
+
+    def __init__(
+        self: CredentialCache,
+        ttl: float = CREDENTIAL_TTL,
+        limit: int = CREDENTIAL_LIMIT,
+    ) -> None:
+        self.secret = secrets.token_bytes(32)
+        self.ttl = ttl
+        self.limit = limit
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def digest(
+        self: CredentialCache, user: bytes, password: bytes, hashed: bytes
+    ) -> bytes:
+        message = b"\0".join([user.lower(), password, hashed])
+
+        return hmac.new(self.secret, message, hashlib.sha256).digest()
+
+    def check(self: CredentialCache, digest: bytes) -> bool:
+        """Checks if a credential digest has been verified recently"""
+
+        with self.lock:
+            expiry = self.entries.get(digest)
+
+            if expiry is None:
+                return False
+
+            if expiry < time.monotonic():
+                del self.entries[digest]
+                return False
+
+            self.entries.move_to_end(digest)
+
+            return True
+
+    def add(self: CredentialCache, digest: bytes) -> None:
+        """Records a credential digest as verified"""
+
+        with self.lock:
+            self.entries[digest] = time.monotonic() + self.ttl
+            self.entries.move_to_end(digest)
+
+            while len(self.entries) > self.limit:
+                self.entries.popitem(last=False)
+
+
+USERS = UserStore("users.txt")
+CREDENTIALS = CredentialCache()
+
+
+def is_verified(user: bytes, password: bytes) -> bool:
+    """
+    Checks if a user's password was verified recently, without running bcrypt.
+    """
+
+    hashed = USERS.get(user)
+
+    if hashed is None:
+        return False
+
+    return CREDENTIALS.check(CREDENTIALS.digest(user, password, hashed))
+
+
+def authenticate(user: bytes, password: bytes) -> bool:
+    """
+    Checks a user's password, registering them if they are new.
+    """
+
+    hashed = USERS.get(user)
+
+    # If not matched, add a new user to the file.
+    if hashed is None:
+        with METRICS.timer("bcrypt"):
+            created = bcrypt.hashpw(password, bcrypt.gensalt())
+
+        hashed = USERS.register(user, created)
+
+        # We won the race to create the user, so the password is theirs.
+        if hashed == created:
+            CREDENTIALS.add(CREDENTIALS.digest(user, password, hashed))
+            return True
+
+    digest = CREDENTIALS.digest(user, password, hashed)
+
+    if CREDENTIALS.check(digest):
+        return True
+
+    with METRICS.timer("bcrypt"):
+        matched = bcrypt.checkpw(password, hashed)
+
+    if not matched:
+        return False
+
+    CREDENTIALS.add(digest)
+
+    return True
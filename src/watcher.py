@@ -0,0 +1,363 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: nospell ts=4 expandtab
+
+"""
+Watches source folders (`<source>/<author>/<key>.txt`) for changes.
+
+The watcher keeps a live tree of source => author => key => stat, and tells
+its listeners which files were added, modified or deleted. On Linux it uses
+inotify (through ctypes, so there are no extra dependencies); elsewhere, or
+if inotify is not available, it re-scans the watched folders every
+POLL_INTERVAL seconds.
+
+Either way, a change in a folder causes only that author's folder to be
+re-scanned, so the cost does not grow with the number of empires.
+"""
+
+from __future__ import annotations
+
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import ctypes
+import ctypes.util
+import os
+import struct
+import threading
+import time
+
+# (source, author, key)
+EntryKey = Tuple[str, str, str]
+
+# Kinds of change.
+ADDED = "added"
+MODIFIED = "modified"
+DELETED = "deleted"
+
+# (kind, key, the file's stat, or None if it was deleted)
+WatchEvent = Tuple[str, EntryKey, Optional[os.stat_result]]
+
+# Called, from the watcher's thread, with each batch of changes.
+Listener = Callable[[List[WatchEvent]], None]
+
+# How often, in seconds, the folders are re-scanned without inotify.
+POLL_INTERVAL = 2.0
+
+# inotify(7) event flags.
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+WATCH_MASK = (
+    IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_ONLYDIR
+)
+
+# struct inotify_event { int wd; uint32_t mask, cookie, len; char name[]; }
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def scan_author(folder: str) -> Dict[str, os.stat_result]:
+    """Lists the empire files in an author's folder { key => stat }"""
+
+    found: Dict[str, os.stat_result] = {}
+
+    try:
+        with os.scandir(folder) as files:
+            for empire in files:
+                if empire.name.startswith(".") or not empire.name.endswith(".txt"):
+                    continue
+
+                if empire.is_file():
+                    found[empire.name[:-4]] = empire.stat()
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+
+    return found
+
+
+def scan_authors(source: str) -> List[str]:
+    """Lists the author folders in a source"""
+
+    with os.scandir(source) as authors:
+        return [
+            author.name
+            for author in authors
+            if not author.name.startswith(".") and author.is_dir()
+        ]
+
+
+def scan_source(source: str) -> Dict[EntryKey, os.stat_result]:
+    """Lists the empire files in a source, without reading them"""
+
+    found: Dict[EntryKey, os.stat_result] = {}
+
+    for author in scan_authors(source):
+        for key, stat in scan_author(os.path.join(source, author)).items():
+            found[(source, author, key)] = stat
+
+    return found
+
+
+def is_same(first: os.stat_result, second: os.stat_result) -> bool:
+    return (first.st_mtime_ns, first.st_size) == (second.st_mtime_ns, second.st_size)
+
+
+class Inotify:
+    """Minimal ctypes binding of inotify(7)"""
+
+    fd: int
+    libc: ctypes.CDLL
+
+    def __init__(self: Inotify) -> None:
+        """:raises OSError: If inotify is not available"""
+
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            init = self.libc.inotify_init1
+        except (OSError, AttributeError) as ex:
+            raise OSError(f"inotify is not available: {ex}") from ex
+
+        self.fd = init(os.O_CLOEXEC)
+
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self: Inotify, path: str, mask: int) -> int:
+        """Watches a folder, returning its watch descriptor (or -1 on error)"""
+
+        return int(self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask))
+
+    def read(self: Inotify) -> List[Tuple[int, int, str]]:
+        """Waits for, and returns, a batch of (watch, mask, name) events"""
+
+        data = os.read(self.fd, 64 * 1024)
+        events: List[Tuple[int, int, str]] = []
+        offset = 0
+
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            start = offset + INOTIFY_EVENT.size
+            offset = start + length
+            name = data[start:offset].rstrip(b"\0")
+
+            events.append((wd, mask, os.fsdecode(name)))
+
+        return events
+
+
+class Watcher:
+    """Live tree of the files in a set of source folders"""
+
+    # { source => { author => { key => stat } } }
+    tree: Dict[str, Dict[str, Dict[str, os.stat_result]]]
+
+    listeners: List[Listener]
+
+    # The inotify instance, or None if polling.
+    inotify: Optional[Inotify]
+
+    # The folder each inotify watch is for { wd => (source, author) }
+    # The author is empty for the watch on the source folder itself.
+    watches: Dict[int, Tuple[str, str]]
+
+    thread: Optional[threading.Thread]
+
+    lock: threading.Lock
+
+    def __init__(self: Watcher) -> None:
+        self.tree = {}
+        self.listeners = []
+        self.inotify = None
+        self.watches = {}
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self: Watcher, use_inotify: bool = True) -> None:
+        """Starts the background thread that watches for changes"""
+
+        if self.thread:
+            return
+
+        if use_inotify:
+            try:
+                self.inotify = Inotify()
+            except OSError as ex:
+                print(f"Watching folders by polling: {ex}")
+
+        target = self.run_inotify if self.inotify else self.run_polling
+        self.thread = threading.Thread(target=target, name="watcher", daemon=True)
+        self.thread.start()
+
+    def watch(self: Watcher, source: str) -> Dict[EntryKey, os.stat_result]:
+        """
+        Starts watching a source, if it is not already watched.
+
+        :return: The current contents of the source.
+        """
+
+        with self.lock:
+            if source not in self.tree:
+                self.tree[source] = {}
+                self.add_watch(source, "")
+
+                for author in scan_authors(source):
+                    self.add_watch(source, author)
+                    self.tree[source][author] = scan_author(
+                        os.path.join(source, author)
+                    )
+
+            return {
+                (source, author, key): stat
+                for author, files in self.tree[source].items()
+                for key, stat in files.items()
+            }
+
+    def add_watch(self: Watcher, source: str, author: str) -> None:
+        if not self.inotify:
+            return
+
+        wd = self.inotify.add_watch(os.path.join(source, author), WATCH_MASK)
+
+        if wd >= 0:
+            self.watches[wd] = (source, author)
+
+    def rescan_author(self: Watcher, source: str, author: str) -> List[WatchEvent]:
+        """Re-scans one author's folder, returning what has changed"""
+
+        folder = os.path.join(source, author)
+
+        # The folder is watched before it is scanned, so that a file added
+        # in between is either found by the scan or causes another event.
+        with self.lock:
+            if source not in self.tree:
+                return []
+
+            if os.path.isdir(folder):
+                self.add_watch(source, author)
+
+        found = scan_author(folder)
+
+        with self.lock:
+            if source not in self.tree:
+                return []
+
+            old = self.tree[source].pop(author, {})
+
+            if found:
+                self.tree[source][author] = found
+
+        events: List[WatchEvent] = [
+            (DELETED, (source, author, key), None) for key in old if key not in found
+        ]
+
+        for key, stat in found.items():
+            if key not in old:
+                events.append((ADDED, (source, author, key), stat))
+            elif not is_same(old[key], stat):
+                events.append((MODIFIED, (source, author, key), stat))
+
+        return events
+
+    def rescan(self: Watcher, source: str) -> List[WatchEvent]:
+        """Re-scans a whole source, returning what has changed"""
+
+        with self.lock:
+            known = set(self.tree.get(source, {}))
+
+        try:
+            authors = known | set(scan_authors(source))
+        except OSError:
+            authors = known
+
+        events: List[WatchEvent] = []
+
+        for author in sorted(authors):
+            events.extend(self.rescan_author(source, author))
+
+        return events
+
+    def emit(self: Watcher, events: List[WatchEvent]) -> None:
+        if not events:
+            return
+
+        for listener in self.listeners:
+            try:
+                listener(events)
+            except Exception as ex:
+                print(f"Watcher listener failed: {ex}")
+
+    def run_polling(self: Watcher) -> None:
+        while True:
+            time.sleep(POLL_INTERVAL)
+
+            with self.lock:
+                sources = list(self.tree)
+
+            for source in sources:
+                self.emit(self.rescan(source))
+
+    def run_inotify(self: Watcher) -> None:
+        assert self.inotify
+
+        while True:
+            dirty = self.dirty_folders(self.inotify.read())
+
+            events: List[WatchEvent] = []
+
+            for source, author in sorted(dirty):
+                if author:
+                    events.extend(self.rescan_author(source, author))
+                else:
+                    events.extend(self.rescan(source))
+
+            self.emit(events)
+
+    def dirty_folders(
+        self: Watcher, events: List[Tuple[int, int, str]]
+    ) -> Set[Tuple[str, str]]:
+        """
+        Works out which folders need re-scanning for a batch of inotify events.
+
+        An empty author means the whole source needs re-scanning.
+        """
+
+        dirty: Set[Tuple[str, str]] = set()
+
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                with self.lock:
+                    dirty.update((source, "") for source in self.tree)
+                continue
+
+            with self.lock:
+                folder = self.watches.get(wd)
+
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+
+            if not folder:
+                continue
+
+            source, author = folder
+
+            # Events on a source are for its author folders, and events on
+            # an author's folder are for their files.
+            dirty.add((source, author or name))
+
+        return dirty
+
+
+WATCHER = Watcher()
@@ -0,0 +1,224 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: nospell ts=4 expandtab
+
+"""
+Pool of worker processes for CPU-bound jobs (parsing uploads and building
+mod packs), so that they do not hold the GIL in the request threads.
+
+The number of jobs waiting for a worker is bounded; once it is full, new
+jobs are refused with PoolFull, which handlers report as a 503.
+"""
+
+from __future__ import annotations
+
+from typing import Any, Callable, Optional, TypeVar
+from typing_extensions import TypedDict
+
+import concurrent.futures
+import concurrent.futures.process
+import http.server
+import os
+import threading
+import time
+
+Result = TypeVar("Result")
+
+# Seconds a client is asked to wait before retrying when the pool is full.
+RETRY_AFTER = 5
+
+PoolStats = TypedDict(
+    "PoolStats",
+    {
+        "processes": int,
+        "capacity": int,
+        "running": int,
+        "queued": int,
+        "completed": int,
+        "failed": int,
+        "rejected": int,
+        "mean_latency": float,
+        "max_latency": float,
+    },
+)
+
+
+class PoolFull(Exception):
+    """Raised when a job is submitted while the queue is full"""
+
+
+class WorkerLost(PoolFull):
+    """
+    Raised when a worker process dies while a job is waiting for it.
+
+    The pool is replaced, so only the jobs already submitted fail.
+    """
+
+
+class WorkerPool:
+    """
+    Bounded ProcessPoolExecutor, which keeps statistics on its jobs.
+
+    Until started with some processes, jobs are run in the calling thread,
+    and are not limited.
+    """
+
+    # The number of worker processes.
+    processes: int
+
+    # The number of jobs that can wait for a worker.
+    queue_size: int
+
+    executor: Optional[concurrent.futures.ProcessPoolExecutor]
+
+    # Jobs submitted and not yet finished (running or queued).
+    in_flight: int
+
+    completed: int
+    failed: int
+    rejected: int
+
+    # Total and maximum time from submission to result, in seconds.
+    total_latency: float
+    max_latency: float
+
+    lock: threading.Lock
+
+    def __init__(self: WorkerPool) -> None:
+        self.processes = 0
+        self.queue_size = 0
+        self.executor = None
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.lock = threading.Lock()
+
+    def start(self: WorkerPool, processes: int, queue_size: int) -> None:
+        """
+        Starts the worker processes.
+
+        This should be called before any threads are started, as the
+        workers are forked from the current process.
+        """
+
+        self.processes = processes
+        self.queue_size = queue_size
+
+        if not processes:
+            return
+
+        self.executor = concurrent.futures.ProcessPoolExecutor(processes)
+
+        # Processes are only started as jobs are submitted, so submit
+        # enough jobs to start them all now.
+        futures = [self.executor.submit(os.getpid) for _ in range(processes)]
+        concurrent.futures.wait(futures)
+
+    def stop(self: WorkerPool) -> None:
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+
+    def run(self: WorkerPool, job: Callable[..., Result], *args: Any) -> Result:
+        """
+        Runs a job in a worker process, waiting for the result.
+
+        :raises PoolFull: If there are already too many jobs queued.
+        :raises WorkerLost: If a worker process died.
+        """
+
+        with self.lock:
+            if self.executor and self.in_flight >= self.capacity():
+                self.rejected += 1
+                raise PoolFull()
+
+            self.in_flight += 1
+
+        start = time.monotonic()
+        success = False
+
+        executor = self.executor
+
+        try:
+            if executor:
+                result = executor.submit(job, *args).result()
+            else:
+                result = job(*args)
+
+            success = True
+        except concurrent.futures.process.BrokenProcessPool as ex:
+            assert executor is not None
+            self.restart(executor)
+            raise WorkerLost() from ex
+        finally:
+            self.finished(time.monotonic() - start, success)
+
+        return result
+
+    def restart(
+        self: WorkerPool, broken: concurrent.futures.ProcessPoolExecutor
+    ) -> None:
+        """Replaces a pool which has lost a process (unless already replaced)"""
+
+        with self.lock:
+            if self.executor is not broken:
+                return
+
+            print("A worker process died; restarting the worker pool")
+            self.executor = concurrent.futures.ProcessPoolExecutor(self.processes)
+
+        broken.shutdown(wait=False)
+
+    def capacity(self: WorkerPool) -> int:
+        """The number of jobs that can be running or queued at once"""
+
+        return self.processes + self.queue_size
+
+    def finished(self: WorkerPool, latency: float, success: bool) -> None:
+        with self.lock:
+            self.in_flight -= 1
+
+            if success:
+                self.completed += 1
+            else:
+                self.failed += 1
+
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def stats(self: WorkerPool) -> PoolStats:
+        with self.lock:
+            finished = self.completed + self.failed
+            running = min(self.in_flight, self.processes or self.in_flight)
+
+            return PoolStats(
+                processes=self.processes,
+                capacity=self.capacity(),
+                running=running,
+                queued=self.in_flight - running,
+                completed=self.completed,
+                failed=self.failed,
+                rejected=self.rejected,
+                mean_latency=self.total_latency / finished if finished else 0.0,
+                max_latency=self.max_latency,
+            )
+
+
+WORKERS = WorkerPool()
+
+
+def send_busy(self: http.server.BaseHTTPRequestHandler) -> None:
+    """Tells the client that the server is too busy, and to try again later"""
+
+    message = b"The server is busy, please try again shortly."
+
+    self.send_response(503)
+    self.send_header("Retry-After", str(RETRY_AFTER))
+    self.send_header("Content-Type", "text/plain")
+    self.send_header("Content-Length", str(len(message)))
+    self.end_headers()
+
+    self.wfile.write(message)
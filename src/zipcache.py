@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# vim: nospell ts=4 expandtab
+
+"""
+Cache of built mod pack zips, keyed by ModPack.fingerprint().
+
+Zips are kept on disk, with the least recently used removed once there
+are more than `max_files`. Small zips are also kept in memory, up to a
+total of `max_memory` bytes, so the most popular downloads never touch the
+disk at all.
+"""
+
+from __future__ import annotations
+
+from typing import IO, Optional, Union
+
+import collections
+import os
+import re
+import tempfile
+import threading
+
+# Fingerprints are hex SHA-256 digests.
+VALID_KEY = re.compile("^[0-9a-f]{64}$")
+
+
+class ModPackCache:
+    """
+    Two level (memory and disk) LRU cache of built zips.
+    """
+
+    # The folder the zips are stored in.
+    folder: str
+
+    # The maximum number of zips kept on disk.
+    max_files: int
+
+    # The maximum total size of the zips kept in memory.
+    max_memory: int
+
+    # The largest single zip that will be kept in memory.
+    max_memory_item: int
+
+    # The zips on disk, least recently used first { key => size }
+    files: collections.OrderedDict[str, int]
+
+    # The zips in memory, least recently used first { key => contents }
+    memory: collections.OrderedDict[str, bytes]
+
+    # Whether the existing contents of the folder have been indexed.
+    indexed: bool
+
+    lock: threading.Lock
+
+    def __init__(
+        self: ModPackCache,
+        folder: str,
+        max_files: int = 256,
+        max_memory: int = 32 * 1024 * 1024,
+        max_memory_item: int = 1024 * 1024,
+    ) -> None:
+        self.folder = folder
+        self.max_files = max_files
+        self.max_memory = max_memory
+        self.max_memory_item = max_memory_item
+
+        self.files = collections.OrderedDict()
+        self.memory = collections.OrderedDict()
+        self.indexed = False
+        self.lock = threading.Lock()
+
+    def path(self: ModPackCache, key: str) -> str:
+        return os.path.join(self.folder, f"{key}.zip")
+
+    def get(self: ModPackCache, key: str) -> Optional[Union[bytes, str]]:
+        """
+        Looks up a zip in the cache.
+
+        :return: The contents of the zip if it is held in memory, the path
+                 to it if it is only on disk, or None if it is not cached.
+        """
+
+        with self.lock:
+            self.index()
+
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.files.move_to_end(key)
+                return self.memory[key]
+
+            if key not in self.files:
+                return None
+
+            path = self.path(key)
+
+            if not os.path.exists(path):
+                del self.files[key]
+                return None
+
+            self.files.move_to_end(key)
+            os.utime(path)
+
+            return path
+
+    def open(self: ModPackCache) -> IO[bytes]:
+        """Creates a temporary file to build a zip into, for use with commit()"""
+
+        os.makedirs(self.folder, exist_ok=True)
+
+        return tempfile.NamedTemporaryFile(
+            dir=self.folder, prefix=".build-", suffix=".zip", delete=False
+        )
+
+    def commit(self: ModPackCache, key: str, handle: IO[bytes]) -> None:
+        """Moves a fully built zip (from open()) into the cache"""
+
+        size = handle.tell()
+        handle.close()
+
+        if not VALID_KEY.match(key):
+            os.unlink(handle.name)
+            raise ValueError(f"Invalid cache key {key}")
+
+        with self.lock:
+            os.replace(handle.name, self.path(key))
+            self.files[key] = size
+            self.files.move_to_end(key)
+
+            if size <= self.max_memory_item:
+                with open(self.path(key), "rb") as cached:
+                    self.memory[key] = cached.read()
+
+            self.evict()
+
+    def abort(self: ModPackCache, handle: IO[bytes]) -> None:
+        """Discards a temporary file from open()"""
+
+        handle.close()
+
+        if os.path.exists(handle.name):
+            os.unlink(handle.name)
+
+    def evict(self: ModPackCache) -> None:
+        """Removes the least recently used zips until within the limits"""
+
+        while len(self.files) > self.max_files:
+            key, _ = self.files.popitem(last=False)
+            self.memory.pop(key, None)
+
+            if os.path.exists(self.path(key)):
+                os.unlink(self.path(key))
+
+        while sum(len(data) for data in self.memory.values()) > self.max_memory:
+            self.memory.popitem(last=False)
+
+    def index(self: ModPackCache) -> None:
+        """Adds the zips already in the folder, oldest first, to the cache"""
+
+        if self.indexed:
+            return
+
+        self.indexed = True
+
+        if not os.path.isdir(self.folder):
+            return
+
+        found = []
+
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                key = entry.name[:-4]
+
+                if entry.name.endswith(".zip") and VALID_KEY.match(key):
+                    stat = entry.stat()
+                    found.append((stat.st_mtime, key, stat.st_size))
+                elif entry.name.startswith(".build-"):
+                    # Left over from a build that was interrupted.
+                    os.unlink(entry.path)
+
+        for _, key, size in sorted(found):
+            self.files[key] = size
+
+        self.evict()
+
+
+MODPACK_CACHE = ModPackCache(os.path.join("cache", "modpacks"))